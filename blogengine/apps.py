@@ -1,5 +1,35 @@
-from django.apps import AppConfig
+from django.apps import AppConfig, apps as global_apps
+from django.db import connections
+from django.db.models.signals import post_migrate
+
+# Post fields render_stale reads and writes
+RENDERED_FIELDS = set(['text', 'rendered_text', 'plain_text', 'text_hash', 'renderer_version'])
+
+def render_stale_posts(sender, using, apps=global_apps, **kwargs):
+    '''
+    Store the html of posts gone stale, such as after a renderer change, on
+    deploy, and publish the feeds again with it, since storing it sends no
+    signal.
+    '''
+    fields = set(field.name for field in apps.get_model('blogengine', 'Post')._meta.get_fields())
+    if RENDERED_FIELDS <= fields:
+        from blogengine import publish
+        from blogengine.models import Post
+        if Post.objects.using(using).render_stale() and publish.feeds_root() is not None:
+            publish.publish_after_commit()
+
+def install_search_triggers(sender, using, **kwargs):
+    '''install the SQLite full-text triggers again, dropped when a migration rebuilt the posts table'''
+    from blogengine.search_backends import install_native_triggers
+    install_native_triggers(connections[using])
 
 
 class BlogengineConfig(AppConfig):
     name = 'blogengine'
+
+    def ready(self):
+        # Keep the search index, suggestions, published feeds and static
+        # export up to date
+        from blogengine import publish, regenerate, search_backends, suggest
+        post_migrate.connect(install_search_triggers, sender=self)
+        post_migrate.connect(render_stale_posts, sender=self)
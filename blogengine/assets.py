@@ -0,0 +1,150 @@
+import mimetypes
+import os
+import posixpath
+import re
+
+from django.conf import settings
+from django.contrib.staticfiles import finders, handlers
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage, staticfiles_storage
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.base import ContentFile
+from django.http import Http404
+from django.utils._os import safe_join
+from blogengine import images, publish
+
+# Files worth precompressing, by extension
+COMPRESSED_EXTENSIONS = ('.css', '.js', '.svg', '.txt', '.xml', '.json', '.map', '.eot', '.ttf')
+
+# Smaller files gain less from compression than it costs to negotiate
+MIN_COMPRESSED_SIZE = 256
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+# Relative urls in stylesheets, with their quotes
+CSS_URL_RE = re.compile(r'''url\((\s*['"]?)(?!data:|[a-z]+://|/|#)([^'")]+)(['"]?\s*)\)''')
+
+def bundles():
+    '''the stylesheets of each bundle, by the name of the bundle'''
+    return getattr(settings, 'STATIC_BUNDLES', {})
+
+def rewrite_css_urls(css, source, rewrite):
+    '''css of the stylesheet source, with rewrite(path) in place of its relative urls'''
+    source_dir = posixpath.dirname(source)
+
+    def rebase(match):
+        url, suffix = re.match(r'([^?#]*)(.*)', match.group(2)).groups()
+        path = posixpath.normpath(posixpath.join(source_dir, url))
+        return 'url(%s%s%s%s)' % (match.group(1), rewrite(path), suffix, match.group(3))
+
+    return CSS_URL_RE.sub(rebase, css)
+
+def rebase_css(css, source, bundle):
+    '''css of the stylesheet source, with its relative urls made relative to bundle'''
+    bundle_dir = posixpath.dirname(bundle) or '.'
+    return rewrite_css_urls(css, source, lambda path: posixpath.relpath(path, bundle_dir))
+
+def static_url(name):
+    '''url of a static file, fingerprinted once collected'''
+    try:
+        return staticfiles_storage.url(name)
+    except ValueError:
+        # Referenced by a stylesheet but missing from the manifest
+        return settings.STATIC_URL + name
+
+def bundle_css(bundle):
+    '''the stylesheets of bundle as found in the static directories, with absolute urls'''
+    css = []
+    for source in bundles()[bundle]:
+        with open(finders.find(source), encoding='utf-8') as stylesheet:
+            css.append(rewrite_css_urls(stylesheet.read(), source, static_url))
+    return '\n'.join(css)
+
+class CompressedManifestStorage(ManifestStaticFilesStorage):
+    '''
+    Manifest storage that also builds the STATIC_BUNDLES stylesheets, so
+    they are fingerprinted with the rest, and writes gzip and, with brotli
+    installed, br variants of the text files next to them for the static
+    files handler to serve. Until collectstatic has run the files keep
+    their names, as in development.
+    '''
+    def stored_name(self, name):
+        if not self.hashed_files:
+            return name
+        return super(CompressedManifestStorage, self).stored_name(name)
+
+    def build_bundle(self, name, sources):
+        css = []
+        for source in sources:
+            with self.open(source) as stylesheet:
+                css.append(rebase_css(stylesheet.read().decode('utf-8'), source, name))
+        if self.exists(name):
+            self.delete(name)
+        self.save(name, ContentFile('\n'.join(css).encode('utf-8')))
+
+    def compress(self, name):
+        if os.path.splitext(name)[1] not in COMPRESSED_EXTENSIONS:
+            return
+        with self.open(name) as original:
+            data = original.read()
+        if len(data) < MIN_COMPRESSED_SIZE:
+            return
+        for extension, compressed in publish.compressed_variants(data):
+            if len(compressed) < len(data):
+                publish.write_atomic('%s.%s' % (self.path(name), extension), compressed)
+
+    def post_process(self, paths, dry_run=False, **options):
+        if not dry_run:
+            for name, sources in bundles().items():
+                self.build_bundle(name, sources)
+                paths[name] = (self, name)
+        for processed in super(CompressedManifestStorage, self).post_process(paths, dry_run, **options):
+            yield processed
+        if not dry_run:
+            for name in set(self.hashed_files) | set(self.hashed_files.values()):
+                self.compress(name)
+
+# The manifest last read, and the fingerprinted names in it
+_fingerprinted = (None, frozenset())
+
+def fingerprinted_names():
+    global _fingerprinted
+    hashed_files = getattr(staticfiles_storage, 'hashed_files', {})
+    if _fingerprinted[0] is not hashed_files:
+        _fingerprinted = (hashed_files, frozenset(hashed_files.values()))
+    return _fingerprinted[1]
+
+def serve(request, path, root=None, immutable=False):
+    '''
+    The static file at path in root, STATIC_ROOT by default, or its
+    precompressed variant the client accepts best. Fingerprinted files, and
+    every file when immutable is set, are cached for good, the others
+    revalidated.
+    '''
+    try:
+        full_path = safe_join(root or settings.STATIC_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404
+    if not os.path.isfile(full_path):
+        raise Http404
+    content_type, encoding = mimetypes.guess_type(full_path)
+    response = publish.serve(request, full_path, content_type or 'application/octet-stream')
+    if response is None:
+        raise Http404
+    if immutable or path.replace(os.sep, '/') in fingerprinted_names():
+        response['Cache-Control'] = IMMUTABLE
+    else:
+        response['Cache-Control'] = 'public, max-age=%d' % getattr(settings, 'STATIC_MAX_AGE', 3600)
+    return response
+
+class StaticFilesHandler(handlers.StaticFilesHandler):
+    '''WSGI middleware serving STATIC_ROOT with serve, ahead of the site'''
+    def serve(self, request):
+        return serve(request, self.file_path(request.path))
+
+class ImagesHandler(handlers.StaticFilesHandler):
+    '''WSGI middleware serving the image variants, named after their content'''
+    def get_base_url(self):
+        return images.images_url()
+
+    def serve(self, request):
+        return serve(request, self.file_path(request.path), images.images_root(), immutable=True)
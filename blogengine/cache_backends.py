@@ -0,0 +1,177 @@
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+# Per-process store of the local tier, shared by the threads of a worker and
+# keyed by the name of the remote cache: its entries, their total size in
+# bytes and its lock.
+_local_tiers = {}
+_local_sizes = {}
+_local_locks = {}
+
+class TieredCache(BaseCache):
+    '''
+    Cache backend with a size-bounded, TTL-aware LRU in each worker in front
+    of a remote cache.
+
+    LOCATION is the alias of the remote cache. Writes go through to it, and
+    reads are answered from the local tier while the entry is younger than
+    the LOCAL_TIMEOUT option, so a change made by another worker shows up
+    here at most that many seconds later. Local entries are stored under the
+    full versioned key, so a read for another cache version never sees them.
+    The local tier holds at most MAX_ENTRIES entries and MAX_BYTES bytes of
+    pickled values. Keys starting with one of the REMOTE_ONLY_PREFIXES, such
+    as the dependency versions other entries are checked against, are
+    always read from the remote cache.
+    '''
+    def __init__(self, location, params):
+        super(TieredCache, self).__init__(params)
+        options = params.get('OPTIONS', {})
+        self.remote_alias = location
+        self.local_timeout = options.get('LOCAL_TIMEOUT', 5)
+        self.max_bytes = options.get('MAX_BYTES', 64 * 1024 * 1024)
+        self.remote_only_prefixes = tuple(options.get('REMOTE_ONLY_PREFIXES', ()))
+        self._local = _local_tiers.setdefault(location, OrderedDict())
+        self._size = _local_sizes.setdefault(location, [0])
+        self._lock = _local_locks.setdefault(location, threading.Lock())
+
+    @property
+    def remote(self):
+        return caches[self.remote_alias]
+
+    def _is_local(self, key):
+        return not key.startswith(self.remote_only_prefixes)
+
+    def _local_get(self, key):
+        with self._lock:
+            try:
+                pickled, expires = self._local[key]
+            except KeyError:
+                return None
+            if expires <= time.time():
+                self._pop(key)
+                return None
+            self._local.move_to_end(key)
+        return pickle.loads(pickled)
+
+    def _pop(self, key):
+        entry = self._local.pop(key, None)
+        if entry is not None:
+            self._size[0] -= len(entry[0])
+
+    def _local_set(self, key, value, timeout=DEFAULT_TIMEOUT):
+        expires = time.time() + self.local_timeout
+        backend_timeout = self.get_backend_timeout(timeout)
+        if backend_timeout is not None:
+            expires = min(expires, backend_timeout)
+        if expires <= time.time():
+            self._local_delete(key)
+            return
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._pop(key)
+            if len(pickled) > self.max_bytes:
+                return
+            self._local[key] = (pickled, expires)
+            self._size[0] += len(pickled)
+            while len(self._local) > self._max_entries or self._size[0] > self.max_bytes:
+                self._pop(next(iter(self._local)))
+
+    def _local_delete(self, key):
+        with self._lock:
+            self._pop(key)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        added = self.remote.add(key, value, timeout, version=version)
+        if added and self._is_local(key):
+            self._local_set(self.make_key(key, version), value, timeout)
+        return added
+
+    def get(self, key, default=None, version=None):
+        if not self._is_local(key):
+            return self.remote.get(key, default, version=version)
+        local_key = self.make_key(key, version)
+        value = self._local_get(local_key)
+        if value is not None:
+            return value
+        value = self.remote.get(key, version=version)
+        if value is None:
+            return default
+        self._local_set(local_key, value)
+        return value
+
+    def get_remote(self, key, default=None, version=None):
+        '''
+        The value of key in the remote cache, replacing the local copy, for
+        readers that found the local copy outdated.
+        '''
+        local_key = self.make_key(key, version)
+        value = self.remote.get(key, version=version)
+        if value is None:
+            self._local_delete(local_key)
+            return default
+        if self._is_local(key):
+            self._local_set(local_key, value)
+        return value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.remote.set(key, value, timeout, version=version)
+        if self._is_local(key):
+            self._local_set(self.make_key(key, version), value, timeout)
+
+    def delete(self, key, version=None):
+        self._local_delete(self.make_key(key, version))
+        self.remote.delete(key, version=version)
+
+    def get_many(self, keys, version=None):
+        found = {}
+        missing = []
+        for key in keys:
+            value = self._local_get(self.make_key(key, version)) if self._is_local(key) else None
+            if value is None:
+                missing.append(key)
+            else:
+                found[key] = value
+        if missing:
+            fetched = self.remote.get_many(missing, version=version)
+            for key, value in fetched.items():
+                if self._is_local(key):
+                    self._local_set(self.make_key(key, version), value)
+            found.update(fetched)
+        return found
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        failed = self.remote.set_many(data, timeout, version=version) or []
+        for key, value in data.items():
+            if key not in failed and self._is_local(key):
+                self._local_set(self.make_key(key, version), value, timeout)
+        return failed
+
+    def delete_many(self, keys, version=None):
+        for key in keys:
+            self._local_delete(self.make_key(key, version))
+        self.remote.delete_many(keys, version=version)
+
+    def has_key(self, key, version=None):
+        return self.get(key, version=version) is not None
+
+    def incr(self, key, delta=1, version=None):
+        local_key = self.make_key(key, version)
+        try:
+            value = self.remote.incr(key, delta, version=version)
+        except ValueError:
+            self._local_delete(local_key)
+            raise
+        if self._is_local(key):
+            self._local_set(local_key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._local.clear()
+            self._size[0] = 0
+        self.remote.clear()
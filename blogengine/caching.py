@@ -0,0 +1,104 @@
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.db import transaction
+
+# Collections: a listing that shows posts, categories or tags depends on the
+# whole collection, a page about one of them on that entity only.
+POSTS = 'posts'
+CATEGORIES = 'categories'
+TAGS = 'tags'
+
+# The categories page, which only changes with category membership
+CATEGORY_OVERVIEW = 'category-overview'
+
+# Resized image variants, which markdown rendered before they were made lacks
+IMAGES = 'images'
+
+VERSION_KEY_PREFIX = 'blogengine:version:'
+
+def get_cache():
+    return caches[getattr(settings, 'CACHE_MIDDLEWARE_ALIAS', 'default')]
+
+def dependency(kind, pk=None):
+    '''name of the dependency on a collection, or on one entity of it'''
+    if pk is None:
+        return kind
+    return '%s:%s' % (kind, pk)
+
+def post_dependency(pk):
+    return dependency(POSTS, pk)
+
+def category_dependency(pk):
+    return dependency(CATEGORIES, pk)
+
+def tag_dependency(pk):
+    return dependency(TAGS, pk)
+
+def version_key(name):
+    return VERSION_KEY_PREFIX + name
+
+def get_versions(dependencies):
+    '''current version of each dependency, None for never invalidated'''
+    dependencies = sorted(set(dependencies))
+    if not dependencies:
+        return {}
+    found = get_cache().get_many([version_key(name) for name in dependencies])
+    return dict((name, found.get(version_key(name))) for name in dependencies)
+
+def versions_are_current(versions):
+    '''whether none of the dependencies in a snapshot has been invalidated'''
+    return get_versions(versions.keys()) == versions
+
+def bump(*dependencies):
+    '''move the version of every dependency on, so entries built on it go stale'''
+    cache = get_cache()
+    for name in set(dependencies):
+        key = version_key(name)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Never invalidated, or the counter was evicted. Start from a
+            # value that can't match any snapshot taken before.
+            cache.set(key, int(time.time() * 1000000), None)
+
+def invalidate(*dependencies):
+    '''bump the dependencies once the current transaction has committed'''
+    dependencies = [name for name in dependencies if name is not None]
+    if dependencies:
+        transaction.on_commit(lambda: bump(*dependencies))
+
+def add_dependencies(request, *dependencies):
+    '''
+    Record that the response to request is built from dependencies.
+
+    The versions are captured now, before the data is read, so that an
+    invalidation racing with the rendering leaves the cached page stale
+    rather than current.
+    '''
+    versions = getattr(request, '_cache_dependencies', None)
+    if versions is None:
+        versions = request._cache_dependencies = {}
+    missing = [name for name in dependencies if name not in versions]
+    versions.update(get_versions(missing))
+
+def get_dependencies(request):
+    '''versions snapshot of everything the response to request depends on'''
+    return getattr(request, '_cache_dependencies', {})
+
+def cached(key, dependencies, builder, timeout=DEFAULT_TIMEOUT):
+    '''
+    Return the cached value of a fragment, calling builder to rebuild it
+    when it is missing or any of its dependencies was invalidated.
+    '''
+    cache = get_cache()
+    entry = cache.get(key)
+    if entry is not None and versions_are_current(entry['versions']):
+        return entry['value']
+
+    versions = get_versions(dependencies)
+    value = builder()
+    cache.set(key, {'value': value, 'versions': versions}, timeout)
+    return value
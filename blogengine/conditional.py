@@ -0,0 +1,103 @@
+import datetime
+import functools
+import hashlib
+
+from django.contrib.flatpages.models import FlatPage
+from django.contrib.sites.models import Site
+from django.db.models import Count, Max
+from django.utils.encoding import force_bytes
+from django.views.decorators.http import condition
+from blogengine import export
+from blogengine.models import Category, Post, Tag
+
+# The templates and assets pages are rendered from only change with a
+# deploy, which restarts the workers, so their digest is taken once
+build_stamp = functools.lru_cache(maxsize=None)(export.build_stamp)
+
+def conditional(state_func):
+    '''
+    Decorator answering conditional GETs for a view with 304s.
+
+    state_func(request, *args, **kwargs) returns a dict of cheap aggregates
+    that change whenever the page would. The ETag is a hash of them and of
+    the build stamp, so a deploy changing the templates or assets changes
+    it too, and the Last-Modified the latest of their dates, so neither
+    needs the page to be rendered.
+    '''
+    def get_validators(request, *args, **kwargs):
+        if getattr(request, '_validators', None) is None:
+            state = state_func(request, *args, **kwargs)
+            dates = [value for value in state.values() if isinstance(value, datetime.datetime)]
+            etag = hashlib.md5(force_bytes('%s|%s|%r' % (build_stamp(), request.get_full_path(),
+                                                           sorted(state.items()))))
+            request._validators = (etag.hexdigest(), max(dates) if dates else None)
+        return request._validators
+
+    def etag_func(request, *args, **kwargs):
+        return get_validators(request, *args, **kwargs)[0]
+
+    def last_modified_func(request, *args, **kwargs):
+        return get_validators(request, *args, **kwargs)[1]
+
+    return condition(etag_func=etag_func, last_modified_func=last_modified_func)
+
+def posts_state(queryset):
+    return queryset.aggregate(posts_updated=Max('updated_at'), posts=Count('pk'))
+
+def categories_state():
+    return Category.objects.aggregate(categories_updated=Max('updated_at'), categories=Count('pk'))
+
+def tags_state():
+    return Tag.objects.aggregate(tags_updated=Max('updated_at'), tags=Count('pk'))
+
+def index_state(request, *args, **kwargs):
+    state = posts_state(Post.objects.all())
+    state.update(categories_state())
+    state.update(tags_state())
+    return state
+
+def post_state(request, slug, *args, **kwargs):
+    return Post.objects.filter(slug=slug).aggregate(
+        post_updated=Max('updated_at'),
+        category_updated=Max('category__updated_at'),
+        tags_updated=Max('tags__updated_at'))
+
+def category_state(request, slug, *args, **kwargs):
+    state = posts_state(Post.objects.filter(category__slug=slug))
+    state.update(Category.objects.filter(slug=slug).aggregate(category_updated=Max('updated_at')))
+    state.update(tags_state())
+    return state
+
+def tag_state(request, slug, *args, **kwargs):
+    state = posts_state(Post.objects.filter(tags__slug=slug))
+    state.update(Tag.objects.filter(slug=slug).aggregate(tag_updated=Max('updated_at')))
+    state.update(categories_state())
+    return state
+
+def archive_state(request, *args, **kwargs):
+    return posts_state(Post.objects.all())
+
+def categories_page_state(request, *args, **kwargs):
+    state = posts_state(Post.objects.all())
+    state.update(categories_state())
+    return state
+
+def feed_state(request, *args, **kwargs):
+    return posts_state(Post.objects.all())
+
+def category_feed_state(request, slug, *args, **kwargs):
+    state = posts_state(Post.objects.filter(category__slug=slug))
+    state.update(Category.objects.filter(slug=slug).aggregate(category_updated=Max('updated_at')))
+    return state
+
+def tag_feed_state(request, slug, *args, **kwargs):
+    state = posts_state(Post.objects.filter(tags__slug=slug))
+    state.update(Tag.objects.filter(slug=slug).aggregate(tag_updated=Max('updated_at')))
+    return state
+
+def sitemap_state(request, *args, **kwargs):
+    state = index_state(request)
+    state['pages'] = tuple(FlatPage.objects.filter(sites=Site.objects.get_current(),
+                                                   registration_required=False)
+                           .order_by('pk').values_list('url', flat=True))
+    return state
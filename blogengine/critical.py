@@ -0,0 +1,138 @@
+import os
+import re
+from html.parser import HTMLParser
+
+from django.conf import settings
+
+COMMENT_RE = re.compile(r'/\*.*?\*/', re.S)
+ATTRIBUTE_RE = re.compile(r'\[[^\]]*\]')
+PSEUDO_RE = re.compile(r'::?[\w-]+(\([^)]*\))?')
+COMBINATOR_RE = re.compile(r'\s*[\s>+~]\s*')
+SIMPLE_RE = re.compile(r'([#.]?)(-?[_a-zA-Z][\w-]*)')
+
+# At-rules whose rules are filtered like those at the top level
+NESTED_AT_RULES = ('@media', '@supports')
+
+def critical_root():
+    return getattr(settings, 'CRITICAL_CSS_ROOT', None)
+
+def fold_elements():
+    return getattr(settings, 'CRITICAL_CSS_FOLD_ELEMENTS', 150)
+
+class UsedSelectors(HTMLParser):
+    '''
+    The tags, classes and ids of the elements of a page, up to limit
+    elements into its body, as a stand-in for the content above the fold.
+    '''
+    def __init__(self, limit=None):
+        super(UsedSelectors, self).__init__(convert_charrefs=True)
+        self.limit = limit
+        self.elements = None
+        self.tags, self.classes, self.ids = set(), set(), set()
+
+    def handle_starttag(self, tag, attrs):
+        if self.elements is not None:
+            if self.limit is not None and self.elements >= self.limit:
+                return
+            self.elements += 1
+        elif tag == 'body':
+            self.elements = 0
+        self.tags.add(tag)
+        for name, value in attrs:
+            if name == 'class' and value:
+                self.classes.update(value.split())
+            elif name == 'id' and value:
+                self.ids.add(value)
+
+def statements(css):
+    '''(prelude, block) of the top level statements of css, block None for those without one'''
+    found = []
+    depth, start, quote, block_start = 0, 0, None, None
+    for index, char in enumerate(css):
+        if quote:
+            if char == quote and css[index - 1] != '\\':
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char == '{':
+            if depth == 0:
+                block_start = index
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                found.append((css[start:block_start].strip(), css[block_start + 1:index]))
+                start = index + 1
+        elif char == ';' and depth == 0:
+            found.append((css[start:index].strip(), None))
+            start = index + 1
+    return found
+
+def split_selectors(prelude):
+    selectors, depth, start = [], 0, 0
+    for index, char in enumerate(prelude):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            selectors.append(prelude[start:index].strip())
+            start = index + 1
+    selectors.append(prelude[start:].strip())
+    return [selector for selector in selectors if selector]
+
+def selector_matches(selector, used):
+    '''
+    Whether every tag, class and id selector uses is on the page. Attribute
+    selectors and pseudo-classes are assumed to match.
+    '''
+    selector = PSEUDO_RE.sub('', ATTRIBUTE_RE.sub('', selector)).strip()
+    for compound in COMBINATOR_RE.split(selector):
+        for kind, name in SIMPLE_RE.findall(compound):
+            if kind == '.' and name not in used.classes:
+                return False
+            if kind == '#' and name not in used.ids:
+                return False
+            if not kind and name.lower() not in used.tags:
+                return False
+    return True
+
+def extract(css, used):
+    '''the rules of css that apply to the elements in used, in their order'''
+    rules = []
+    for prelude, block in statements(COMMENT_RE.sub('', css)):
+        if block is None or not prelude:
+            continue
+        if prelude.startswith(NESTED_AT_RULES):
+            nested = extract(block, used)
+            if nested:
+                rules.append('%s{%s}' % (prelude, nested))
+        elif prelude.startswith('@font-face'):
+            # Icon fonts are only downloaded once something uses them
+            rules.append('%s{%s}' % (prelude, block.strip()))
+        elif not prelude.startswith('@'):
+            selectors = [selector for selector in split_selectors(prelude)
+                         if selector_matches(selector, used)]
+            if selectors:
+                rules.append('%s{%s}' % (','.join(selectors), ' '.join(block.split())))
+    return '\n'.join(rules)
+
+def critical_path(name):
+    return os.path.join(critical_root(), '%s.css' % name)
+
+# The critical css read of each page, with the time its file was modified
+_read = {}
+
+def critical_css(name):
+    '''the critical css built for the page name, None when it wasn't built'''
+    if critical_root() is None:
+        return None
+    path = critical_path(name)
+    try:
+        modified = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    if name not in _read or _read[name][0] != modified:
+        with open(path, encoding='utf-8') as css:
+            _read[name] = (modified, css.read())
+    return _read[name][1]
@@ -0,0 +1,286 @@
+import contextlib
+import fcntl
+import hashlib
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import threading
+
+from django.conf import settings
+from django.contrib.flatpages.models import FlatPage
+from django.contrib.sites.models import Site
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.handlers.base import BaseHandler
+from django.core.urlresolvers import reverse
+from django.db import connections
+from django.db.models import Count
+from django.template import engines
+from django.test import RequestFactory
+from django.utils import timezone
+from blogengine import critical, markup, publish, sitemaps
+from blogengine.models import Category, Post, Tag
+from blogengine.pagination import PAGE_SIZE, anchored_pages, listing_url
+
+logger = logging.getLogger(__name__)
+
+MANIFEST = '.export-manifest.json'
+LOCK = '.export-lock'
+
+# Held while the manifest is read and written back by a thread of this process
+manifest_lock = threading.Lock()
+
+# File extension of index files, by content type
+EXTENSIONS = {
+    'application/rss+xml': 'xml',
+    'application/atom+xml': 'xml',
+    'application/feed+json': 'json',
+    'application/json': 'json',
+}
+
+def page_urls(name, count, **kwargs):
+    '''urls of a listing of count posts and of its numbered pages, numbered from the oldest'''
+    pages = anchored_pages(count, PAGE_SIZE) if count else 0
+    return [listing_url(name, number, **kwargs) for number in [None] + list(range(1, pages + 1))]
+
+def archive_urls(months):
+    '''urls of the archive pages of the years and months of months, in UTC as post urls'''
+    urls = [reverse('blogengine:post_archive_year', args=[year])
+            for year in sorted(set(month.year for month in months))]
+    urls.extend(reverse('blogengine:post_archive_month', args=[month.year, month.month])
+                for month in months)
+    return urls
+
+def feed_urls():
+    '''urls of the posts feeds, in every format'''
+    return [reverse('blogengine:feed')] + [reverse('blogengine:feed_format', kwargs={'format': format})
+                                           for format in ('atom', 'json')]
+
+def sitemap_urls():
+    '''urls of the sitemap index and of every sitemap it links to'''
+    return [reverse('blogengine:sitemap')] + [
+        reverse('blogengine:sitemap_section', kwargs={'section': section, 'shard': shard})
+        for section, shard, lastmod in sitemaps.index_entries()]
+
+def site_urls():
+    '''every public url of the blog, and the public flatpages of the current site'''
+    urls = page_urls('index', Post.objects.count())
+    urls.extend(post.get_absolute_url() for post in Post.objects.only('slug', 'pub_date'))
+
+    for model, name in ((Category, 'category'), (Tag, 'tag')):
+        for item in model.objects.exclude(slug=None).annotate(
+                count=Count('post')).only('slug'):
+            urls.extend(page_urls(name, item.count, slug=item.slug))
+            urls.append(reverse('blogengine:%s_feed' % name, kwargs={'slug': item.slug}))
+
+    urls.append(reverse('blogengine:post_archive'))
+    urls.extend(archive_urls(Post.objects.datetimes('pub_date', 'month', tzinfo=timezone.utc)))
+    urls.append(reverse('blogengine:post_category'))
+    urls.extend(feed_urls())
+    urls.extend(sitemap_urls())
+
+    urls.extend(FlatPage.objects.filter(sites=Site.objects.get_current(), registration_required=False)
+                .values_list('url', flat=True))
+    return urls
+
+def output_path(url, content_type):
+    '''path of the file url is written to, relative to the export directory'''
+    path = url.lstrip('/')
+    if url.endswith('/') or not os.path.splitext(path)[1]:
+        extension = EXTENSIONS.get(content_type.split(';')[0].strip(), 'html')
+        path = os.path.join(path, 'index.%s' % extension)
+    return path
+
+def remove_output(directory, path):
+    for variant in [path] + ['%s.%s' % (path, extension) for _, extension in publish.ENCODINGS]:
+        try:
+            os.unlink(os.path.join(directory, variant))
+        except FileNotFoundError:
+            pass
+
+class Renderer(BaseHandler):
+    '''
+    Renders urls through the views and middleware, as a visitor of the
+    current site. The requests are flagged as static_export, so listings
+    link to numbered pages and the page cache is bypassed, and come from an
+    address outside INTERNAL_IPS, so the debug toolbar is left out.
+    '''
+    def __init__(self):
+        super(Renderer, self).__init__()
+        self.load_middleware()
+        self.factory = RequestFactory(SERVER_NAME=Site.objects.get_current().domain,
+                                      REMOTE_ADDR='192.0.2.1')
+
+    def render(self, url, etag=None):
+        '''the response to url and its content, a 304 when its ETag is still etag'''
+        headers = {'HTTP_IF_NONE_MATCH': etag} if etag else {}
+        request = self.factory.get(url, **headers)
+        request.static_export = True
+        response = self.get_response(request)
+        if response.streaming:
+            content = b''.join(response.streaming_content)
+        else:
+            content = response.content
+        response.close()
+        return response, content
+
+def stamp_files():
+    '''the files pages are rendered from besides the database'''
+    directories = [directory for engine in engines.all() for directory in engine.template_dirs]
+    if critical.critical_root() is not None:
+        directories.append(critical.critical_root())
+    paths = []
+    for directory in directories:
+        for root, dirs, files in os.walk(str(directory)):
+            dirs.sort()
+            paths.extend(os.path.join(root, name) for name in sorted(files))
+    manifest_name = getattr(staticfiles_storage, 'manifest_name', None)
+    if settings.STATIC_ROOT and manifest_name:
+        paths.append(os.path.join(settings.STATIC_ROOT, manifest_name))
+    return paths
+
+def build_stamp():
+    '''
+    Digest of the templates, the markdown renderer version, the manifest of
+    the collected static files and the critical css. Their changes don't
+    show in the ETags of pages, so the pages exported under another stamp
+    are rendered again.
+    '''
+    digest = hashlib.sha1(('renderer %d\n' % markup.RENDERER_VERSION).encode('utf-8'))
+    for path in stamp_files():
+        try:
+            with open(path, 'rb') as stamped:
+                content = stamped.read()
+        except OSError:
+            continue
+        digest.update(('%s %d\n' % (path, len(content))).encode('utf-8'))
+        digest.update(content)
+    return digest.hexdigest()
+
+# The renderer of each thread, set up on first use
+_local = threading.local()
+
+def export_url(directory, url, entry, stamp):
+    '''
+    Render url into directory unless it is unchanged since the manifest
+    entry, written under the same build stamp. Returns url, the status of
+    its response, its new entry and whether its file was written.
+    '''
+    if not hasattr(_local, 'renderer'):
+        _local.renderer = Renderer()
+    etag = entry.get('etag') if entry is not None and entry.get('stamp') == stamp else None
+    response, content = _local.renderer.render(url, etag)
+    if response.status_code == 304:
+        return url, 304, entry, False
+    if response.status_code != 200:
+        return url, response.status_code, entry, False
+
+    path = output_path(url, response['Content-Type'])
+    sha1 = hashlib.sha1(content).hexdigest()
+    written = entry is None or entry['sha1'] != sha1 or entry['path'] != path
+    if written:
+        publish.write_compressed(os.path.join(directory, path), content)
+        if entry is not None and entry['path'] != path:
+            remove_output(directory, entry['path'])
+    return url, 200, {'path': path, 'etag': response.get('ETag'), 'sha1': sha1, 'stamp': stamp}, written
+
+def export_root():
+    return getattr(settings, 'EXPORT_ROOT', None)
+
+def read_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST)) as manifest:
+            return json.load(manifest)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+@contextlib.contextmanager
+def locked_manifest(directory):
+    '''
+    Hold the manifest of directory for reading and writing back, against
+    the other threads of this process and the other processes, such as the
+    workers regenerating pages and exportsite.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    with manifest_lock, open(os.path.join(directory, LOCK), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+def write_manifest(directory, manifest):
+    publish.write_atomic(os.path.join(directory, MANIFEST),
+                         json.dumps(manifest, indent=1, sort_keys=True).encode('utf-8'))
+
+def export_tasks(directory, manifest, urls):
+    '''arguments of export_url for urls, forgetting the entries whose file is gone'''
+    stamp = build_stamp()
+    tasks = []
+    for url in urls:
+        entry = manifest.get(url)
+        if entry is not None and not os.path.exists(os.path.join(directory, entry['path'])):
+            entry = None
+        tasks.append((directory, url, entry, stamp))
+    return tasks
+
+def export_site(directory, processes=None, full=False):
+    '''
+    Render every public url into directory, over processes worker processes.
+    Pages whose ETag hasn't changed since the last export, as recorded in
+    its manifest, are not written again unless full is set. Returns the
+    number of pages written, unchanged and removed, and the failed urls.
+    '''
+    directory = os.path.abspath(directory)
+    with locked_manifest(directory):
+        manifest = {} if full else read_manifest(directory)
+        tasks = export_tasks(directory, manifest, site_urls())
+        if processes == 1:
+            results = list(itertools.starmap(export_url, tasks))
+        else:
+            # Workers are forked, and must not share the connections of this process
+            connections.close_all()
+            with multiprocessing.Pool(processes) as pool:
+                results = pool.starmap(export_url, tasks, chunksize=8)
+
+        stats = {'written': 0, 'unchanged': 0, 'removed': 0, 'failed': []}
+        exported = {}
+        for url, status, entry, written in results:
+            if written:
+                stats['written'] += 1
+            elif status in (200, 304):
+                stats['unchanged'] += 1
+            else:
+                stats['failed'].append((url, status))
+            if entry is not None:
+                exported[url] = entry
+
+        for url, entry in manifest.items():
+            if url not in exported:
+                remove_output(directory, entry['path'])
+                stats['removed'] += 1
+        write_manifest(directory, exported)
+    return stats
+
+def export_urls(directory, urls):
+    '''
+    Render urls into directory, removing the pages of those no longer found.
+    Returns the number of pages written.
+    '''
+    directory = os.path.abspath(directory)
+    written_pages = 0
+    with locked_manifest(directory):
+        manifest = read_manifest(directory)
+        for url, status, entry, written in itertools.starmap(
+                export_url, export_tasks(directory, manifest, sorted(urls))):
+            written_pages += written
+            if status == 404:
+                if url in manifest:
+                    remove_output(directory, manifest.pop(url)['path'])
+            elif status in (200, 304):
+                manifest[url] = entry
+            else:
+                logger.error('Exporting %s answered %d', url, status)
+        write_manifest(directory, manifest)
+    return written_pages
@@ -0,0 +1,256 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from html.parser import HTMLParser
+from io import BytesIO
+from urllib.error import URLError
+from urllib.parse import unquote, urlparse
+from urllib.request import Request, urlopen
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.utils.html import escape
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+IMG_RE = re.compile(r'<img\b[^>]*>', re.I)
+
+# Sources larger than this are left as they are
+MAX_SOURCE_BYTES = 20 * 1024 * 1024
+
+FETCH_TIMEOUT = 10
+
+# Content type and file extension of each format variants are written in
+FORMATS = {
+    'WEBP': ('image/webp', 'webp'),
+    'JPEG': ('image/jpeg', 'jpg'),
+    'PNG': ('image/png', 'png'),
+}
+
+def images_root():
+    return getattr(settings, 'RESPONSIVE_IMAGES_ROOT', None)
+
+def images_url():
+    return getattr(settings, 'RESPONSIVE_IMAGES_URL', '/media/images/')
+
+def image_widths():
+    return tuple(getattr(settings, 'RESPONSIVE_IMAGE_WIDTHS', (320, 640, 960, 1280)))
+
+def image_sizes():
+    return getattr(settings, 'RESPONSIVE_IMAGE_SIZES', '100vw')
+
+def image_quality():
+    return getattr(settings, 'RESPONSIVE_IMAGE_QUALITY', 80)
+
+def webp_supported():
+    return Image is not None and features.check('webp')
+
+class TagAttributes(HTMLParser):
+    '''the attributes of the first tag fed, in their order'''
+    def __init__(self):
+        super(TagAttributes, self).__init__(convert_charrefs=True)
+        self.attrs = None
+
+    def handle_starttag(self, tag, attrs):
+        if self.attrs is None:
+            self.attrs = [(name, '' if value is None else value) for name, value in attrs]
+
+    handle_startendtag = handle_starttag
+
+def tag_attributes(tag):
+    parser = TagAttributes()
+    parser.feed(tag)
+    parser.close()
+    return parser.attrs or []
+
+def img_tag(attrs):
+    return '<img %s>' % ' '.join('%s="%s"' % (name, escape(value)) for name, value in attrs)
+
+def read_source(src):
+    '''
+    The bytes of the image at src, from the static directories for static
+    urls and over http otherwise. None when it can't be read.
+    '''
+    url = urlparse(src)
+    if src.startswith(settings.STATIC_URL) and not url.netloc:
+        path = finders.find(unquote(url.path[len(settings.STATIC_URL):]))
+        if path is None:
+            return None
+        if os.path.getsize(path) > MAX_SOURCE_BYTES:
+            return None
+        with open(path, 'rb') as source:
+            return source.read()
+    if url.scheme not in ('http', 'https', '') or not url.netloc:
+        return None
+    if not url.scheme:
+        src = 'https:' + src
+    try:
+        with urlopen(Request(src, headers={'User-Agent': 'blogengine'}), timeout=FETCH_TIMEOUT) as response:
+            data = response.read(MAX_SOURCE_BYTES + 1)
+    except (URLError, OSError, ValueError) as error:
+        logger.warning('Fetching the image %s failed: %s', src, error)
+        return None
+    return data if len(data) <= MAX_SOURCE_BYTES else None
+
+def write_atomic(path, data):
+    # publish imports the models, whose markdown is rendered through here
+    from blogengine import publish
+    publish.write_atomic(path, data)
+
+def save_variant(image, format, path):
+    output = BytesIO()
+    if format == 'WEBP':
+        image.save(output, format, quality=image_quality(), method=6)
+    elif format == 'JPEG':
+        image.save(output, format, quality=image_quality(), optimize=True, progressive=True)
+    else:
+        image.save(output, format, optimize=True)
+    write_atomic(path, output.getvalue())
+
+def build_variants(data, widths):
+    '''
+    Resize the image data to each of widths, without enlarging it, and write
+    the sizes out as WebP, where Pillow supports it, and as JPEG, or PNG for
+    images with transparency, into images_root. Variants are named after the
+    digest of data, so their urls change with the image. Returns the
+    dimensions of the image and the variants of each content type, None when
+    data isn't an image Pillow resizes.
+    '''
+    try:
+        image = Image.open(BytesIO(data))
+        if getattr(image, 'is_animated', False):
+            return None
+        transparent = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+        image = ImageOps.exif_transpose(image).convert('RGBA' if transparent else 'RGB')
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+    formats = (['WEBP'] if webp_supported() else []) + ['PNG' if transparent else 'JPEG']
+
+    width, height = image.size
+    digest = hashlib.sha1(data).hexdigest()[:20]
+    variants = dict((FORMATS[format][0], []) for format in formats)
+    for size in sorted(set(min(size, width) for size in widths)):
+        resized = image if size == width else image.resize(
+            (size, max(1, round(height * size / width))), Image.LANCZOS)
+        for format in formats:
+            content_type, extension = FORMATS[format]
+            name = '%s-%d.%s' % (digest, size, extension)
+            path = os.path.join(images_root(), name)
+            if not os.path.exists(path):
+                save_variant(resized, format, path)
+            variants[content_type].append((size, name))
+    return {'width': width, 'height': height, 'fallback': FORMATS[formats[-1]][0], 'variants': variants}
+
+def info_path(src, widths):
+    key = '%s\0%s' % (src, ','.join(str(width) for width in widths))
+    return os.path.join(images_root(), 'sources', '%s.json' % hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+# The variants of each (src, widths) read by this process, and the images
+# it rendered before they were resized, for processimages
+_processed = {}
+_pending = set()
+_lock = threading.Lock()
+
+def image_variants(src, widths=None):
+    '''
+    The variants of the image at src, as returned by build_variants, when
+    process_image built them. Rendering never fetches nor resizes images,
+    the missing ones are remembered as pending instead. None without
+    images_root.
+    '''
+    if images_root() is None:
+        return None
+    widths = tuple(widths or image_widths())
+    key = (src, widths)
+    with _lock:
+        if key in _processed:
+            return _processed[key]
+
+    try:
+        with open(info_path(src, widths), encoding='utf-8') as stored:
+            info = json.load(stored)
+    except (FileNotFoundError, ValueError):
+        with _lock:
+            _pending.add(key)
+        return None
+
+    with _lock:
+        _processed[key] = info
+        _pending.discard(key)
+    return info
+
+def pending_images():
+    '''(src, widths) of the images rendered by this process that weren't resized yet'''
+    with _lock:
+        return sorted(_pending)
+
+def process_image(src, widths=None):
+    '''
+    Fetch the image at src and build its variants in widths, for the pages
+    rendered from then on. Returns them, None when src can't be read or
+    resized.
+    '''
+    if Image is None or images_root() is None:
+        return None
+    widths = tuple(widths or image_widths())
+    data = read_source(src)
+    info = build_variants(data, widths) if data is not None else None
+    if info is not None:
+        write_atomic(info_path(src, widths), json.dumps(info).encode('utf-8'))
+        with _lock:
+            _processed[(src, widths)] = info
+            _pending.discard((src, widths))
+    return info
+
+def srcset(variants):
+    return ', '.join('%s%s %dw' % (images_url(), name, width) for width, name in variants)
+
+def responsive_img(attrs, sizes=None, widths=None, lazy=True):
+    '''
+    The html of an img tag with attrs, made responsive: it gets a srcset of
+    the variants of its src, inside a picture offering the WebP variants
+    when there are some, and the dimensions of the image so the page
+    doesn't move as it loads, unless it has its own. Images below the fold
+    should be lazy, so they are only fetched as they come near.
+    '''
+    attrs = [(name, value) for name, value in attrs if name not in ('srcset', 'sizes')]
+    names = set(name for name, value in attrs)
+    src, width = dict(attrs).get('src'), dict(attrs).get('width', '')
+    info = image_variants(src, widths) if src else None
+    if lazy and 'loading' not in names:
+        attrs.append(('loading', 'lazy'))
+    if 'decoding' not in names:
+        attrs.append(('decoding', 'async'))
+    if info is None:
+        return img_tag(attrs)
+
+    if not sizes:
+        # An image given a width is shown that wide
+        sizes = '%spx' % width if width.isdigit() else image_sizes()
+    fallback = info['variants'][info['fallback']]
+    attrs = [(name, images_url() + fallback[-1][1] if name == 'src' else value) for name, value in attrs]
+    attrs.extend([('srcset', srcset(fallback)), ('sizes', sizes)])
+    if 'width' not in names and 'height' not in names:
+        attrs.extend([('width', str(info['width'])), ('height', str(info['height']))])
+    sources = ''.join('<source type="%s" srcset="%s" sizes="%s">' % (
+        content_type, escape(srcset(variants)), escape(sizes))
+        for content_type, variants in sorted(info['variants'].items())
+        if content_type != info['fallback'])
+    if not sources:
+        return img_tag(attrs)
+    return '<picture>%s%s</picture>' % (sources, img_tag(attrs))
+
+def responsive_html(html):
+    '''html with each of its img tags made responsive'''
+    if '<img' not in html:
+        return html
+    return IMG_RE.sub(lambda match: responsive_img(tag_attributes(match.group(0))), html)
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from blogengine import assets, critical, export, publish
+from blogengine.models import Post
+
+def newest_post_url():
+    post = Post.objects.order_by('-pub_date').first()
+    return post.get_absolute_url() if post is not None else None
+
+# The pages critical css is built for, with the url of a page of each kind
+PAGES = (
+    ('index', lambda: reverse('blogengine:index')),
+    ('post', newest_post_url),
+    ('archive', lambda: reverse('blogengine:post_archive')),
+)
+
+
+class Command(BaseCommand):
+    help = ('Writes the rules of the stylesheet bundle used above the fold of the index, '
+            'post and archive pages to CRITICAL_CSS_ROOT, to be inlined into them')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bundle', default='css/site.css')
+
+    def handle(self, *args, **options):
+        if critical.critical_root() is None:
+            raise CommandError('CRITICAL_CSS_ROOT is not set')
+        if options['bundle'] not in assets.bundles():
+            raise CommandError('%s is not in STATIC_BUNDLES' % options['bundle'])
+        css = assets.bundle_css(options['bundle'])
+        renderer = export.Renderer()
+
+        for name, page in PAGES:
+            url = page()
+            if url is None:
+                self.stderr.write('No page to build the %s critical css from' % name)
+                continue
+            response, content = renderer.render(url)
+            if response.status_code != 200:
+                raise CommandError('%s answered %d' % (url, response.status_code))
+
+            used = critical.UsedSelectors(critical.fold_elements())
+            used.feed(content.decode('utf-8'))
+            extracted = critical.extract(css, used)
+            publish.write_atomic(critical.critical_path(name), extracted.encode('utf-8'))
+            self.stdout.write('%s: %d of %d bytes from %s' % (name, len(extracted), len(css), url))
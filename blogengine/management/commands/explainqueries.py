@@ -0,0 +1,96 @@
+import datetime
+import re
+
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+from blogengine.models import Category, Post, Tag
+from blogengine.pagination import ORDERING
+
+PAGE_ROWS = 6
+
+def seed(number_of_posts):
+    '''add number_of_posts posts spread over a few categories and tags'''
+    user = User.objects.create(username='explainqueries-seed')
+    site = Site.objects.create(domain='explainqueries.invalid', name='explainqueries')
+    categories = [Category.objects.create(name='Seed category %d' % number, slug='seed-category-%d' % number)
+                  for number in range(10)]
+    tags = [Tag.objects.create(name='Seed tag %d' % number, slug='seed-tag-%d' % number)
+            for number in range(20)]
+    start = timezone.now()
+    Post.objects.bulk_create([
+        Post(title='Seed post %d' % number, slug='seed-post-%d' % number, text='Seed post',
+             pub_date=start - datetime.timedelta(hours=number), author=user, site=site,
+             category=categories[number % len(categories)])
+        for number in range(number_of_posts)], batch_size=500)
+    through = Post.tags.through
+    through.objects.bulk_create([
+        through(post_id=pk, tag_id=tags[pk % len(tags)].pk)
+        for pk in Post.objects.filter(site=site).values_list('pk', flat=True)], batch_size=500)
+
+def view_queries():
+    '''(name, queryset) of the main query of each view'''
+    post = Post.objects.order_by(*ORDERING).first()
+    if post is None:
+        return []
+    return [
+        ('index', Post.objects.order_by(*ORDERING)[:PAGE_ROWS]),
+        ('index, later page', Post.objects.filter(pub_date__lte=post.pub_date)
+         .order_by(*ORDERING)[:PAGE_ROWS]),
+        ('post', Post.objects.filter(slug=post.slug)),
+        ('category', Post.objects.filter(category_id=post.category_id)
+         .order_by(*ORDERING)[:PAGE_ROWS]),
+        ('tag', Post.objects.filter(tags=Tag.objects.order_by('pk').first())
+         .order_by(*ORDERING)[:PAGE_ROWS]),
+        ('site', Post.objects.filter(site_id=post.site_id).order_by(*ORDERING)[:PAGE_ROWS]),
+    ]
+
+def explain(queryset):
+    '''lines of the query plan of queryset'''
+    sql, params = queryset.query.sql_with_params()
+    prefix = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+    with connection.cursor() as cursor:
+        cursor.execute(prefix + sql, params)
+        return [' '.join(str(column) for column in row) for row in cursor.fetchall()]
+
+def is_sequential_scan(line):
+    '''whether a plan line reads a whole table, on SQLite or PostgreSQL'''
+    if 'Seq Scan' in line:
+        return True
+    return re.search(r'\bSCAN (TABLE )?\w+', line) is not None and 'USING' not in line
+
+class Command(BaseCommand):
+    help = 'Prints the query plan of the main query of each view and flags sequential scans'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Add this many posts for the duration of the command, '
+                                 'so the planner sees realistic table sizes')
+
+    def handle(self, *args, **options):
+        scans = 0
+        with transaction.atomic():
+            if options['seed']:
+                seed(options['seed'])
+                if connection.vendor != 'sqlite':
+                    with connection.cursor() as cursor:
+                        cursor.execute('ANALYZE')
+
+            for name, queryset in view_queries():
+                self.stdout.write(self.style.MIGRATE_HEADING(name))
+                for line in explain(queryset):
+                    if is_sequential_scan(line):
+                        scans += 1
+                        self.stdout.write(self.style.WARNING('  %s  <- sequential scan' % line))
+                    else:
+                        self.stdout.write('  %s' % line)
+
+            # Leave the database as it was
+            transaction.set_rollback(True)
+
+        if scans:
+            self.stdout.write(self.style.WARNING('%d sequential scans' % scans))
+        else:
+            self.stdout.write(self.style.SUCCESS('No sequential scans'))
@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+from blogengine import export
+
+
+class Command(BaseCommand):
+    help = ('Renders every public page and feed of the blog to a directory, '
+            'only rewriting the pages that changed since the last export')
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', nargs='?',
+                            help='Directory to export to, EXPORT_ROOT by default')
+        parser.add_argument('--processes', type=int, default=None,
+                            help='Number of rendering processes, one per CPU by default')
+        parser.add_argument('--full', action='store_true',
+                            help='Render and write every page, ignoring the manifest')
+
+    def handle(self, *args, **options):
+        directory = options['directory'] or export.export_root()
+        if directory is None:
+            raise CommandError('Give a directory, or set EXPORT_ROOT')
+        if options['processes'] is not None and options['processes'] < 1:
+            raise CommandError('--processes must be at least 1')
+        stats = export.export_site(directory, options['processes'], options['full'])
+        for url, status in stats['failed']:
+            self.stderr.write('%s answered %d' % (url, status))
+        self.stdout.write(self.style.SUCCESS(
+            'Wrote %(written)d pages, %(unchanged)d unchanged, removed %(removed)d' % stats))
+        if stats['failed']:
+            raise CommandError('%d pages failed to render' % len(stats['failed']))
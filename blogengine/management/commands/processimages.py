@@ -0,0 +1,47 @@
+from django.contrib.flatpages.models import FlatPage
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from blogengine import caching, images, markup
+from blogengine.export import Renderer
+from blogengine.models import Post
+
+
+class Command(BaseCommand):
+    help = ('Resizes the images of the posts, flatpages and templates that were not yet, '
+            'which pages show unresized until then, and saves the posts using them')
+
+    def handle(self, *args, **options):
+        if images.Image is None:
+            raise CommandError('Pillow is not installed')
+        if images.images_root() is None:
+            raise CommandError('RESPONSIVE_IMAGES_ROOT is not set')
+
+        # Rendering the posts, the flatpages and a page of the site collects
+        # the images without variants, those of the templates included
+        for post in Post.objects.all().iterator():
+            markup.render_markdown(post.text)
+        for content in FlatPage.objects.values_list('content', flat=True).iterator():
+            markup.render_markdown(content)
+        Renderer().render(reverse('blogengine:index'))
+
+        processed = 0
+        for src, widths in images.pending_images():
+            if images.process_image(src, widths) is not None:
+                processed += 1
+            else:
+                self.stderr.write('Could not resize %s' % src)
+        if processed:
+            # Markdown rendered before, as the flatpages are, is rendered again
+            caching.bump(caching.IMAGES)
+
+        updated = 0
+        for post in Post.objects.all().iterator():
+            # Rendered again rather than through the cache, which may hold
+            # the html from before the images were resized
+            rendered = markup.render_markdown(post.text)
+            if rendered != post.html:
+                post.rendered_text = rendered
+                post.plain_text = markup.plain_text(rendered)
+                post.save()
+                updated += 1
+        self.stdout.write(self.style.SUCCESS('Resized %d images, updated %d posts' % (processed, updated)))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand, CommandError
+from blogengine import publish
+
+
+class Command(BaseCommand):
+    help = 'Writes the RSS, Atom and JSON posts feeds to PUBLISHED_FEEDS_ROOT'
+
+    def handle(self, *args, **options):
+        if publish.feeds_root() is None:
+            raise CommandError('PUBLISHED_FEEDS_ROOT is not set')
+        publish.publish_feeds()
+        self.stdout.write(self.style.SUCCESS('Published the feeds to %s' % publish.feeds_root()))
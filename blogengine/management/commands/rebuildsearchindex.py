@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from blogengine import search_backends
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the inverted index and the index of the search backend from all posts'
+
+    def handle(self, *args, **options):
+        indexed = search_backends.rebuild_indexes()
+        self.stdout.write(self.style.SUCCESS('Indexed %d posts' % indexed))
@@ -0,0 +1,124 @@
+import hashlib
+import html
+import threading
+from collections import OrderedDict
+
+import markdown2
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.encoding import force_bytes, force_str
+from django.utils.html import strip_tags
+from blogengine import caching, images
+
+# Bump this whenever the HTML produced by render_markdown changes, so that
+# HTML stored on posts is re-rendered the next time it is read.
+RENDERER_VERSION = 2
+
+MARKDOWN_EXTRAS = ["fenced-code-blocks"]
+
+def content_hash(text):
+    '''sha1 hex digest of a markdown source text'''
+    return hashlib.sha1(force_bytes(text)).hexdigest()
+
+def render_markdown(text, extras=None):
+    '''convert markdown source text to html, with responsive images'''
+    if extras is None:
+        extras = MARKDOWN_EXTRAS
+
+    return images.responsive_html(markdown2.markdown(force_str(text), extras=list(extras)))
+
+def plain_text(rendered):
+    '''the text of rendered html, without markup and on one line'''
+    return ' '.join(html.unescape(strip_tags(rendered)).split())
+
+class RenderCache(object):
+    '''
+    Content addressed cache of rendered markdown.
+
+    Entries are keyed by the sha1 of the source text, the extras, the
+    renderer version and the version of the resized images, so texts are
+    rendered again once processimages resized their images. Lookups go to a bounded in-process LRU first and then
+    to an optional shared django cache, so a text is rendered once per
+    worker at most and usually once for the whole site.
+    '''
+    key_prefix = 'markdown'
+
+    def __init__(self, max_entries=256, cache_alias=None, timeout=None):
+        self.max_entries = max_entries
+        self.cache_alias = cache_alias
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'hits': self.hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def make_key(self, text, extras):
+        digest = hashlib.sha1()
+        digest.update(force_bytes(text))
+        digest.update(b'\0')
+        digest.update(force_bytes(','.join(extras)))
+        images_version = caching.get_versions([caching.IMAGES])[caching.IMAGES]
+        return '%s:%s:%s:%s' % (self.key_prefix, RENDERER_VERSION, images_version, digest.hexdigest())
+
+    def render(self, text, extras=None):
+        '''return the html for text, rendering it only on a miss'''
+        if extras is None:
+            extras = MARKDOWN_EXTRAS
+        key = self.make_key(text, extras)
+
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return html
+
+        shared = caches[self.cache_alias] if self.cache_alias else None
+        html = shared.get(key) if shared is not None else None
+        if html is not None:
+            self.shared_hits += 1
+        else:
+            self.misses += 1
+            html = render_markdown(text, extras)
+            if shared is not None:
+                shared.set(key, html, self.timeout)
+
+        self._store(key, html)
+        return html
+
+    def _store(self, key, html):
+        with self._lock:
+            self._entries[key] = html
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+render_cache = RenderCache(
+    max_entries=getattr(settings, 'MARKDOWN_CACHE_ENTRIES', 256),
+    cache_alias=getattr(settings, 'MARKDOWN_CACHE_ALIAS', 'default'),
+    timeout=getattr(settings, 'MARKDOWN_CACHE_TIMEOUT', 24 * 60 * 60),
+)
+
+def cached_markdown(text, extras=None):
+    '''convert markdown source text to html through the shared render cache'''
+    return render_cache.render(text, extras)
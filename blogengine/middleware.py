@@ -0,0 +1,250 @@
+import gzip
+import hashlib
+import random
+import time
+
+from django.conf import settings
+from django.middleware import cache as cache_middleware
+from django.utils.cache import (
+    get_cache_key, get_max_age, has_vary_header, learn_cache_key,
+    patch_response_headers, patch_vary_headers,
+)
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.encoding import force_bytes
+from django.utils.text import compress_sequence
+from blogengine import caching, publish
+
+# Levels cheap enough to compress pages as they are served
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# Content types worth compressing
+COMPRESSED_TYPES = (
+    'text/', 'application/xml', 'application/rss+xml', 'application/atom+xml',
+    'application/json', 'application/feed+json', 'application/javascript', 'image/svg+xml',
+)
+
+def page_cache_settings():
+    return {
+        'grace': getattr(settings, 'PAGE_CACHE_GRACE_SECONDS', 60),
+        'jitter': getattr(settings, 'PAGE_CACHE_JITTER', 0.1),
+        'lock_timeout': getattr(settings, 'PAGE_CACHE_LOCK_SECONDS', 10),
+        'lock_wait': getattr(settings, 'PAGE_CACHE_LOCK_WAIT', 0.5),
+    }
+
+def compression_min_size():
+    return getattr(settings, 'COMPRESSION_MIN_SIZE', 256)
+
+def content_digest(content):
+    return hashlib.md5(content).hexdigest()
+
+def compressible(response):
+    '''whether response is worth compressing, and not already compressed'''
+    if response.has_header('Content-Encoding'):
+        return False
+    if not response.get('Content-Type', '').startswith(COMPRESSED_TYPES):
+        return False
+    return response.streaming or len(response.content) >= compression_min_size()
+
+def encode(content, encoding):
+    if encoding == 'br':
+        return publish.brotli.compress(content, quality=BROTLI_QUALITY)
+    return gzip.compress(content, GZIP_LEVEL)
+
+def encoded_variants(content):
+    '''
+    The content compressed in each encoding available, with the digest of
+    content, leaving out the encodings that don't make it smaller.
+    '''
+    variants = {'digest': content_digest(content)}
+    for encoding, extension in publish.ENCODINGS:
+        if encoding == 'br' and publish.brotli is None:
+            continue
+        compressed = encode(content, encoding)
+        if len(compressed) < len(content):
+            variants[encoding] = compressed
+    return variants
+
+def lock_key(request):
+    '''key of the lock held by the worker rebuilding the page for request'''
+    url = hashlib.md5(force_bytes(request.build_absolute_uri()))
+    return 'blogengine:page-lock:%s' % url.hexdigest()
+
+class UpdateCacheMiddleware(cache_middleware.UpdateCacheMiddleware):
+    '''
+    Response-phase page cache middleware that stores each page together with
+    the versions of the posts, categories and tags it was built from.
+
+    Pages are kept for a grace period after they go stale so they can still
+    be served while one worker rebuilds them, and the timeouts are jittered
+    so that pages cached together don't all expire together.
+    '''
+    def __init__(self, get_response=None):
+        super(UpdateCacheMiddleware, self).__init__(get_response)
+        # Keep the pages in the same cache as the dependency versions
+        self.cache = caching.get_cache()
+        self.__dict__.update(page_cache_settings())
+
+    def process_response(self, request, response):
+        response = self.update_cache(request, response)
+        if getattr(request, '_cache_lock', None):
+            self.cache.delete(request._cache_lock)
+        return response
+
+    def update_cache(self, request, response):
+        if not self._should_update_cache(request, response):
+            return response
+
+        if response.streaming or response.status_code not in (200, 304):
+            return response
+
+        # Don't cache responses that set a user-specific cookie in response
+        # to a cookie-less request.
+        if not request.COOKIES and response.cookies and has_vary_header(response, 'Cookie'):
+            return response
+
+        timeout = get_max_age(response)
+        if timeout is None:
+            timeout = self.cache_timeout
+        elif timeout == 0:
+            return response
+        patch_response_headers(response, timeout)
+        if timeout and response.status_code == 200:
+            fresh_for = timeout * (1 - random.uniform(0, self.jitter))
+            stored_for = int(fresh_for + self.grace)
+            cache_key = learn_cache_key(request, response, stored_for, self.key_prefix, cache=self.cache)
+            versions = caching.get_dependencies(request)
+
+            def store(response):
+                entry = {
+                    'response': response,
+                    'versions': versions,
+                    'expires': time.time() + fresh_for,
+                }
+                if compressible(response):
+                    entry['encoded'] = encoded_variants(response.content)
+                self.cache.set(cache_key, entry, stored_for)
+                if 'encoded' in entry:
+                    # Also spares compressing the page being sent
+                    response._encoded = entry['encoded']
+
+            if hasattr(response, 'render') and callable(response.render):
+                response.add_post_render_callback(store)
+            else:
+                store(response)
+        return response
+
+class FetchFromCacheMiddleware(cache_middleware.FetchFromCacheMiddleware):
+    '''
+    Request-phase page cache middleware that only serves a cached page while
+    it is fresh and none of its dependencies has been invalidated.
+
+    When a page is stale or missing only the worker that takes the page's
+    lock rebuilds it. The others keep serving the stale copy, or wait for
+    the rebuilt page for a short while when there is no copy at all.
+    '''
+    def __init__(self, get_response=None):
+        super(FetchFromCacheMiddleware, self).__init__(get_response)
+        self.cache = caching.get_cache()
+        self.__dict__.update(page_cache_settings())
+
+    def get_entry(self, request, get=None):
+        get = get or self.cache.get
+        entry = None
+        cache_key = get_cache_key(request, self.key_prefix, 'GET', cache=self.cache)
+        if cache_key is not None:
+            entry = get(cache_key)
+        if entry is None and request.method == 'HEAD':
+            cache_key = get_cache_key(request, self.key_prefix, 'HEAD', cache=self.cache)
+            if cache_key is not None:
+                entry = get(cache_key)
+        if not isinstance(entry, dict) or 'expires' not in entry:
+            return None
+        if 'encoded' in entry:
+            entry['response']._encoded = entry['encoded']
+        return entry
+
+    def is_fresh(self, entry):
+        return entry['expires'] > time.time() and caching.versions_are_current(entry['versions'])
+
+    def process_request(self, request):
+        # The static export renders its own variant of listings
+        if request.method not in ('GET', 'HEAD') or getattr(request, 'static_export', False):
+            request._cache_update_cache = False
+            return None
+
+        entry = self.get_entry(request)
+        if entry is not None and not self.is_fresh(entry) and hasattr(self.cache, 'get_remote'):
+            # The local tier may still hold the copy from before another
+            # worker rebuilt the page, which would take the lock again
+            entry = self.get_entry(request, self.cache.get_remote)
+        if entry is not None and self.is_fresh(entry):
+            request._cache_update_cache = False
+            return entry['response']
+
+        key = lock_key(request)
+        if self.cache.add(key, 1, self.lock_timeout):
+            # This worker rebuilds the page, UpdateCacheMiddleware unlocks it
+            request._cache_lock = key
+            request._cache_update_cache = True
+            return None
+
+        if entry is None:
+            # Nothing to fall back on, give the rebuilding worker a chance
+            deadline = time.time() + self.lock_wait
+            while entry is None and time.time() < deadline:
+                time.sleep(0.05)
+                entry = self.get_entry(request)
+
+        if entry is None:
+            request._cache_update_cache = True
+            return None
+
+        # Serve the stale page while another worker rebuilds it
+        request._cache_update_cache = False
+        return entry['response']
+
+class CompressionMiddleware(MiddlewareMixin):
+    '''
+    Compresses responses with brotli, when installed, or gzip, whichever the
+    client accepts first, once they are at least COMPRESSION_MIN_SIZE bytes.
+    Pages from the page cache come with their bodies compressed when they
+    were stored, which are sent as they are. Streamed responses are gzipped
+    as they stream.
+    '''
+    def process_response(self, request, response):
+        if not compressible(response):
+            return response
+        patch_vary_headers(response, ('Accept-Encoding',))
+        accepted = publish.accepted_encodings(request)
+
+        if response.streaming:
+            if 'gzip' not in accepted:
+                return response
+            encoding = 'gzip'
+            response.streaming_content = compress_sequence(response.streaming_content)
+            del response['Content-Length']
+        else:
+            encodings = [encoding for encoding, extension in publish.ENCODINGS if encoding in accepted
+                         and (encoding != 'br' or publish.brotli is not None)]
+            if not encodings:
+                return response
+            encoding = encodings[0]
+            content = response.content
+            variants = getattr(response, '_encoded', None)
+            if variants is not None and variants['digest'] == content_digest(content):
+                # Stored by the page cache, only missing when it didn't help
+                compressed = variants.get(encoding)
+            else:
+                compressed = encode(content, encoding)
+            if compressed is None or len(compressed) >= len(content):
+                return response
+            response.content = compressed
+            response['Content-Length'] = str(len(compressed))
+
+        # The compressed body is another representation, its ETag only weakly matches
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        response['Content-Encoding'] = encoding
+        return response
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 18:41
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blogengine', '0014_auto_20261018_1215'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['-pub_date', '-id'], name='blogengine_post_recent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['category', '-pub_date', '-id'], name='blogengine_post_cat_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['site', '-pub_date', '-id'], name='blogengine_post_site_idx'),
+        ),
+        # Tag listings walk the auto-created through table from the tag side
+        migrations.RunSQL(
+            'CREATE INDEX blogengine_post_tags_tag_idx ON blogengine_post_tags (tag_id, post_id)',
+            'DROP INDEX blogengine_post_tags_tag_idx',
+        ),
+    ]
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 18:43
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+from collections import Counter
+
+
+def index_posts(apps, schema_editor):
+    from blogengine.search import tokenize
+    Post = apps.get_model('blogengine', 'Post')
+    SearchDocument = apps.get_model('blogengine', 'SearchDocument')
+    Posting = apps.get_model('blogengine', 'Posting')
+    for post in Post.objects.only('title', 'text').iterator():
+        title_terms = Counter(tokenize(post.title))
+        text_terms = Counter(tokenize(post.text))
+        SearchDocument.objects.create(post_id=post.pk,
+                                      title_length=sum(title_terms.values()),
+                                      text_length=sum(text_terms.values()))
+        Posting.objects.bulk_create([
+            Posting(term=term, document_id=post.pk,
+                    title_frequency=title_terms[term], text_frequency=text_terms[term])
+            for term in set(title_terms) | set(text_terms)])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blogengine', '0015_post_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Posting',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=64)),
+                ('title_frequency', models.PositiveIntegerField(default=0)),
+                ('text_frequency', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SearchDocument',
+            fields=[
+                ('post', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='search_document', serialize=False, to='blogengine.Post')),
+                ('title_length', models.PositiveIntegerField(default=0)),
+                ('text_length', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='posting',
+            name='document',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='postings', to='blogengine.SearchDocument'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='posting',
+            unique_together=set([('term', 'document')]),
+        ),
+        migrations.RunPython(index_posts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def install(apps, schema_editor):
+    from blogengine.search_backends import install_native_search
+    install_native_search(schema_editor)
+
+
+def uninstall(apps, schema_editor):
+    from blogengine.search_backends import uninstall_native_search
+    uninstall_native_search(schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blogengine', '0016_search_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(install, uninstall),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 18:48
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def fill_plain_text(apps, schema_editor):
+    from blogengine import markup
+    Post = apps.get_model('blogengine', 'Post')
+    for post in Post.objects.only('text', 'rendered_text').iterator():
+        rendered = post.rendered_text or markup.render_markdown(post.text)
+        Post.objects.filter(pk=post.pk).update(plain_text=markup.plain_text(rendered))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blogengine', '0017_native_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='plain_text',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.RunPython(fill_plain_text, migrations.RunPython.noop),
+    ]
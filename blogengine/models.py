@@ -2,14 +2,17 @@ from django.db import models
 from django.contrib.auth.models import User
 from django.contrib.sites.models import Site
 from django.utils.text import slugify
-from django.db.models.signals import post_save
-from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.utils import timezone
+from django.utils.safestring import mark_safe
+from blogengine import caching, markup
 
 # Create your models here.
 class Tag(models.Model):
     name = models.CharField(max_length=200)
     description = models.TextField()
     slug = models.SlugField(max_length=40, unique=True, blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def save(self, *args, **kwargs):
         if not self.slug:
@@ -26,6 +29,7 @@ class Category(models.Model):
     name = models.CharField(max_length=200)
     description = models.TextField()
     slug = models.SlugField(max_length=40, unique=True, blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def save(self, *args, **kwargs):
         if not self.slug:
@@ -41,6 +45,31 @@ class Category(models.Model):
     class Meta:
         verbose_name_plural = 'categories'
 
+class PostQuerySet(models.QuerySet):
+    def for_listing(self):
+        '''posts with what the listing templates show about them'''
+        return self.select_related('category').prefetch_related('tags')
+
+    def render_stale(self):
+        '''
+        Render and store the html of the posts whose text changed behind the
+        model's back or was rendered by an older renderer, so that reading
+        them never writes. Returns the number of posts rendered.
+        '''
+        rendered = []
+        for post in self.only('text', 'text_hash', 'renderer_version').iterator():
+            if post.rendered_text_is_stale():
+                post.render_text()
+                self.model.objects.filter(pk=post.pk).update(
+                    rendered_text=post.rendered_text,
+                    plain_text=post.plain_text,
+                    text_hash=post.text_hash,
+                    renderer_version=post.renderer_version)
+                rendered.append(post.pk)
+        if rendered:
+            caching.bump(caching.POSTS, *[caching.post_dependency(pk) for pk in rendered])
+        return len(rendered)
+
 class Post(models.Model):
     title = models.CharField(max_length=200)
     pub_date = models.DateTimeField()
@@ -50,6 +79,54 @@ class Post(models.Model):
     site = models.ForeignKey(Site)
     category = models.ForeignKey(Category, blank=True, null=True)
     tags = models.ManyToManyField(Tag, blank=True, null=True)
+    rendered_text = models.TextField(blank=True, editable=False)
+    plain_text = models.TextField(blank=True, editable=False)
+    text_hash = models.CharField(max_length=40, blank=True, editable=False)
+    renderer_version = models.PositiveSmallIntegerField(default=0, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    objects = PostQuerySet.as_manager()
+
+    # Remembered as loaded, to tell what a save changes
+    tracked_fields = ('category_id', 'title', 'slug', 'pub_date')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Post, cls).from_db(db, field_names, values)
+        values = dict(zip(field_names, values))
+        instance._loaded_values = dict((name, values.get(name)) for name in cls.tracked_fields)
+        return instance
+
+    def tracked_values(self):
+        return dict((name, getattr(self, name)) for name in self.tracked_fields)
+
+    def loaded_value(self, name):
+        return getattr(self, '_loaded_values', {}).get(name)
+
+    def save(self, *args, **kwargs):
+        if self.rendered_text_is_stale():
+            self.render_text()
+        super(Post, self).save(*args, **kwargs)
+
+    def rendered_text_is_stale(self):
+        return (self.renderer_version != markup.RENDERER_VERSION or
+                self.text_hash != markup.content_hash(self.text))
+
+    def render_text(self):
+        self.rendered_text = markup.cached_markdown(self.text)
+        self.plain_text = markup.plain_text(self.rendered_text)
+        self.text_hash = markup.content_hash(self.text)
+        self.renderer_version = markup.RENDERER_VERSION
+
+    @property
+    def html(self):
+        '''
+        the stored html of the post text, rendered again without storing it
+        when out of date until render_stale runs after the next migrate
+        '''
+        if self.rendered_text_is_stale():
+            self.render_text()
+        return mark_safe(self.rendered_text)
 
     def get_absolute_url(self):
         return "/%s/%s/%s/" % (self.pub_date.year, self.pub_date.month, self.slug)
@@ -59,10 +136,98 @@ class Post(models.Model):
 
     class Meta:
         ordering = ["-pub_date"]
+        # Listings are read newest first by (pub_date, id), see pagination
+        indexes = [
+            models.Index(fields=['-pub_date', '-id'], name='blogengine_post_recent_idx'),
+            models.Index(fields=['category', '-pub_date', '-id'], name='blogengine_post_cat_idx'),
+            models.Index(fields=['site', '-pub_date', '-id'], name='blogengine_post_site_idx'),
+        ]
+
+class SearchDocument(models.Model):
+    '''lengths of a post in indexed terms, for ranking search results'''
+    post = models.OneToOneField(Post, primary_key=True, related_name='search_document')
+    title_length = models.PositiveIntegerField(default=0)
+    text_length = models.PositiveIntegerField(default=0)
+
+class Posting(models.Model):
+    '''the occurrences of a term in a post, one row of the inverted index'''
+    term = models.CharField(max_length=64)
+    document = models.ForeignKey(SearchDocument, related_name='postings')
+    title_frequency = models.PositiveIntegerField(default=0)
+    text_frequency = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('term', 'document')
 
 # Define signals
+def post_dependencies(post):
+    dependencies = [caching.POSTS, caching.post_dependency(post.pk)]
+    for category_id in set([post.category_id, post.loaded_value('category_id')]):
+        if category_id is not None:
+            dependencies.append(caching.category_dependency(category_id))
+    return dependencies
+
+def touch(model, pks):
+    '''mark rows as modified, for pages whose membership changed'''
+    pks = [pk for pk in pks if pk is not None]
+    if pks:
+        model.objects.filter(pk__in=pks).update(updated_at=timezone.now())
+
 def new_post(sender, instance, created, **kwargs):
-    cache.clear()
+    tag_ids = instance.tags.values_list('pk', flat=True)
+    caching.invalidate(*post_dependencies(instance) +
+                       [caching.tag_dependency(pk) for pk in tag_ids])
+    if getattr(instance, '_loaded_values', None) != instance.tracked_values():
+        # The post moved, or what the categories page shows of it changed
+        caching.invalidate(caching.CATEGORY_OVERVIEW)
+    if instance.loaded_value('category_id') != instance.category_id:
+        touch(Category, [instance.loaded_value('category_id')])
+    instance._loaded_values = instance.tracked_values()
+
+def delete_post(sender, instance, **kwargs):
+    # The tags are unlinked before post_delete, so collect them beforehand
+    tag_ids = list(instance.tags.values_list('pk', flat=True))
+    caching.invalidate(*post_dependencies(instance) +
+                       [caching.tag_dependency(pk) for pk in tag_ids])
+    touch(Category, [instance.category_id])
+    touch(Tag, tag_ids)
+    caching.invalidate(caching.CATEGORY_OVERVIEW)
+
+def change_category(sender, instance, **kwargs):
+    caching.invalidate(caching.CATEGORIES, caching.CATEGORY_OVERVIEW,
+                       caching.category_dependency(instance.pk))
+
+def change_tag(sender, instance, **kwargs):
+    caching.invalidate(caching.TAGS, caching.tag_dependency(instance.pk))
+
+def change_post_tags(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+
+    if reverse:
+        tag_ids = [instance.pk]
+        post_ids = pk_set
+        if action == 'pre_clear':
+            post_ids = instance.post_set.values_list('pk', flat=True)
+    else:
+        post_ids = [instance.pk]
+        tag_ids = pk_set
+        if action == 'pre_clear':
+            tag_ids = instance.tags.values_list('pk', flat=True)
+    post_ids = list(post_ids)
+    tag_ids = list(tag_ids)
+
+    caching.invalidate(caching.POSTS,
+                       *[caching.post_dependency(pk) for pk in post_ids] +
+                       [caching.tag_dependency(pk) for pk in tag_ids])
+    touch(Post, post_ids)
+    touch(Tag, tag_ids)
 
 # Set up signals
 post_save.connect(new_post, sender=Post)
+pre_delete.connect(delete_post, sender=Post)
+post_save.connect(change_category, sender=Category)
+post_delete.connect(change_category, sender=Category)
+post_save.connect(change_tag, sender=Tag)
+post_delete.connect(change_tag, sender=Tag)
+m2m_changed.connect(change_post_tags, sender=Post.tags.through)
@@ -0,0 +1,198 @@
+import datetime
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.core.paginator import InvalidPage, Paginator
+from django.db.models import Q
+from django.http import Http404
+from django.utils import timezone
+from django.utils.http import urlencode
+from blogengine import caching
+
+# Listings are ordered newest first, with the id breaking ties between posts
+# published at the same time so that every post has one place in the order.
+ORDERING = ('-pub_date', '-pk')
+
+# Number of posts on a page of a listing
+PAGE_SIZE = 5
+
+def numbered_page_links(request):
+    '''whether listings link to numbered pages by path rather than to cursors'''
+    return getattr(request, 'static_export', False) or getattr(settings, 'NUMBERED_PAGE_LINKS', False)
+
+def listing_url(name, number=None, **kwargs):
+    '''url of the index, category or tag listing name, or of its numbered page'''
+    if not number:
+        return reverse('blogengine:%s' % name, kwargs=kwargs)
+    if name == 'index':
+        return '%s%d/' % (reverse('blogengine:index'), number)
+    return reverse('blogengine:%s_page' % name, kwargs=dict(kwargs, page=number))
+
+def encode_cursor(post):
+    '''position of post in a listing, as used in the after and before parameters'''
+    delta = post.pub_date - datetime.datetime(1970, 1, 1, tzinfo=timezone.utc)
+    microseconds = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    return '%d.%d' % (microseconds, post.pk)
+
+def decode_cursor(cursor):
+    '''(pub_date, pk) of a cursor, raising ValueError when it is malformed'''
+    microseconds, pk = cursor.split('.')
+    pub_date = (datetime.datetime(1970, 1, 1, tzinfo=timezone.utc) +
+                datetime.timedelta(microseconds=int(microseconds)))
+    return pub_date, int(pk)
+
+class CursorPage(object):
+    '''
+    A page of a listing that knows the cursors of its neighbours rather than
+    its number, so fetching it never counts or skips over rows.
+    '''
+    def __init__(self, object_list, has_next, has_previous):
+        self.object_list = object_list
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self._has_next and bool(self.object_list)
+
+    def has_previous(self):
+        return self._has_previous and bool(self.object_list)
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+def cursor_page(queryset, per_page, after=None, before=None):
+    '''
+    The per_page posts of queryset that follow the cursor after, or precede
+    the cursor before, or the first page when neither is given. Reads one
+    extra row to tell whether there is a page beyond.
+    '''
+    try:
+        if before:
+            pub_date, pk = decode_cursor(before)
+            rows = list(queryset.filter(Q(pub_date__gt=pub_date) | Q(pub_date=pub_date, pk__gt=pk))
+                        .order_by('pub_date', 'pk')[:per_page + 1])
+            return CursorPage(rows[:per_page][::-1], True, len(rows) > per_page)
+        if after:
+            pub_date, pk = decode_cursor(after)
+            queryset = queryset.filter(Q(pub_date__lt=pub_date) | Q(pub_date=pub_date, pk__lt=pk))
+    except (ValueError, OverflowError):
+        raise Http404('Invalid cursor')
+    rows = list(queryset.order_by(*ORDERING)[:per_page + 1])
+    return CursorPage(rows[:per_page], len(rows) > per_page, bool(after))
+
+class CachedCountPaginator(Paginator):
+    '''
+    Paginator for the numbered pages, which reads the total count from the
+    fragment cache instead of counting on every request.
+    '''
+    def __init__(self, object_list, per_page, count_key, dependencies, **kwargs):
+        super(CachedCountPaginator, self).__init__(object_list, per_page, **kwargs)
+        self.count_key = count_key
+        self.dependencies = dependencies
+
+    @property
+    def count(self):
+        if not hasattr(self, '_cached_count'):
+            self._cached_count = caching.cached('blogengine:count:%s' % self.count_key,
+                                                self.dependencies,
+                                                lambda: self.object_list.count())
+        return self._cached_count
+
+def numbered_page(queryset, per_page, number, count_key, dependencies):
+    '''page number of queryset, the numbered urls kept for compatibility'''
+    paginator = CachedCountPaginator(queryset.order_by(*ORDERING), per_page,
+                                     count_key, dependencies)
+    try:
+        return paginator.page(number)
+    except InvalidPage:
+        raise Http404('Invalid page')
+
+class AnchoredPage(CursorPage):
+    '''
+    A page of a listing as the static export numbers them, from its oldest
+    post, so that publishing a post leaves the pages of the older ones as
+    they are. The number of its newer page is None for the first page of
+    the listing, and either number is False when there is no such page.
+    '''
+    def __init__(self, object_list, newer, older):
+        super(AnchoredPage, self).__init__(object_list, older is not False, newer is not False)
+        self.newer = newer
+        self.older = older
+
+def anchored_pages(count, per_page):
+    '''number of pages of a listing of count posts, numbered from the oldest'''
+    return max(1, (count + per_page - 1) // per_page)
+
+def anchored_page(queryset, per_page, number, count_key, dependencies):
+    '''
+    Page number of queryset, page 1 holding its oldest per_page posts and
+    each page the per_page posts newer than the page before. Without number,
+    the first page of the listing, showing the newest page together with
+    the page before it while the newest isn't full.
+    '''
+    paginator = CachedCountPaginator(queryset.order_by(*ORDERING), per_page, count_key, dependencies)
+    pages = anchored_pages(paginator.count, per_page)
+    if number is None:
+        first = pages - 1 if pages > 1 and paginator.count % per_page else pages
+        last, newer = pages, False
+    else:
+        try:
+            first = last = int(number)
+        except (TypeError, ValueError):
+            raise Http404('Invalid page')
+        if not 1 <= first <= pages or not paginator.count:
+            raise Http404('Invalid page')
+        newer = last + 1 if last < pages else None
+    start = max(0, paginator.count - last * per_page)
+    end = paginator.count - (first - 1) * per_page
+    object_list = list(paginator.object_list[start:end]) if end > start else []
+    return AnchoredPage(object_list, newer, first - 1 or False)
+
+def anchored_links(page, page_url):
+    '''previous and next urls of an anchored page, page_url(number) giving their path'''
+    return {
+        'previous_page_url': page_url(page.newer) if page.newer is not False else None,
+        'next_page_url': page_url(page.older) if page.older is not False else None,
+    }
+
+def number_links(page, url, **params):
+    '''previous and next urls of a numbered page, for lists that have no cursor'''
+    def link(number):
+        query = dict((key, value) for key, value in params.items() if value)
+        query['page'] = number
+        return '%s?%s' % (url, urlencode(sorted(query.items())))
+
+    return {
+        'previous_page_url': link(page.previous_page_number()) if page.has_previous() else None,
+        'next_page_url': link(page.next_page_number()) if page.has_next() else None,
+    }
+
+def path_links(page, page_url):
+    '''previous and next urls of a numbered page, page_url(number) giving their path'''
+    return {
+        'previous_page_url': page_url(page.previous_page_number() if page.number > 2 else None)
+                             if page.has_previous() else None,
+        'next_page_url': page_url(page.next_page_number()) if page.has_next() else None,
+    }
+
+def page_links(page, url):
+    '''
+    Previous and next urls of a page. Numbered pages link to cursors too, so
+    crawlers that come in on a numbered url carry on through cheap pages.
+    '''
+    def link(**cursor):
+        return '%s?%s' % (url, urlencode(sorted(cursor.items())))
+
+    object_list = list(page.object_list)
+    links = {'previous_page_url': None, 'next_page_url': None}
+    if page.has_previous() and object_list:
+        links['previous_page_url'] = link(before=encode_cursor(object_list[0]))
+    if page.has_next() and object_list:
+        links['next_page_url'] = link(after=encode_cursor(object_list[-1]))
+    return links
@@ -0,0 +1,201 @@
+import gzip
+import json
+import logging
+import os
+import tempfile
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.contrib.syndication.views import add_domain
+from django.core.urlresolvers import reverse
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.http import FileResponse, HttpRequest
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+from blogengine.models import Post
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPES = {
+    'rss': 'application/rss+xml; charset=utf-8',
+    'atom': 'application/atom+xml; charset=utf-8',
+    'json': 'application/feed+json; charset=utf-8',
+}
+
+# Content-Encoding of each precompressed variant, by file extension
+ENCODINGS = (('br', 'br'), ('gzip', 'gz'))
+
+def feeds_root():
+    return getattr(settings, 'PUBLISHED_FEEDS_ROOT', None)
+
+def feed_path(format):
+    '''path of the published feed in format, None when publishing is off'''
+    root = feeds_root()
+    if root is None:
+        return None
+    return os.path.join(root, 'posts.%s' % format)
+
+def write_atomic(path, data):
+    '''write data to path through a temporary file, so readers never see half of it'''
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    descriptor, temporary = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+        with os.fdopen(descriptor, 'wb') as output:
+            output.write(data)
+            output.flush()
+            os.fsync(output.fileno())
+        os.chmod(temporary, 0o644)
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+def compress(data, extension):
+    if extension == 'gz':
+        return gzip.compress(data, 9)
+    return brotli.compress(data)
+
+def compressed_variants(data):
+    '''(extension, compressed data) of the gzip and, with brotli installed, br variants'''
+    for encoding, extension in ENCODINGS:
+        if extension == 'br' and brotli is None:
+            continue
+        yield extension, compress(data, extension)
+
+def write_compressed(path, data):
+    '''write data to path, and its gzip and, with brotli installed, br variants'''
+    write_atomic(path, data)
+    for extension, compressed in compressed_variants(data):
+        write_atomic('%s.%s' % (path, extension), compressed)
+
+def site_scheme():
+    return getattr(settings, 'SITE_SCHEME', 'http')
+
+class SiteRequest(HttpRequest):
+    '''a request over the scheme the site is served on, whatever the proxy headers'''
+    def _get_scheme(self):
+        return site_scheme()
+
+def site_request(path='/'):
+    '''a request for path on the current site, for building absolute urls outside of requests'''
+    request = SiteRequest()
+    request.path = request.path_info = path
+    request.META['SERVER_NAME'] = Site.objects.get_current().domain
+    request.META['SERVER_PORT'] = '443' if site_scheme() == 'https' else '80'
+    return request
+
+def json_feed(request):
+    '''the newest posts as a JSON Feed 1.1 document'''
+    from blogengine.views import PostsFeed
+    feed = PostsFeed()
+    domain = Site.objects.get_current().domain
+    items = []
+    for post in feed.items():
+        url = add_domain(domain, post.get_absolute_url(), request.is_secure())
+        items.append({
+            'id': url,
+            'url': url,
+            'title': post.title,
+            'content_html': str(post.html),
+            'date_published': post.pub_date.isoformat(),
+        })
+    document = {
+        'version': 'https://jsonfeed.org/version/1.1',
+        'title': feed.title,
+        'home_page_url': add_domain(domain, feed.link, request.is_secure()),
+        'feed_url': add_domain(domain, request.path, request.is_secure()),
+        'description': feed.description,
+        'items': items,
+    }
+    return json.dumps(document, ensure_ascii=False).encode('utf-8')
+
+def build_feeds():
+    '''the RSS, Atom and JSON documents of the posts feed, by format'''
+    from blogengine.views import AtomPostsFeed, PostsFeed
+    # Each built at its own url, which the feeds link to as their self link
+    rss_request = site_request(reverse('blogengine:feed'))
+    atom_request = site_request(reverse('blogengine:feed_format', kwargs={'format': 'atom'}))
+    json_request = site_request(reverse('blogengine:feed_format', kwargs={'format': 'json'}))
+    return {
+        'rss': PostsFeed().get_feed(None, rss_request).writeString('utf-8').encode('utf-8'),
+        'atom': AtomPostsFeed().get_feed(None, atom_request).writeString('utf-8').encode('utf-8'),
+        'json': json_feed(json_request),
+    }
+
+def publish_feeds():
+    '''write every format of the posts feed to PUBLISHED_FEEDS_ROOT'''
+    if feeds_root() is None:
+        return
+    for format, document in build_feeds().items():
+        write_compressed(feed_path(format), document)
+
+def accepted_encodings(request):
+    '''the encodings of ENCODINGS the client accepts, going by the q values of Accept-Encoding'''
+    qualities = {}
+    for coding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        name, _, params = coding.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name.strip():
+            qualities[name.strip().lower()] = quality
+    return set(encoding for encoding, extension in ENCODINGS
+               if qualities.get(encoding, qualities.get('*', 0)) > 0)
+
+def serve(request, path, content_type):
+    '''
+    Response serving the file at path, or its precompressed variant the
+    client accepts best, with validators from the file. None when there is
+    no such file.
+    '''
+    accepted = accepted_encodings(request)
+    for encoding, extension in ENCODINGS + ((None, None),):
+        if encoding is not None and encoding not in accepted:
+            continue
+        variant = path if extension is None else '%s.%s' % (path, extension)
+        try:
+            stat = os.stat(variant)
+        except OSError:
+            continue
+        etag = '"%x-%x%s"' % (stat.st_mtime_ns, stat.st_size, '-' + extension if extension else '')
+        response = get_conditional_response(request, etag=etag,
+                                            last_modified=int(stat.st_mtime))
+        if response is None:
+            response = FileResponse(open(variant, 'rb'), content_type=content_type)
+            response['Content-Length'] = stat.st_size
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(stat.st_mtime)
+        if encoding is not None:
+            response['Content-Encoding'] = encoding
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+    return None
+
+def publish_after_commit():
+    def publish():
+        try:
+            publish_feeds()
+        except Exception:
+            # The post is saved, the next change publishes the feeds again
+            logger.exception('Publishing the feeds failed')
+    transaction.on_commit(publish)
+
+def post_changed(sender, instance, raw=False, **kwargs):
+    if not raw and feeds_root() is not None:
+        publish_after_commit()
+
+# Set up signals
+post_save.connect(post_changed, sender=Post)
+post_delete.connect(post_changed, sender=Post)
@@ -0,0 +1,62 @@
+import logging
+
+from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils.deprecation import MiddlewareMixin
+
+logger = logging.getLogger(__name__)
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+def query_budget(max_queries):
+    '''declare how many database queries a view may run, rendering included'''
+    def decorator(view_func):
+        view_func.query_budget = max_queries
+        return view_func
+    return decorator
+
+class QueryBudgetMiddleware(MiddlewareMixin):
+    '''
+    Counts the queries of views declared with query_budget, those run while
+    a streamed response is sent included. Going over the budget raises
+    QueryBudgetExceeded when QUERY_BUDGET_STRICT is set, as in the tests,
+    and is logged as a warning otherwise.
+    '''
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        budget = getattr(view_func, 'query_budget', None)
+        if budget is None:
+            return None
+        context = CaptureQueriesContext(connection)
+        context.__enter__()
+        request._query_budget = (budget, context)
+        return None
+
+    def process_response(self, request, response):
+        if getattr(request, '_query_budget', None) is None:
+            return response
+        budget, context = request._query_budget
+        request._query_budget = None
+        context.__exit__(None, None, None)
+        if response.streaming:
+            response.streaming_content = self.stream(request, response.streaming_content,
+                                                     budget, len(context))
+        else:
+            self.check(request, budget, len(context))
+        return response
+
+    def stream(self, request, content, budget, queries):
+        '''content, counting the queries run while it is sent on top of those of the view'''
+        context = CaptureQueriesContext(connection)
+        with context:
+            for chunk in content:
+                yield chunk
+        self.check(request, budget, queries + len(context))
+
+    def check(self, request, budget, queries):
+        if queries > budget:
+            message = '%s ran %d queries, over its budget of %d' % (request.path, queries, budget)
+            if getattr(settings, 'QUERY_BUDGET_STRICT', False):
+                raise QueryBudgetExceeded(message)
+            logger.warning(message, extra={'request': request})
@@ -0,0 +1,176 @@
+import logging
+import queue
+import threading
+
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from blogengine import export, sitemaps
+from blogengine.models import Post, Tag
+from blogengine.pagination import PAGE_SIZE, listing_url
+
+logger = logging.getLogger(__name__)
+
+def listing_posts(name, slug):
+    if name == 'category':
+        return Post.objects.filter(category__slug=slug)
+    if name == 'tag':
+        return Post.objects.filter(tags__slug=slug)
+    return Post.objects.all()
+
+def position(name, slug, post_id, pub_date):
+    '''number of other posts listed after a post published at pub_date, which are older'''
+    return (listing_posts(name, slug).exclude(pk=post_id)
+            .filter(Q(pub_date__lt=pub_date) | Q(pub_date=pub_date, pk__lt=post_id)).count())
+
+def post_state(post_id):
+    '''
+    Where the post is shown, as its row stands in the database: its url,
+    publication date, category and tags, and its position in each listing.
+    None when there is no such post.
+    '''
+    post = Post.objects.filter(pk=post_id).select_related('category').only(
+        'pub_date', 'slug', 'category__slug').first()
+    if post is None:
+        return None
+    listings = [('index', None)]
+    if post.category is not None and post.category.slug:
+        listings.append(('category', post.category.slug))
+    listings.extend(('tag', slug) for slug in
+                    Tag.objects.filter(post=post_id).exclude(slug=None).values_list('slug', flat=True))
+    return {
+        'url': post.get_absolute_url(),
+        'pub_date': post.pub_date,
+        'positions': dict((listing, position(listing[0], listing[1], post_id, post.pub_date))
+                          for listing in listings),
+    }
+
+def affected_urls(post_id, before, after):
+    '''
+    Urls of the pages and files that change when a post goes from the state
+    before to the state after, either being None when the post didn't or
+    doesn't exist.
+    '''
+    urls = set(export.feed_urls())
+    urls.add(reverse('blogengine:sitemap'))
+    urls.add(reverse('blogengine:sitemap_section', kwargs={
+        'section': 'posts', 'shard': (post_id - 1) // sitemaps.urls_per_file()}))
+    urls.add(reverse('blogengine:post_archive'))
+    urls.add(reverse('blogengine:post_category'))
+    for state in (before, after):
+        if state is None:
+            continue
+        urls.add(state['url'])
+        urls.update(export.archive_urls([state['pub_date']]))
+        for name, slug in state['positions']:
+            if name != 'index':
+                urls.add(reverse('blogengine:%s_feed' % name, kwargs={'slug': slug}))
+
+    # The exported pages are numbered from the oldest post, so only the pages
+    # from the post's position to the newest change, and the first page of
+    # the listing, which shows the newest
+    old = before['positions'] if before else {}
+    new = after['positions'] if after else {}
+    for listing in set(old) | set(new):
+        name, slug = listing
+        kwargs = {'slug': slug} if slug else {}
+        if listing in old and listing in new:
+            # The posts between the old and the new position move by one
+            first, last = sorted((old[listing], new[listing]))
+            numbers = range(first // PAGE_SIZE + 1, last // PAGE_SIZE + 2)
+        else:
+            # The newer posts move by one, and a page is added or removed
+            # with the newest post of a full page, changing the links of the
+            # page before
+            first = old[listing] if listing in old else new[listing]
+            others = listing_posts(name, slug).exclude(pk=post_id).count()
+            numbers = list(range(first // PAGE_SIZE + 1, others // PAGE_SIZE + 2))
+            if others and not others % PAGE_SIZE:
+                numbers.append(others // PAGE_SIZE)
+        urls.add(listing_url(name, **kwargs))
+        urls.update(listing_url(name, number, **kwargs) for number in numbers)
+    return urls
+
+class Regenerator(object):
+    '''
+    Exports the pages affected by post changes on a background thread, so
+    that saving a post doesn't wait for them. Batches queued while a batch
+    is being exported are exported together.
+    '''
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def schedule(self, urls):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name='blogengine-regenerate', daemon=True)
+                self.thread.start()
+        self.queue.put(set(urls))
+
+    def run(self):
+        while True:
+            batches = [self.queue.get()]
+            while True:
+                try:
+                    batches.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                directory = export.export_root()
+                if directory is not None:
+                    export.export_urls(directory, set().union(*batches))
+            except Exception:
+                # The next exportsite run writes the pages missed here
+                logger.exception('Regenerating the exported pages failed')
+            finally:
+                connection.close()
+                for batch in batches:
+                    self.queue.task_done()
+
+    def wait(self):
+        '''block until the queued pages are exported'''
+        self.queue.join()
+
+regenerator = Regenerator()
+
+def schedule_after_commit(urls):
+    transaction.on_commit(lambda: regenerator.schedule(urls))
+
+def remember_state(sender, instance, raw=False, **kwargs):
+    if not raw and instance.pk is not None and export.export_root() is not None:
+        instance._export_state = post_state(instance.pk)
+
+def post_changed(sender, instance, raw=False, **kwargs):
+    if raw or export.export_root() is None:
+        return
+    before = getattr(instance, '_export_state', None)
+    after = instance._export_state = post_state(instance.pk)
+    schedule_after_commit(affected_urls(instance.pk, before, after))
+
+def post_tags_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if export.export_root() is None:
+        return
+    if action in ('pre_add', 'pre_remove', 'pre_clear'):
+        if not reverse:
+            post_ids = [instance.pk]
+        elif action == 'pre_clear':
+            post_ids = instance.post_set.values_list('pk', flat=True)
+        else:
+            post_ids = pk_set
+        instance._export_states = dict((pk, post_state(pk)) for pk in post_ids)
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        urls = set()
+        for pk, before in getattr(instance, '_export_states', {}).items():
+            urls |= affected_urls(pk, before, post_state(pk))
+        instance._export_states = {}
+        schedule_after_commit(urls)
+
+# Set up signals
+pre_save.connect(remember_state, sender=Post)
+post_save.connect(post_changed, sender=Post)
+pre_delete.connect(remember_state, sender=Post)
+post_delete.connect(post_changed, sender=Post)
+m2m_changed.connect(post_tags_changed, sender=Post.tags.through)
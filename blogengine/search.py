@@ -0,0 +1,121 @@
+import itertools
+import math
+import re
+from collections import Counter
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Avg, Count
+from blogengine import caching
+from blogengine.models import Post, Posting, SearchDocument
+from blogengine.stemmer import stem
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+STOPWORDS = frozenset('''
+a an and are as at be but by for if in into is it no not of on or such that the
+their then there these they this to was will with
+'''.split())
+
+MAX_TERM_LENGTH = 64
+
+def tokenize(text):
+    '''the stemmed terms of text, in order, without stop words'''
+    return [stem(word)[:MAX_TERM_LENGTH] for word in WORD_RE.findall(text.lower())
+            if word not in STOPWORDS]
+
+def query_terms(query):
+    '''the distinct terms of a search query'''
+    terms = []
+    for term in tokenize(query):
+        if term not in terms:
+            terms.append(term)
+    return terms
+
+def ranking_settings():
+    return {
+        'title_boost': getattr(settings, 'SEARCH_TITLE_BOOST', 3.0),
+        'k1': getattr(settings, 'SEARCH_BM25_K1', 1.2),
+        'b': getattr(settings, 'SEARCH_BM25_B', 0.75),
+    }
+
+def document_rows(post):
+    '''the unsaved SearchDocument and Postings indexing post'''
+    title_terms = Counter(tokenize(post.title))
+    text_terms = Counter(tokenize(post.text))
+    document = SearchDocument(post_id=post.pk,
+                              title_length=sum(title_terms.values()),
+                              text_length=sum(text_terms.values()))
+    postings = [Posting(term=term, document_id=post.pk,
+                        title_frequency=title_terms[term],
+                        text_frequency=text_terms[term])
+                for term in set(title_terms) | set(text_terms)]
+    return document, postings
+
+def index_post(post):
+    '''replace the postings of post with those of its current title and text'''
+    document, postings = document_rows(post)
+    with transaction.atomic():
+        SearchDocument.objects.update_or_create(post_id=post.pk, defaults={
+            'title_length': document.title_length,
+            'text_length': document.text_length,
+        })
+        Posting.objects.filter(document_id=post.pk).delete()
+        Posting.objects.bulk_create(postings)
+
+def rebuild_index(batch_size=500):
+    '''index every post from scratch, returning the number of posts indexed'''
+    indexed = 0
+    with transaction.atomic():
+        Posting.objects.all().delete()
+        SearchDocument.objects.all().delete()
+        posts = Post.objects.order_by().only('title', 'text').iterator()
+        while True:
+            batch = list(itertools.islice(posts, batch_size))
+            if not batch:
+                break
+            rows = [document_rows(post) for post in batch]
+            SearchDocument.objects.bulk_create([document for document, _ in rows])
+            Posting.objects.bulk_create([posting for _, postings in rows for posting in postings])
+            indexed += len(batch)
+    caching.invalidate(caching.POSTS)
+    return indexed
+
+def corpus_stats():
+    '''number of indexed posts and their average title and text lengths'''
+    return caching.cached('blogengine:search-stats', [caching.POSTS],
+                          lambda: SearchDocument.objects.aggregate(
+                              documents=Count('pk'),
+                              title_length=Avg('title_length'),
+                              text_length=Avg('text_length')))
+
+def search(query):
+    '''
+    Ids of the posts matching any term of query, best first, ranked by BM25
+    with the title terms counted title_boost times.
+    '''
+    terms = query_terms(query)
+    if not terms:
+        return []
+    postings = list(Posting.objects.filter(term__in=terms).values_list(
+        'document_id', 'term', 'title_frequency', 'text_frequency',
+        'document__title_length', 'document__text_length'))
+    if not postings:
+        return []
+
+    ranking = ranking_settings()
+    boost, k1, b = ranking['title_boost'], ranking['k1'], ranking['b']
+    frequencies = Counter(term for _, term, _, _, _, _ in postings)
+    stats = corpus_stats()
+    # The stats may lag behind the postings until their cache entry is rebuilt
+    documents = max(stats['documents'], max(frequencies.values()))
+    average_length = max(boost * (stats['title_length'] or 0) + (stats['text_length'] or 0), 1)
+
+    scores = Counter()
+    for post_id, term, title_frequency, text_frequency, title_length, text_length in postings:
+        idf = math.log(1 + (documents - frequencies[term] + 0.5) / (frequencies[term] + 0.5))
+        frequency = boost * title_frequency + text_frequency
+        length = boost * title_length + text_length
+        scores[post_id] += idf * frequency * (k1 + 1) / (
+            frequency + k1 * (1 - b + b * length / average_length))
+    return sorted(scores, key=lambda post_id: (-scores[post_id], -post_id))
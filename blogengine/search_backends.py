@@ -0,0 +1,254 @@
+import hashlib
+import unicodedata
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.db.models.signals import post_save
+from django.db.utils import DatabaseError
+from django.utils.module_loading import import_string
+from django.utils.encoding import force_bytes
+from blogengine import caching, search
+from blogengine.models import Post
+from blogengine.pagination import ORDERING
+
+class BaseSearchBackend(object):
+    '''
+    Finds the posts matching a search query: backends define search(query),
+    returning the ids of the posts matching query, best first. The inverted
+    index of blogengine.search is kept up to date whichever backend is used,
+    so switching to IndexBackend never serves stale results.
+    '''
+    def rebuild(self):
+        '''index every post again, returning the number of posts indexed'''
+        return Post.objects.count()
+
+class ContainsBackend(BaseSearchBackend):
+    '''substring match on the title and text, newest first, needing no index'''
+    def search(self, query):
+        if not query.strip():
+            return []
+        return list(Post.objects.filter(Q(text__icontains=query) | Q(title__icontains=query))
+                    .order_by(*ORDERING).values_list('pk', flat=True))
+
+class IndexBackend(BaseSearchBackend):
+    '''the inverted index of blogengine.search, which works on any database'''
+    def search(self, query):
+        return search.search(query)
+
+    def rebuild(self):
+        return search.rebuild_index()
+
+def query_words(query):
+    '''the words of query, safe to quote into a native full-text query'''
+    return search.WORD_RE.findall(query.lower())
+
+class PostgresBackend(BaseSearchBackend):
+    '''
+    PostgreSQL full-text search on a tsvector column that a trigger keeps up
+    to date, with a GIN index, ranked by ts_rank with the title weighted A.
+    '''
+    install_sql = [
+        'ALTER TABLE blogengine_post ADD COLUMN search_vector tsvector',
+        '''CREATE FUNCTION blogengine_post_search_vector() RETURNS trigger AS $$
+        BEGIN
+            NEW.search_vector :=
+                setweight(to_tsvector('pg_catalog.english', coalesce(NEW.title, '')), 'A') ||
+                setweight(to_tsvector('pg_catalog.english', coalesce(NEW.text, '')), 'D');
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql''',
+        '''CREATE TRIGGER blogengine_post_search_vector
+        BEFORE INSERT OR UPDATE OF title, text ON blogengine_post
+        FOR EACH ROW EXECUTE PROCEDURE blogengine_post_search_vector()''',
+        'UPDATE blogengine_post SET title = title',
+        'CREATE INDEX blogengine_post_search_vector_idx ON blogengine_post USING GIN (search_vector)',
+    ]
+
+    uninstall_sql = [
+        'DROP TRIGGER IF EXISTS blogengine_post_search_vector ON blogengine_post',
+        'DROP FUNCTION IF EXISTS blogengine_post_search_vector()',
+        'ALTER TABLE blogengine_post DROP COLUMN IF EXISTS search_vector',
+    ]
+
+    @staticmethod
+    def is_installed():
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM information_schema.columns "
+                           "WHERE table_name = 'blogengine_post' AND column_name = 'search_vector'")
+            return cursor.fetchone() is not None
+
+    def search(self, query):
+        words = query_words(query)
+        if not words:
+            return []
+        # ts_rank weighs D, C, B and A lexemes, the title being A
+        boost = search.ranking_settings()['title_boost']
+        with connection.cursor() as cursor:
+            cursor.execute('''
+                SELECT id FROM blogengine_post, to_tsquery('pg_catalog.english', %s) query
+                WHERE search_vector @@ query
+                ORDER BY ts_rank(%s::float4[], search_vector, query) DESC, id DESC
+            ''', [' | '.join(words), [1.0 / boost, 0, 0, 1.0]])
+            return [row[0] for row in cursor.fetchall()]
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute('UPDATE blogengine_post SET title = title')
+            return cursor.rowcount
+
+class SqliteBackend(BaseSearchBackend):
+    '''
+    SQLite FTS5 table over the title and text of posts, kept in sync by
+    triggers and ranked by bm25 with the title weighted title_boost.
+    '''
+    install_sql = [
+        '''CREATE VIRTUAL TABLE blogengine_post_fts USING fts5(
+            title, text, content='blogengine_post', content_rowid='id',
+            tokenize='porter unicode61')''',
+        "INSERT INTO blogengine_post_fts(blogengine_post_fts) VALUES ('rebuild')",
+    ]
+
+    # Rebuilding the posts table drops its triggers, as migrations altering
+    # blogengine_post do on SQLite, so they are installed again after every
+    # migration.
+    trigger_sql = [
+        'DROP TRIGGER IF EXISTS blogengine_post_fts_insert',
+        'DROP TRIGGER IF EXISTS blogengine_post_fts_delete',
+        'DROP TRIGGER IF EXISTS blogengine_post_fts_update',
+        '''CREATE TRIGGER blogengine_post_fts_insert AFTER INSERT ON blogengine_post BEGIN
+            INSERT INTO blogengine_post_fts(rowid, title, text) VALUES (new.id, new.title, new.text);
+        END''',
+        '''CREATE TRIGGER blogengine_post_fts_delete AFTER DELETE ON blogengine_post BEGIN
+            INSERT INTO blogengine_post_fts(blogengine_post_fts, rowid, title, text)
+            VALUES ('delete', old.id, old.title, old.text);
+        END''',
+        '''CREATE TRIGGER blogengine_post_fts_update AFTER UPDATE OF title, text ON blogengine_post BEGIN
+            INSERT INTO blogengine_post_fts(blogengine_post_fts, rowid, title, text)
+            VALUES ('delete', old.id, old.title, old.text);
+            INSERT INTO blogengine_post_fts(rowid, title, text) VALUES (new.id, new.title, new.text);
+        END''',
+    ]
+
+    uninstall_sql = [
+        'DROP TRIGGER IF EXISTS blogengine_post_fts_insert',
+        'DROP TRIGGER IF EXISTS blogengine_post_fts_delete',
+        'DROP TRIGGER IF EXISTS blogengine_post_fts_update',
+        'DROP TABLE IF EXISTS blogengine_post_fts',
+    ]
+
+    @staticmethod
+    def is_installed():
+        return 'blogengine_post_fts' in connection.introspection.table_names()
+
+    def search(self, query):
+        words = query_words(query)
+        if not words:
+            return []
+        boost = search.ranking_settings()['title_boost']
+        with connection.cursor() as cursor:
+            cursor.execute('''
+                SELECT rowid FROM blogengine_post_fts WHERE blogengine_post_fts MATCH %s
+                ORDER BY bm25(blogengine_post_fts, %s, 1.0), rowid DESC
+            ''', [' OR '.join('"%s"' % word for word in words), boost])
+            return [row[0] for row in cursor.fetchall()]
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO blogengine_post_fts(blogengine_post_fts) VALUES ('rebuild')")
+        return Post.objects.count()
+
+NATIVE_BACKENDS = {
+    'postgresql': PostgresBackend,
+    'sqlite': SqliteBackend,
+}
+
+def install_native_search(schema_editor):
+    '''set up the native full-text search of the database, if it has one'''
+    backend = NATIVE_BACKENDS.get(schema_editor.connection.vendor)
+    if backend is None:
+        return
+    try:
+        with transaction.atomic(using=schema_editor.connection.alias):
+            with schema_editor.connection.cursor() as cursor:
+                for sql in backend.install_sql:
+                    cursor.execute(sql)
+    except DatabaseError:
+        # Built without full-text search, ContainsBackend takes over
+        return
+    install_native_triggers(schema_editor.connection)
+
+def install_native_triggers(connection):
+    '''(re)create the SQLite sync triggers, once the full-text table exists'''
+    if connection.vendor != 'sqlite':
+        return
+    if 'blogengine_post_fts' not in connection.introspection.table_names():
+        return
+    with connection.cursor() as cursor:
+        for sql in SqliteBackend.trigger_sql:
+            cursor.execute(sql)
+
+def uninstall_native_search(schema_editor):
+    backend = NATIVE_BACKENDS.get(schema_editor.connection.vendor)
+    if backend is not None:
+        with schema_editor.connection.cursor() as cursor:
+            for sql in backend.uninstall_sql:
+                cursor.execute(sql)
+
+# Whether the native backend of each database vendor was installed
+_native_installed = {}
+
+def get_backend():
+    '''
+    The backend named by SEARCH_BACKEND, or by default the native full-text
+    search of the database, falling back to ContainsBackend without one.
+    '''
+    path = getattr(settings, 'SEARCH_BACKEND', None)
+    if path:
+        return import_string(path)()
+    backend = NATIVE_BACKENDS.get(connection.vendor)
+    if backend is not None:
+        if connection.vendor not in _native_installed:
+            _native_installed[connection.vendor] = backend.is_installed()
+        if _native_installed[connection.vendor]:
+            return backend()
+    return ContainsBackend()
+
+def normalize_query(query):
+    '''query as searched, so that queries differing in case or spacing share results'''
+    return ' '.join(unicodedata.normalize('NFKC', query).lower().split())
+
+def search_posts(query):
+    '''
+    Ids of the posts matching query, best first. The ids are cached per
+    normalized query until a post changes, so paging through the results
+    only fetches the posts of each page.
+    '''
+    query = normalize_query(query)
+    if not query:
+        return []
+    backend = get_backend()
+    key = hashlib.md5(force_bytes('%s|%s' % (type(backend).__name__, query)))
+    return caching.cached('blogengine:search:%s' % key.hexdigest(), [caching.POSTS],
+                          lambda: list(backend.search(query)))
+
+def rebuild_indexes():
+    '''
+    Index every post again, in the inverted index and in the index of the
+    backend, returning the number of posts indexed.
+    '''
+    backend = get_backend()
+    indexed = search.rebuild_index()
+    if not isinstance(backend, IndexBackend):
+        indexed = backend.rebuild()
+    return indexed
+
+def update_search_index(sender, instance, raw=False, **kwargs):
+    # Loading fixtures saves raw rows, they are indexed by rebuildsearchindex.
+    # The native indexes are kept up to date by the database.
+    if not raw:
+        search.index_post(instance)
+
+# Deleting a post deletes its postings by cascade, and its native index rows
+# by trigger
+post_save.connect(update_search_index, sender=Post)
@@ -0,0 +1,117 @@
+from collections import OrderedDict
+from xml.sax.saxutils import escape
+
+from django.conf import settings
+from django.contrib.flatpages.models import FlatPage
+from django.contrib.sites.models import Site
+from django.contrib.syndication.views import add_domain
+from django.core.urlresolvers import reverse
+from django.db.models import Count, Max
+from blogengine import caching
+from blogengine.models import Category, Post, Tag
+
+# Limit of the sitemap protocol on the urls of one file
+MAX_URLS = 50000
+
+HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n'
+NAMESPACE = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+
+# Number of urls written out together while streaming
+CHUNK_URLS = 500
+
+def urls_per_file():
+    return min(getattr(settings, 'SITEMAP_URLS_PER_FILE', MAX_URLS), MAX_URLS)
+
+def flatpages():
+    return FlatPage.objects.filter(sites=Site.objects.get_current(), registration_required=False)
+
+# The rows listed in each section of the sitemap, with only the columns
+# their url and lastmod need, and the field their lastmod is taken from
+SECTIONS = OrderedDict([
+    ('posts', (lambda: Post.objects.only('pub_date', 'slug', 'updated_at'), 'updated_at')),
+    ('categories', (lambda: Category.objects.exclude(slug=None).only('slug', 'updated_at'), 'updated_at')),
+    ('tags', (lambda: Tag.objects.exclude(slug=None).only('slug', 'updated_at'), 'updated_at')),
+    ('pages', (lambda: flatpages().only('url'), None)),
+])
+
+def shard_rows(section, shard):
+    '''
+    The rows of shard of section. Shards are ranges of ids, so a shard is
+    read with the primary key index rather than an OFFSET, and never holds
+    more than urls_per_file rows.
+    '''
+    rows, lastmod_field = SECTIONS[section]
+    size = urls_per_file()
+    return rows().filter(pk__gt=shard * size, pk__lte=(shard + 1) * size).order_by('pk')
+
+def section_shards(section):
+    '''(shard, lastmod) of the shards of section holding rows, in order'''
+    rows, lastmod_field = SECTIONS[section]
+    size = urls_per_file()
+    last = rows().aggregate(last=Max('pk'))['last']
+    if last is None:
+        return []
+    shards = []
+    aggregates = {'rows': Count('pk')}
+    if lastmod_field:
+        aggregates['lastmod'] = Max(lastmod_field)
+    for shard in range((last - 1) // size + 1):
+        state = shard_rows(section, shard).aggregate(**aggregates)
+        if state['rows']:
+            shards.append((shard, state.get('lastmod')))
+    return shards
+
+def index_entries():
+    '''(section, shard, lastmod) of every sitemap file'''
+    size = urls_per_file()
+    entries = []
+    for section in SECTIONS:
+        if section == 'pages':
+            # Flatpages have no cache dependency, and are few
+            shards = section_shards(section)
+        else:
+            shards = caching.cached('blogengine:sitemap:%s:%d' % (section, size),
+                                    [caching.POSTS, caching.CATEGORIES, caching.TAGS],
+                                    lambda: section_shards(section))
+        entries.extend((section, shard, lastmod) for shard, lastmod in shards)
+    return entries
+
+def w3c_datetime(value):
+    return value.replace(microsecond=0).isoformat()
+
+def entry_xml(tag, location, lastmod):
+    xml = '<%s><loc>%s</loc>' % (tag, escape(location))
+    if lastmod is not None:
+        xml += '<lastmod>%s</lastmod>' % w3c_datetime(lastmod)
+    return xml + '</%s>\n' % tag
+
+def chunked(lines):
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) == CHUNK_URLS:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+def stream_index(request):
+    '''the sitemap index, listing each sitemap file with its latest lastmod'''
+    domain = Site.objects.get_current().domain
+    yield HEADER + '<sitemapindex xmlns="%s">\n' % NAMESPACE
+    for section, shard, lastmod in index_entries():
+        location = reverse('blogengine:sitemap_section', kwargs={'section': section, 'shard': shard})
+        yield entry_xml('sitemap', add_domain(domain, location, request.is_secure()), lastmod)
+    yield '</sitemapindex>\n'
+
+def stream_section(request, section, rows):
+    '''the urls of the rows of section, as they are read from the database'''
+    domain = Site.objects.get_current().domain
+    lastmod_field = SECTIONS[section][1]
+    yield HEADER + '<urlset xmlns="%s">\n' % NAMESPACE
+    for chunk in chunked(
+            entry_xml('url', add_domain(domain, row.get_absolute_url(), request.is_secure()),
+                      getattr(row, lastmod_field) if lastmod_field else None)
+            for row in rows):
+        yield chunk
+    yield '</urlset>\n'
@@ -0,0 +1,59 @@
+import re
+
+from django.conf import settings
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+from blogengine import search
+from blogengine.stemmer import stem
+
+TOKEN_RE = re.compile(r'\S+')
+
+def word_terms(word):
+    '''the search terms of a whitespace delimited word of plain text'''
+    return set(stem(part) for part in search.WORD_RE.findall(word.lower()))
+
+def best_window(matches, size):
+    '''
+    Start of the size words covering the most distinct query terms, then
+    the most matches. matches[i] is the set of query terms word i matches.
+    '''
+    best, best_score = 0, (0, 0)
+    counts = {}
+    total = 0
+    for end, terms in enumerate(matches):
+        for term in terms:
+            counts[term] = counts.get(term, 0) + 1
+        total += bool(terms)
+        start = end - size + 1
+        if start > 0:
+            for term in matches[start - 1]:
+                counts[term] -= 1
+                if not counts[term]:
+                    del counts[term]
+            total -= bool(matches[start - 1])
+        score = (len(counts), total)
+        if score > best_score:
+            best, best_score = max(start, 0), score
+    return best
+
+def snippet(plain_text, query, size=None):
+    '''
+    The window of plain_text that best matches query, as html with the
+    matching words in <mark>, or the start of the text when nothing matches.
+    '''
+    if size is None:
+        size = getattr(settings, 'SEARCH_SNIPPET_WORDS', 30)
+    words = TOKEN_RE.findall(plain_text)
+    terms = set(search.query_terms(query))
+    matches = [word_terms(word) & terms for word in words]
+    start = best_window(matches, size)
+
+    parts = []
+    for word, matched in zip(words[start:start + size], matches[start:start + size]):
+        parts.append('<mark>%s</mark>' % escape(word) if matched else escape(word))
+    html = ' '.join(parts)
+    if start > 0:
+        html = '&hellip; ' + html
+    if start + size < len(words):
+        html += ' &hellip;'
+    return mark_safe(html)
@@ -0,0 +1,16 @@
+// Search suggestions script
+$(document).ready(function () {
+    var timer = null;
+    $('input[data-suggest-url]').on('input', function () {
+        var input = $(this);
+        clearTimeout(timer);
+        timer = setTimeout(function () {
+            $.getJSON(input.data('suggest-url'), {q: input.val()}, function (data) {
+                var list = $('#' + input.attr('list')).empty();
+                $.each(data.suggestions, function (i, suggestion) {
+                    list.append($('<option>').attr('value', suggestion.label));
+                });
+            });
+        }, 100);
+    });
+});
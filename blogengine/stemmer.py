@@ -0,0 +1,118 @@
+'''
+The Porter stemmer, reducing English words to a common stem so that
+"post", "posts" and "posting" are searched as one term.
+
+M.F. Porter, An algorithm for suffix stripping, Program 14(3), 1980.
+'''
+
+def is_consonant(word, i):
+    letter = word[i]
+    if letter in 'aeiou':
+        return False
+    if letter == 'y':
+        return i == 0 or not is_consonant(word, i - 1)
+    return True
+
+def measure(stem):
+    '''number of vowel-consonant sequences in stem, the m of the paper'''
+    forms = ''.join('c' if is_consonant(stem, i) else 'v' for i in range(len(stem)))
+    collapsed = ''
+    for form in forms:
+        if not collapsed or collapsed[-1] != form:
+            collapsed += form
+    return collapsed.count('vc')
+
+def has_vowel(stem):
+    return any(not is_consonant(stem, i) for i in range(len(stem)))
+
+def ends_double_consonant(word):
+    return len(word) > 1 and word[-1] == word[-2] and is_consonant(word, len(word) - 1)
+
+def ends_cvc(word):
+    '''whether word ends consonant, vowel, consonant, the last not w, x or y'''
+    return (len(word) > 2 and is_consonant(word, len(word) - 1) and
+            not is_consonant(word, len(word) - 2) and is_consonant(word, len(word) - 3) and
+            word[-1] not in 'wxy')
+
+def replace_suffix(word, rules, min_measure):
+    '''apply the first rule whose suffix word ends with, if its stem is long enough'''
+    for suffix, replacement in rules:
+        if word.endswith(suffix):
+            stem = word[:len(word) - len(suffix)]
+            if measure(stem) > min_measure:
+                return stem + replacement
+            return word
+    return word
+
+STEP2_RULES = (
+    ('ational', 'ate'), ('tional', 'tion'), ('enci', 'ence'), ('anci', 'ance'),
+    ('izer', 'ize'), ('bli', 'ble'), ('alli', 'al'), ('entli', 'ent'), ('eli', 'e'),
+    ('ousli', 'ous'), ('ization', 'ize'), ('ation', 'ate'), ('ator', 'ate'),
+    ('alism', 'al'), ('iveness', 'ive'), ('fulness', 'ful'), ('ousness', 'ous'),
+    ('aliti', 'al'), ('iviti', 'ive'), ('biliti', 'ble'), ('logi', 'log'),
+)
+
+STEP3_RULES = (
+    ('icate', 'ic'), ('ative', ''), ('alize', 'al'), ('iciti', 'ic'), ('ical', 'ic'),
+    ('ful', ''), ('ness', ''),
+)
+
+STEP4_SUFFIXES = (
+    'al', 'ance', 'ence', 'er', 'ic', 'able', 'ible', 'ant', 'ement', 'ment', 'ent',
+    'ion', 'ou', 'ism', 'ate', 'iti', 'ous', 'ive', 'ize',
+)
+
+def step1(word):
+    if word.endswith('sses'):
+        word = word[:-2]
+    elif word.endswith('ies'):
+        word = word[:-2]
+    elif word.endswith('s') and not word.endswith('ss'):
+        word = word[:-1]
+
+    if word.endswith('eed'):
+        if measure(word[:-3]) > 0:
+            word = word[:-1]
+    else:
+        for suffix in ('ed', 'ing'):
+            if word.endswith(suffix) and has_vowel(word[:-len(suffix)]):
+                word = word[:-len(suffix)]
+                if word.endswith(('at', 'bl', 'iz')):
+                    word += 'e'
+                elif ends_double_consonant(word) and word[-1] not in 'lsz':
+                    word = word[:-1]
+                elif measure(word) == 1 and ends_cvc(word):
+                    word += 'e'
+                break
+
+    if word.endswith('y') and has_vowel(word[:-1]):
+        word = word[:-1] + 'i'
+    return word
+
+def step4(word):
+    for suffix in sorted(STEP4_SUFFIXES, key=len, reverse=True):
+        if word.endswith(suffix):
+            stem = word[:-len(suffix)]
+            if suffix == 'ion' and not stem.endswith(('s', 't')):
+                return word
+            return stem if measure(stem) > 1 else word
+    return word
+
+def step5(word):
+    if word.endswith('e'):
+        stem = word[:-1]
+        if measure(stem) > 1 or (measure(stem) == 1 and not ends_cvc(stem)):
+            word = stem
+    if measure(word) > 1 and ends_double_consonant(word) and word.endswith('l'):
+        word = word[:-1]
+    return word
+
+def stem(word):
+    '''the stem of a lower case word'''
+    if len(word) <= 2:
+        return word
+    word = step1(word)
+    word = replace_suffix(word, STEP2_RULES, 0)
+    word = replace_suffix(word, STEP3_RULES, 0)
+    word = step4(word)
+    return step5(word)
@@ -0,0 +1,265 @@
+import bisect
+import datetime
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from blogengine import caching
+from blogengine.models import Category, Post, Tag
+from blogengine.search_backends import normalize_query
+
+# The collections the suggestions are drawn from
+DEPENDENCIES = (caching.POSTS, caching.CATEGORIES, caching.TAGS)
+
+# Counter of the deletions logged in the shared cache, checked with the
+# versions of the dependencies, and the key logging each deletion
+DELETIONS = 'suggest-deletions'
+DELETED_KEY = 'blogengine:suggest:deleted:%d'
+
+# Seconds deletions stay logged, and the most deletions read at once. A
+# worker further behind rebuilds its index.
+DELETIONS_TIMEOUT = 24 * 60 * 60
+MAX_DELETIONS = 10000
+
+# Keys are inserted one by one below this many keys in the index per key
+# added or removed, and the whole index sorted or filtered above
+BATCH_RATIO = 64
+
+class PrefixIndex(object):
+    '''
+    Sorted array of the keys of each label, one key starting at each word,
+    so a prefix of any word of a label finds it with a binary search.
+    '''
+    def __init__(self):
+        self.keys = []
+        self.entries = {}
+
+    def label_keys(self, label):
+        words = normalize_query(label).split()
+        return [' '.join(words[start:]) for start in range(len(words))]
+
+    def add(self, entry_id, label, entry):
+        self.remove(entry_id)
+        keys = [(key, entry_id) for key in self.label_keys(label)]
+        self.entries[entry_id] = (entry, keys)
+        for key in keys:
+            bisect.insort(self.keys, key)
+
+    def extend(self, entries):
+        '''
+        Add many (entry_id, label, entry) at once. Few keys are inserted one
+        by one, many appended and sorted together, so building the index
+        doesn't take quadratic time.
+        '''
+        entries = OrderedDict((entry[0], entry) for entry in entries)
+        self.remove_all([entry_id for entry_id in entries if entry_id in self.entries])
+        added = []
+        for entry_id, label, entry in entries.values():
+            keys = [(key, entry_id) for key in self.label_keys(label)]
+            self.entries[entry_id] = (entry, keys)
+            added.extend(keys)
+        if len(added) * BATCH_RATIO < len(self.keys):
+            for key in added:
+                bisect.insort(self.keys, key)
+        else:
+            self.keys.extend(added)
+            self.keys.sort()
+
+    def remove_all(self, entry_ids):
+        removed = set()
+        for entry_id in entry_ids:
+            if entry_id in self.entries:
+                removed.update(self.entries.pop(entry_id)[1])
+        if len(removed) * BATCH_RATIO < len(self.keys):
+            for key in removed:
+                self.remove_key(key)
+        elif removed:
+            self.keys = [key for key in self.keys if key not in removed]
+
+    def remove(self, entry_id):
+        if entry_id not in self.entries:
+            return
+        entry, keys = self.entries.pop(entry_id)
+        for key in keys:
+            self.remove_key(key)
+
+    def remove_key(self, key):
+        index = bisect.bisect_left(self.keys, key)
+        if index < len(self.keys) and self.keys[index] == key:
+            del self.keys[index]
+
+    def search(self, prefix, limit):
+        '''entries with a word starting with prefix, in key order'''
+        prefix = normalize_query(prefix)
+        found = []
+        if not prefix:
+            return found
+        index = bisect.bisect_left(self.keys, (prefix,))
+        while index < len(self.keys) and len(found) < limit:
+            key, entry_id = self.keys[index]
+            if not key.startswith(prefix):
+                break
+            entry = self.entries[entry_id][0]
+            if entry not in found:
+                found.append(entry)
+            index += 1
+        return found
+
+def post_entry(post):
+    return (('post', post.pk), post.title,
+            {'type': 'post', 'label': post.title, 'url': post.get_absolute_url()})
+
+def category_entry(category):
+    return (('category', category.pk), category.name,
+            {'type': 'category', 'label': category.name, 'url': category.get_absolute_url()})
+
+def tag_entry(tag):
+    return (('tag', tag.pk), tag.name,
+            {'type': 'tag', 'label': tag.name, 'url': tag.get_absolute_url()})
+
+# The rows each kind of entry is built from, by the name of their model
+SOURCES = (
+    ('post', lambda: Post.objects.only('title', 'slug', 'pub_date', 'updated_at'), post_entry),
+    ('category', lambda: Category.objects.only('name', 'slug', 'updated_at'), category_entry),
+    ('tag', lambda: Tag.objects.only('name', 'slug', 'updated_at'), tag_entry),
+)
+
+def log_deletion(entry_id):
+    '''record that the entry was deleted, for the other workers to remove it'''
+    cache = caching.get_cache()
+    try:
+        number = cache.incr(caching.version_key(DELETIONS))
+    except ValueError:
+        # Evicted, start where no worker's count can be caught up from
+        number = int(time.time() * 1000000)
+        cache.set(caching.version_key(DELETIONS), number, None)
+    cache.set(DELETED_KEY % number, entry_id, DELETIONS_TIMEOUT)
+
+def deleted_since(number, current):
+    '''
+    The entries deleted after the deletion number up to current, None when
+    they can't all be told, for a count that was evicted or logs that
+    expired.
+    '''
+    if number is None or current is None or not number <= current <= number + MAX_DELETIONS:
+        return None
+    keys = [DELETED_KEY % deletion for deletion in range(number + 1, current + 1)]
+    found = caching.get_cache().get_many(keys)
+    if len(found) < len(keys):
+        return None
+    return list(found.values())
+
+# How far back rows are read again when catching up, for those saved by
+# transactions that committed after later ones
+REFRESH_OVERLAP = datetime.timedelta(minutes=1)
+
+class Suggestions(object):
+    '''
+    The prefix index of this worker. It is built on first use, kept up to
+    date by the model signals of this worker once their transaction
+    committed, and refreshed when another worker changes posts, categories
+    or tags, as told by the versions of their cache dependencies, with the
+    rows updated since and the deletions logged since.
+    '''
+    def __init__(self):
+        self.index = None
+        self.versions = None
+        self.updated = {}
+        self.lock = threading.Lock()
+
+    def build(self):
+        # Start the deletion count, so deletions from now on can be told
+        caching.get_cache().add(caching.version_key(DELETIONS), int(time.time() * 1000000), None)
+        versions = caching.get_versions(DEPENDENCIES + (DELETIONS,))
+        index = PrefixIndex()
+        updated = {}
+        for name, rows, entry in SOURCES:
+            found = list(rows())
+            index.extend(entry(row) for row in found)
+            updated[name] = max([row.updated_at for row in found], default=None)
+        self.index, self.versions, self.updated = index, versions, updated
+
+    def refresh(self):
+        '''
+        Catch up with the changes made by other workers: add the rows updated
+        since the newest indexed one, and remove the entries deleted since.
+        Rebuilds the index when the deletions can't be told.
+        '''
+        versions = caching.get_versions(DEPENDENCIES + (DELETIONS,))
+        deleted = []
+        if versions[DELETIONS] != self.versions.get(DELETIONS):
+            deleted = deleted_since(self.versions.get(DELETIONS), versions[DELETIONS])
+            if deleted is None:
+                self.build()
+                return
+        self.index.remove_all(deleted)
+        for name, rows, entry in SOURCES:
+            changed = rows()
+            if self.updated[name] is not None:
+                changed = changed.filter(updated_at__gte=self.updated[name] - REFRESH_OVERLAP)
+            changed = list(changed)
+            self.index.extend(entry(row) for row in changed)
+            times = [row.updated_at for row in changed]
+            if self.updated[name] is not None:
+                times.append(self.updated[name])
+            self.updated[name] = max(times, default=None)
+        self.versions = versions
+
+    def suggest(self, prefix, limit=None):
+        if limit is None:
+            limit = getattr(settings, 'SEARCH_SUGGESTIONS', 8)
+        if self.index is None or not caching.versions_are_current(self.versions):
+            with self.lock:
+                if self.index is None:
+                    self.build()
+                elif not caching.versions_are_current(self.versions):
+                    self.refresh()
+        return self.index.search(prefix, limit)
+
+    def update(self, entry_id, label=None, entry=None):
+        '''
+        Apply a change made by this worker once it is committed, without
+        rebuilding. Deletions are logged for the other workers.
+        '''
+        def apply():
+            if entry is None:
+                log_deletion(entry_id)
+            if self.index is None:
+                return
+            with self.lock:
+                if entry is None:
+                    self.index.remove(entry_id)
+                else:
+                    self.index.add(entry_id, label, entry)
+                # The change bumped the versions, catch up with them so the
+                # index isn't refreshed for a change it already has. The
+                # deletions logged by others meanwhile are still to be read.
+                versions = caching.get_versions(DEPENDENCIES)
+                versions[DELETIONS] = self.versions[DELETIONS]
+                self.versions = versions
+        transaction.on_commit(apply)
+
+suggestions = Suggestions()
+
+def update_post(sender, instance, **kwargs):
+    suggestions.update(*post_entry(instance))
+
+def update_category(sender, instance, **kwargs):
+    suggestions.update(*category_entry(instance))
+
+def update_tag(sender, instance, **kwargs):
+    suggestions.update(*tag_entry(instance))
+
+def remove_entry(sender, instance, **kwargs):
+    suggestions.update((sender._meta.model_name, instance.pk))
+
+# Set up signals
+post_save.connect(update_post, sender=Post)
+post_save.connect(update_category, sender=Category)
+post_save.connect(update_tag, sender=Tag)
+post_delete.connect(remove_entry, sender=Post)
+post_delete.connect(remove_entry, sender=Category)
+post_delete.connect(remove_entry, sender=Tag)
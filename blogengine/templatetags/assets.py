@@ -0,0 +1,43 @@
+from django import template
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.contrib.staticfiles.templatetags.staticfiles import static
+from django.utils.html import format_html, format_html_join
+from django.utils.safestring import mark_safe
+from blogengine.assets import bundles
+from blogengine.images import responsive_img
+from blogengine.critical import critical_css
+
+register = template.Library()
+
+@register.simple_tag
+def stylesheets(bundle, critical=None):
+    '''
+    A link to the bundle once collected, and to each of its stylesheets
+    before. When the critical css of the page critical was built it is
+    inlined instead, and the stylesheets load without blocking rendering.
+    '''
+    if bundle in getattr(staticfiles_storage, 'hashed_files', {}):
+        urls = [static(bundle)]
+    else:
+        urls = [static(name) for name in bundles()[bundle]]
+
+    css = critical_css(critical) if critical else None
+    if css is None:
+        return format_html_join('\n', '<link rel="stylesheet" href="{}">', ((url,) for url in urls))
+    links = format_html_join('\n', '<link rel="preload" href="{}" as="style" '
+                             'onload="this.onload=null;this.rel=\'stylesheet\'">', ((url,) for url in urls))
+    fallback = format_html_join('\n', '<link rel="stylesheet" href="{}">', ((url,) for url in urls))
+    # The css is built from our own stylesheets
+    return format_html('<style>{}</style>\n{}\n<noscript>{}</noscript>',
+                       mark_safe(css), links, fallback)
+
+@register.simple_tag
+def responsive_image(src, sizes=None, widths=None, lazy=True, **attrs):
+    '''
+    An img tag for src with attrs, given a srcset of its variants in widths,
+    a comma separated list of pixel widths.
+    '''
+    if widths:
+        widths = [int(width) for width in widths.split(',')]
+    attrs = [('src', src)] + sorted((name.replace('_', '-'), str(value)) for name, value in attrs.items())
+    return mark_safe(responsive_img(attrs, sizes, widths, lazy))
@@ -1,7 +1,19 @@
 from django.core.urlresolvers import reverse
-from django.test import TestCase, LiveServerTestCase, Client
+from django.test import TestCase, LiveServerTestCase, Client, RequestFactory, override_settings
+from django.utils.cache import get_cache_key
 from django.utils import timezone
 from blogengine.models import Post, Category, Tag
+from blogengine import assets, caching, conditional, critical, export, images, markup, middleware, pagination, regenerate, search, search_backends, snippets, stemmer, suggest
+from blogengine.models import Posting, SearchDocument
+from blogengine.views import PostsFeed
+from blogengine.querybudget import QueryBudgetExceeded, QueryBudgetMiddleware, query_budget
+from django.db import DatabaseError, connection, transaction
+from django.http import HttpResponse, StreamingHttpResponse
+from django.core.cache import caches
+from django.core.management import call_command
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.template import Context, Template
+from io import StringIO
 import markdown2 as markdown
 from django.contrib.flatpages.models import FlatPage
 from django.contrib.sites.models import Site
@@ -10,6 +22,24 @@ import feedparser
 import factory.django
 from datetime import datetime
 from dateutil import tz
+import fcntl
+import gzip
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+import unittest
+import xml.etree.ElementTree as ElementTree
+
+# Caches for tests that exercise caching
+LOCMEM_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'blogengine-tests',
+    }
+}
 
 # Factories for tests
 class SiteFactory(factory.django.DjangoModelFactory):
@@ -169,9 +199,388 @@ class PostTest(TestCase):
         self.assertEqual(only_post_tag.name, 'perl')
         self.assertEqual(only_post_tag.description, 'The Perl programming language')
 
+    def test_post_stores_plain_text(self):
+        post = PostFactory(text='This is my *first* [blog post](/) &amp; more')
+        self.assertEqual(post.plain_text, 'This is my first blog post & more')
+
+    def test_post_stores_rendered_text(self):
+        # Create the post
+        post = PostFactory(text='This is my *first* blog post')
+
+        # Check the rendered html was stored on save
+        only_post = Post.objects.get(pk=post.pk)
+        self.assertEqual(only_post.rendered_text, markup.render_markdown(post.text))
+        self.assertEqual(only_post.text_hash, markup.content_hash(post.text))
+        self.assertEqual(only_post.renderer_version, markup.RENDERER_VERSION)
+
+        # Check the stored html is served without rendering again
+        with self.assertNumQueries(0):
+            self.assertTrue('<em>first</em>' in only_post.html)
+
+    def test_post_rerenders_stale_text(self):
+        # Create the post
+        post = PostFactory(text='This is my *first* blog post')
+
+        # Change the text behind the model's back
+        Post.objects.filter(pk=post.pk).update(text='This is my **second** blog post')
+
+        # Check the stale html is re-rendered, without writing while reading
+        only_post = Post.objects.get(pk=post.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue('<strong>second</strong>' in only_post.html)
+        self.assertFalse('<strong>second</strong>' in Post.objects.get(pk=post.pk).rendered_text)
+
+        # Check render_stale stores it
+        self.assertEqual(Post.objects.render_stale(), 1)
+        self.assertTrue('<strong>second</strong>' in Post.objects.get(pk=post.pk).rendered_text)
+        self.assertEqual(Post.objects.render_stale(), 0)
+
+        # Check an old renderer version is stored again after migrating
+        Post.objects.filter(pk=post.pk).update(renderer_version=0)
+        call_command('migrate', verbosity=0)
+        self.assertEqual(Post.objects.get(pk=post.pk).renderer_version, markup.RENDERER_VERSION)
+
+class RenderCacheTest(TestCase):
+    def test_render_cache_hits(self):
+        render_cache = markup.RenderCache(max_entries=2)
+
+        # Check the first render is a miss and the second a hit
+        html = render_cache.render('This is my *first* blog post')
+        self.assertEqual(html, markup.render_markdown('This is my *first* blog post'))
+        self.assertEqual(render_cache.render('This is my *first* blog post'), html)
+        self.assertEqual(render_cache.stats()['misses'], 1)
+        self.assertEqual(render_cache.stats()['hits'], 1)
+
+        # Check the extras are part of the key
+        render_cache.render('This is my *first* blog post', extras=[])
+        self.assertEqual(render_cache.stats()['misses'], 2)
+
+    def test_render_cache_evicts_least_recently_used(self):
+        render_cache = markup.RenderCache(max_entries=2)
+        render_cache.render('first')
+        render_cache.render('second')
+        render_cache.render('first')
+        render_cache.render('third')
+
+        # Check the least recently used entry was evicted
+        self.assertEqual(render_cache.stats()['entries'], 2)
+        self.assertEqual(render_cache.stats()['evictions'], 1)
+        render_cache.render('first')
+        self.assertEqual(render_cache.stats()['misses'], 3)
+        render_cache.render('second')
+        self.assertEqual(render_cache.stats()['misses'], 4)
+
+    @override_settings(CACHES=LOCMEM_CACHES)
+    def test_render_cache_shared_tier(self):
+        first = markup.RenderCache(max_entries=2, cache_alias='default')
+        second = markup.RenderCache(max_entries=2, cache_alias='default')
+
+        # Check a text rendered by one worker is shared with another
+        html = first.render('This is my *first* blog post')
+        self.assertEqual(second.render('This is my *first* blog post'), html)
+        self.assertEqual(second.stats()['shared_hits'], 1)
+        self.assertEqual(second.stats()['misses'], 0)
+
+def tiered_caches(**options):
+    return {
+        'default': {
+            'BACKEND': 'blogengine.cache_backends.TieredCache',
+            'LOCATION': 'remote',
+            'OPTIONS': options,
+        },
+        'remote': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'blogengine-tests-remote',
+        }
+    }
+
+class TieredCacheTest(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+
+    @override_settings(CACHES=tiered_caches(LOCAL_TIMEOUT=60))
+    def test_reads_served_from_local_tier(self):
+        # Write through both tiers
+        caches['default'].set('key', 'value')
+        self.assertEqual(caches['remote'].get('key'), 'value')
+
+        # Check a change made by another worker isn't seen while the local copy is fresh
+        caches['remote'].set('key', 'changed')
+        self.assertEqual(caches['default'].get('key'), 'value')
+
+        # Check deleting goes through both tiers
+        caches['default'].delete('key')
+        self.assertEqual(caches['default'].get('key'), None)
+        self.assertEqual(caches['remote'].get('key'), None)
+
+    @override_settings(CACHES=tiered_caches(LOCAL_TIMEOUT=0.05))
+    def test_local_entries_expire(self):
+        caches['default'].set('key', 'value')
+        caches['remote'].set('key', 'changed')
+
+        # Check the remote value is read once the local copy expired
+        time.sleep(0.1)
+        self.assertEqual(caches['default'].get('key'), 'changed')
+
+    @override_settings(CACHES=tiered_caches(LOCAL_TIMEOUT=60, MAX_ENTRIES=2))
+    def test_local_tier_is_bounded(self):
+        caches['default'].set('first', 1)
+        caches['default'].set('second', 2)
+        caches['default'].get('first')
+        caches['default'].set('third', 3)
+
+        # Check the least recently used entry was dropped from the local tier
+        caches['remote'].set('first', 'changed')
+        caches['remote'].set('second', 'changed')
+        self.assertEqual(caches['default'].get('first'), 1)
+        self.assertEqual(caches['default'].get('second'), 'changed')
+
+    @override_settings(CACHES=tiered_caches(LOCAL_TIMEOUT=60))
+    def test_versioned_reads(self):
+        caches['default'].set('key', 'value', version=1)
+
+        # Check another version never sees the local entry
+        self.assertEqual(caches['default'].get('key', version=2), None)
+        self.assertEqual(caches['default'].get('key', version=1), 'value')
+
+        # Check counters are kept in step with the remote tier
+        caches['default'].set('counter', 1)
+        self.assertEqual(caches['default'].incr('counter'), 2)
+        self.assertEqual(caches['default'].get('counter'), 2)
+        self.assertEqual(caches['remote'].get('counter'), 2)
+
+    @override_settings(CACHES=tiered_caches(LOCAL_TIMEOUT=60, MAX_BYTES=300))
+    def test_local_tier_is_bounded_in_bytes(self):
+        caches['default'].set('first', 'x' * 100)
+        caches['default'].set('second', 'y' * 100)
+        caches['default'].set('third', 'z' * 100)
+        caches['default'].set('large', 'l' * 1000)
+
+        # Check the oldest entry was dropped to make room, and the large one never kept
+        for key in ('first', 'second', 'large'):
+            caches['remote'].set(key, 'changed')
+        self.assertEqual(caches['default'].get('first'), 'changed')
+        self.assertEqual(caches['default'].get('large'), 'changed')
+
+    @override_settings(CACHES=tiered_caches(LOCAL_TIMEOUT=60, REMOTE_ONLY_PREFIXES=['blogengine:version:']))
+    def test_remote_only_keys(self):
+        caches['default'].set('blogengine:version:posts', 1)
+        caches['default'].get_many(['blogengine:version:posts'])
+
+        # Check a version bumped by another worker is seen at once
+        caches['remote'].incr('blogengine:version:posts')
+        self.assertEqual(caches['default'].get('blogengine:version:posts'), 2)
+        self.assertEqual(caches['default'].get_many(['blogengine:version:posts']),
+                         {'blogengine:version:posts': 2})
+
+class AssetsTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def test_rebase_css(self):
+        css = "a { background: url('../fonts/x.woff?v=1#y') } b { background: url(data:image/png;base64,AA) }"
+        self.assertEqual(assets.rebase_css(css, 'lib/dist/css/lib.css', 'css/site.css'),
+                         "a { background: url('../lib/dist/fonts/x.woff?v=1#y') } "
+                         "b { background: url(data:image/png;base64,AA) }")
+
+    def test_collectstatic(self):
+        # Check the stylesheets are linked one by one until collected
+        stylesheets = Template("{% load assets %}{% stylesheets 'css/site.css' %}")
+        with self.settings(STATIC_ROOT=self.root):
+            self.assertEqual(stylesheets.render(Context()).count('<link'), 8)
+
+            call_command('collectstatic', interactive=False, verbosity=0)
+
+            # Check the bundle is fingerprinted, with fingerprinted fonts
+            bundle = staticfiles_storage.stored_name('css/site.css')
+            self.assertNotEqual(bundle, 'css/site.css')
+            self.assertEqual(stylesheets.render(Context()),
+                             '<link rel="stylesheet" href="/static/%s">' % bundle)
+            with open(os.path.join(self.root, bundle), encoding='utf-8') as css:
+                content = css.read()
+            self.assertTrue('.navbar' in content and '#sidebar' in content)
+            font = staticfiles_storage.stored_name('bower_components/font-awesome/fonts/fontawesome-webfont.woff')
+            self.assertTrue(('../%s' % font) in content)
+
+            # Check the precompressed variant is served, cached for good
+            request = RequestFactory().get('/static/' + bundle, HTTP_ACCEPT_ENCODING='gzip, deflate')
+            response = assets.serve(request, bundle)
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertEqual(response['Cache-Control'], 'public, max-age=31536000, immutable')
+            self.assertTrue('Accept-Encoding' in response['Vary'])
+            self.assertEqual(gzip.decompress(response_content(response)).decode('utf-8'), content)
+
+            # Check files without a fingerprint are revalidated
+            response = assets.serve(RequestFactory().get('/static/css/site.css'), 'css/site.css')
+            self.assertFalse('Content-Encoding' in response)
+            self.assertEqual(response['Cache-Control'], 'public, max-age=3600')
+
+    def test_critical_css(self):
+        used = critical.UsedSelectors(limit=2)
+        used.feed('<html><body class="home"><div id="top"><a class="title">x</a></div>'
+                  '<p class="below">y</p></body></html>')
+        css = ('''/* comment */ @charset "utf-8"; body { margin: 0 } .home #top > a.title:hover { color: red }
+               .below, p { display: none } @media (min-width: 768px) { .title, .other { float: left } .other { x: y } }
+               @font-face { font-family: "Icons"; src: url(/static/icons.woff) } @keyframes spin { to { x: y } }''')
+
+        # Check only the rules of the elements above the fold are kept
+        self.assertEqual(critical.extract(css, used).split('\n'), [
+            'body{margin: 0}',
+            '.home #top > a.title:hover{color: red}',
+            '@media (min-width: 768px){.title{float: left}}',
+            '@font-face{font-family: "Icons"; src: url(/static/icons.woff)}',
+        ])
+
+    def test_build_critical_css(self):
+        PostFactory()
+        with self.settings(CRITICAL_CSS_ROOT=self.root):
+            # Check the stylesheets block rendering until the critical css is built
+            response = self.client.get(reverse('blogengine:index'))
+            self.assertFalse(b'<style>' in response.content)
+
+            call_command('buildcriticalcss', stdout=StringIO())
+            for name in ('index', 'post', 'archive'):
+                with open(os.path.join(self.root, '%s.css' % name), encoding='utf-8') as css:
+                    self.assertTrue('.navbar' in css.read())
+
+            # Check the critical css is inlined and the stylesheets deferred
+            caches['default'].clear()
+            response = self.client.get(reverse('blogengine:index'))
+            self.assertTrue(b'<style>' in response.content)
+            self.assertTrue(b'rel="preload"' in response.content)
+            self.assertTrue(b'<noscript><link rel="stylesheet"' in response.content)
+
+class ImagesTest(TestCase):
+    def setUp(self):
+        self.static = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.static)
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        images_settings = override_settings(STATICFILES_DIRS=[self.static], RESPONSIVE_IMAGES_ROOT=self.root,
+                                            RESPONSIVE_IMAGE_WIDTHS=(320, 640, 1280))
+        images_settings.enable()
+        self.addCleanup(images_settings.disable)
+        images._processed.clear()
+        images._pending.clear()
+
+    def save_image(self, name, mode, size):
+        images.Image.new(mode, size).save(os.path.join(self.static, name))
+
+    def test_without_variants(self):
+        with self.settings(RESPONSIVE_IMAGES_ROOT=None):
+            html = markup.render_markdown('![A photo](http://example.com/a.jpg?w=1&h=2)')
+
+        # Check images are still made lazy
+        self.assertTrue('<img src="http://example.com/a.jpg?w=1&amp;h=2" alt="A photo" '
+                        'loading="lazy" decoding="async">' in html)
+
+    @unittest.skipIf(images.Image is None, 'Pillow is not installed')
+    def test_variants(self):
+        self.save_image('photo.jpg', 'RGB', (800, 400))
+
+        # Check rendering leaves images it has no variants of to be resized
+        html = images.responsive_html('<p><img src="/static/photo.jpg" alt="A photo"></p>')
+        self.assertEqual(html, '<p><img src="/static/photo.jpg" alt="A photo" loading="lazy" decoding="async"></p>')
+        self.assertEqual(images.pending_images(), [('/static/photo.jpg', (320, 640, 1280))])
+        self.assertEqual(os.listdir(self.root), [])
+
+        # Check the image is resized to the widths narrower than it
+        info = images.process_image('/static/photo.jpg')
+        self.assertEqual(images.pending_images(), [])
+        html = images.responsive_html('<p><img src="/static/photo.jpg" alt="A photo"></p>')
+        names = [name for width, name in info['variants']['image/jpeg']]
+        self.assertEqual([name.split('-')[1] for name in names], ['320.jpg', '640.jpg', '800.jpg'])
+        with images.Image.open(os.path.join(self.root, names[0])) as variant:
+            self.assertEqual(variant.size, (320, 160))
+
+        # Check the tag offers the variants, with the dimensions of the image
+        attrs = dict(images.tag_attributes(images.IMG_RE.search(html).group(0)))
+        self.assertEqual(attrs['src'], '/media/images/' + names[-1])
+        self.assertEqual(attrs['srcset'], ', '.join(
+            '/media/images/%s %s' % (name, name.split('-')[1].split('.')[0] + 'w') for name in names))
+        self.assertEqual(attrs['sizes'], images.image_sizes())
+        self.assertEqual((attrs['width'], attrs['height'], attrs['loading']), ('800', '400', 'lazy'))
+        self.assertEqual('<picture>' in html, images.webp_supported())
+
+        # Check variants built before are used without reading the image
+        os.unlink(os.path.join(self.static, 'photo.jpg'))
+        images._processed.clear()
+        self.assertEqual(images.responsive_html('<img src="/static/photo.jpg">').count('srcset'),
+                         2 if images.webp_supported() else 1)
+
+    @unittest.skipIf(images.Image is None, 'Pillow is not installed')
+    def test_transparent_variants(self):
+        self.save_image('logo.png', 'RGBA', (200, 100))
+        images.process_image('/static/logo.png')
+        html = images.responsive_html('<img src="/static/logo.png" width="50">')
+
+        # Check transparency is kept, and the given width is the size shown
+        attrs = dict(images.tag_attributes(images.IMG_RE.search(html).group(0)))
+        self.assertTrue(attrs['src'].endswith('-200.png'))
+        self.assertEqual(attrs['sizes'], '50px')
+        self.assertFalse('height' in attrs)
+
+    @unittest.skipIf(images.Image is None, 'Pillow is not installed')
+    def test_responsive_image_tag(self):
+        self.save_image('me.jpg', 'RGB', (400, 400))
+        images.process_image('/static/me.jpg', (100, 200))
+        html = Template("{% load assets %}{% responsive_image '/static/me.jpg' sizes='100px' "
+                        "widths='100,200' lazy=False class='picture' %}").render(Context())
+
+        attrs = dict(images.tag_attributes(images.IMG_RE.search(html).group(0)))
+        self.assertEqual(attrs['class'], 'picture')
+        self.assertEqual(attrs['sizes'], '100px')
+        self.assertTrue(attrs['srcset'].endswith('-200.jpg 200w'))
+        self.assertFalse('loading' in attrs)
+
+        # Check the variants are served to be cached for good
+        name = attrs['src'][len('/media/images/'):]
+        response = assets.serve(RequestFactory().get(attrs['src']), name, self.root, immutable=True)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(response['Cache-Control'], assets.IMMUTABLE)
+
+    @unittest.skipIf(images.Image is None, 'Pillow is not installed')
+    def test_process_images(self):
+        # Check images missing when the post is saved are left as they are
+        post = PostFactory(text='![A photo](/static/late.jpg)')
+        self.assertFalse('srcset' in post.rendered_text)
+        page = FlatPageFactory(content='![A photo](/static/page.jpg)')
+        self.assertFalse('srcset' in markup.cached_markdown(page.content))
+
+        # Check processimages resizes them once they can be read
+        self.save_image('late.jpg', 'RGB', (700, 350))
+        self.save_image('page.jpg', 'RGB', (700, 350))
+        output = StringIO()
+        call_command('processimages', stdout=output, stderr=StringIO())
+        self.assertTrue('updated 1 posts' in output.getvalue())
+        self.assertTrue('srcset' in Post.objects.get(pk=post.pk).rendered_text)
+
+        # Check the flatpages are rendered again with theirs
+        self.assertTrue('srcset' in markup.cached_markdown(page.content))
+
+class ExplainQueriesTest(TestCase):
+    def test_no_sequential_scans(self):
+        # Check the view queries all use an index
+        output = StringIO()
+        call_command('explainqueries', seed=200, stdout=output)
+        self.assertTrue('No sequential scans' in output.getvalue())
+
+        # Check the seeded posts were rolled back
+        self.assertEqual(Post.objects.count(), 0)
+
 class BaseAcceptanceTest(LiveServerTestCase):
     def setUp(self):
         self.client = Client()
+        caches['default'].clear()
+
+        # Publish feeds to a temporary directory
+        self.published = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.published)
+        published_settings = override_settings(PUBLISHED_FEEDS_ROOT=os.path.join(self.published, 'feeds'),
+                                               RESPONSIVE_IMAGES_ROOT=os.path.join(self.published, 'images'))
+        published_settings.enable()
+        self.addCleanup(published_settings.disable)
 
 class AdminTest(BaseAcceptanceTest):
     fixtures = ['users.json']
@@ -512,6 +921,7 @@ class AdminTest(BaseAcceptanceTest):
         all_posts = Post.objects.all()
         self.assertEqual(len(all_posts), 0)
 
+@override_settings(QUERY_BUDGET_STRICT=True)
 class PostViewTest(BaseAcceptanceTest):
     def test_clear_cache(self):
         # Create the category
@@ -756,6 +1166,49 @@ class PostViewTest(BaseAcceptanceTest):
         # Check the link is marked up properly
         self.assertTrue('<a href="http://127.0.0.1:8000/">my first blog post</a>' in response.content.decode('utf-8'))
 
+    def test_listing_query_budget(self):
+        # Create several tagged posts
+        tag = TagFactory()
+        other_tag = TagFactory(name='ruby', description='The Ruby programming language', slug='ruby')
+        for number in range(7):
+            post = PostFactory(title='Post number %d' % number, slug='post-number-%d' % number)
+            post.tags.add(tag, other_tag)
+
+        # Check the listings stay within their query budgets
+        for url in [reverse('blogengine:index'), '/2/', post.get_absolute_url(),
+                    post.category.get_absolute_url(), tag.get_absolute_url(),
+                    reverse('blogengine:search') + '?q=post', '/feeds/posts/',
+                    '/archive/', '/categories/']:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+
+        # Check the index doesn't query per post, nor count them
+        caches['default'].clear()
+        with self.assertNumQueries(5):
+            self.client.get(reverse('blogengine:index'))
+
+    def test_query_budget_exceeded(self):
+        @query_budget(0)
+        def view(request):
+            return HttpResponse(str(Post.objects.count()))
+
+        request = RequestFactory().get('/')
+        budget = QueryBudgetMiddleware()
+        budget.process_view(request, view, (), {})
+        response = view(request)
+        with self.assertRaises(QueryBudgetExceeded):
+            budget.process_response(request, response)
+
+        # Check the queries run while a response streams count too
+        @query_budget(0)
+        def streaming_view(request):
+            return StreamingHttpResponse(str(post.pk) for post in Post.objects.iterator())
+
+        budget.process_view(request, streaming_view, (), {})
+        response = budget.process_response(request, streaming_view(request))
+        with self.assertRaises(QueryBudgetExceeded):
+            b''.join(response.streaming_content)
+
     def test_nonexistent_category_page(self):
         category_url = '/category/blah/'
         response = self.client.get(category_url)
@@ -768,6 +1221,625 @@ class PostViewTest(BaseAcceptanceTest):
         self.assertEqual(response.status_code, 200)
         self.assertTrue('No posts found' in response.content.decode('utf-8'))
 
+@override_settings(CACHES=LOCMEM_CACHES)
+class CacheInvalidationTest(BaseAcceptanceTest):
+    def setUp(self):
+        super(CacheInvalidationTest, self).setUp()
+        caches['default'].clear()
+
+    def test_post_save_invalidates_only_its_pages(self):
+        # Create two posts in different categories
+        python = CategoryFactory()
+        perl = CategoryFactory(name='perl', description='The Perl programming language', slug='perl')
+        post = PostFactory(category=python)
+        other_post = PostFactory(title='My second post', slug='my-second-post', category=perl)
+
+        # Fetch both category pages so they are cached
+        self.client.get(python.get_absolute_url())
+        self.client.get(perl.get_absolute_url())
+
+        # Change the other post without sending signals
+        Post.objects.filter(pk=other_post.pk).update(title='My sneaky post')
+
+        # Edit the first post
+        post.title = 'My edited post'
+        post.save()
+
+        # Check the first category page was invalidated
+        response = self.client.get(python.get_absolute_url())
+        self.assertTrue('My edited post' in response.content.decode('utf-8'))
+
+        # Check the other category page is still served from the cache
+        response = self.client.get(perl.get_absolute_url())
+        self.assertTrue('My second post' in response.content.decode('utf-8'))
+        self.assertTrue('My sneaky post' not in response.content.decode('utf-8'))
+
+    def test_post_tags_change_invalidates_tag_page(self):
+        # Create the post and tag
+        tag = TagFactory()
+        post = PostFactory()
+
+        # Fetch the tag page so it is cached
+        response = self.client.get(tag.get_absolute_url())
+        self.assertTrue('No posts found' in response.content.decode('utf-8'))
+
+        # Tag the post
+        post.tags.add(tag)
+
+        # Check the tag page was invalidated
+        response = self.client.get(tag.get_absolute_url())
+        self.assertTrue('My first post' in response.content.decode('utf-8'))
+
+    def test_category_rename_invalidates_post_page(self):
+        # Create the post
+        post = PostFactory()
+
+        # Fetch the post page so it is cached
+        response = self.client.get(post.get_absolute_url())
+        self.assertTrue('python' in response.content.decode('utf-8'))
+
+        # Rename the category
+        category = post.category
+        category.name = 'cpython'
+        category.save()
+
+        # Check the post page was invalidated
+        response = self.client.get(post.get_absolute_url())
+        self.assertTrue('cpython' in response.content.decode('utf-8'))
+
+    def test_cached_fragment(self):
+        builds = []
+        def build():
+            builds.append(1)
+            return len(builds)
+
+        # Check the fragment is built once
+        self.assertEqual(caching.cached('fragment', [caching.TAGS], build), 1)
+        self.assertEqual(caching.cached('fragment', [caching.TAGS], build), 1)
+
+        # Check an unrelated invalidation keeps it
+        caching.bump(caching.CATEGORIES)
+        self.assertEqual(caching.cached('fragment', [caching.TAGS], build), 1)
+
+        # Check invalidating a dependency rebuilds it
+        caching.bump(caching.TAGS)
+        self.assertEqual(caching.cached('fragment', [caching.TAGS], build), 2)
+
+@override_settings(CACHES=LOCMEM_CACHES, PAGE_CACHE_JITTER=0.5, PAGE_CACHE_LOCK_WAIT=0.1)
+class PageCacheTest(BaseAcceptanceTest):
+    def setUp(self):
+        super(PageCacheTest, self).setUp()
+        caches['default'].clear()
+
+    def get_entry(self, url):
+        request = RequestFactory().get(url)
+        cache_key = get_cache_key(request, '', 'GET', cache=caches['default'])
+        return caches['default'].get(cache_key)
+
+    def test_stale_page_served_while_rebuilding(self):
+        # Create the post and cache the index
+        post = PostFactory()
+        self.client.get(reverse('blogengine:index'))
+
+        # Make the cached index stale behind the cache's back
+        Post.objects.filter(pk=post.pk).update(title='My edited post')
+        caching.bump(caching.POSTS)
+
+        # Check the stale copy is served while another worker holds the lock
+        request = RequestFactory().get(reverse('blogengine:index'))
+        caches['default'].add(middleware.lock_key(request), 1)
+        response = self.client.get(reverse('blogengine:index'))
+        self.assertTrue('My first post' in response.content.decode('utf-8'))
+
+        # Check the page is rebuilt once the lock is free
+        caches['default'].delete(middleware.lock_key(request))
+        response = self.client.get(reverse('blogengine:index'))
+        self.assertTrue('My edited post' in response.content.decode('utf-8'))
+
+        # Check the rebuilding worker released the lock
+        self.assertTrue(caches['default'].get(middleware.lock_key(request)) is None)
+
+    @override_settings(CACHES=tiered_caches(LOCAL_TIMEOUT=60, REMOTE_ONLY_PREFIXES=['blogengine:version:',
+                                                                             'blogengine:page-lock:']))
+    def test_page_rebuilt_once_across_tiers(self):
+        # Create the post and cache the index in this worker's local tier
+        post = PostFactory()
+        caches['default'].clear()
+        self.client.get(reverse('blogengine:index'))
+        cache_key = get_cache_key(RequestFactory().get(reverse('blogengine:index')), '', 'GET',
+                                  cache=caches['default'])
+        stale = caches['remote'].get(cache_key)
+
+        # Rebuild the page as another worker would, leaving the stale copy here
+        Post.objects.filter(pk=post.pk).update(title='My edited post')
+        caching.bump(caching.POSTS)
+        self.client.get(reverse('blogengine:index'))
+        caches['default']._local_set(caches['default'].make_key(cache_key), stale)
+
+        # Check the rebuilt page is read from the remote tier rather than built again
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('blogengine:index'))
+        self.assertTrue('My edited post' in response.content.decode('utf-8'))
+
+    def test_missing_page_rebuilt_after_waiting_for_lock(self):
+        # Create the post
+        post = PostFactory()
+
+        # Check the page is still built when the lock holder never finishes
+        request = RequestFactory().get(post.get_absolute_url())
+        caches['default'].add(middleware.lock_key(request), 1)
+        response = self.client.get(post.get_absolute_url())
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('My first post' in response.content.decode('utf-8'))
+
+    def test_timeout_jitter(self):
+        # Create the post and cache the index
+        PostFactory()
+        before = time.time()
+        self.client.get(reverse('blogengine:index'))
+
+        # Check the page goes stale somewhere within the jittered timeout
+        entry = self.get_entry(reverse('blogengine:index'))
+        self.assertTrue(before + 150 <= entry['expires'] <= time.time() + 300)
+
+    def test_compressed_page(self):
+        # Create the post and cache the index
+        PostFactory(text='This is my first blog post. ' * 50)
+        response = self.client.get(reverse('blogengine:index'))
+        self.assertFalse('Content-Encoding' in response)
+        self.assertTrue('Accept-Encoding' in response['Vary'])
+        page, etag = response.content, response['ETag']
+
+        # Check the page is compressed for clients accepting gzip
+        response = self.client.get(reverse('blogengine:index'), HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.content), page)
+        self.assertEqual(int(response['Content-Length']), len(response.content))
+        self.assertEqual(response['ETag'], 'W/' + etag)
+
+        # Check the compressed page is validated against either ETag
+        response = self.client.get(reverse('blogengine:index'), HTTP_ACCEPT_ENCODING='gzip',
+                                   HTTP_IF_NONE_MATCH='W/' + etag)
+        self.assertEqual(response.status_code, 304)
+
+        # Check refused encodings aren't used
+        response = self.client.get(reverse('blogengine:index'), HTTP_ACCEPT_ENCODING='gzip;q=0, identity')
+        self.assertFalse('Content-Encoding' in response)
+        self.assertEqual(response.content, page)
+
+    def test_cached_page_compressed_once(self):
+        # Create the post and cache the index
+        PostFactory(text='This is my first blog post. ' * 50)
+        self.client.get(reverse('blogengine:index'))
+
+        # Check the page is stored compressed, and served as stored
+        entry = self.get_entry(reverse('blogengine:index'))
+        self.assertEqual(gzip.decompress(entry['encoded']['gzip']), entry['response'].content)
+        entry['encoded']['gzip'] = gzip.compress(entry['response'].content, 1)
+        caches['default'].set(get_cache_key(RequestFactory().get(reverse('blogengine:index')), '', 'GET',
+                                            cache=caches['default']), entry)
+        response = self.client.get(reverse('blogengine:index'), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.content, entry['encoded']['gzip'])
+
+    def test_compression_min_size(self):
+        # Check responses below the minimum size are sent as they are
+        PostFactory(text='This is my first blog post. ' * 50)
+        with self.settings(COMPRESSION_MIN_SIZE=10 ** 6):
+            response = self.client.get(reverse('blogengine:index'), HTTP_ACCEPT_ENCODING='gzip')
+            self.assertFalse('Content-Encoding' in response)
+
+        # Check streamed responses are gzipped as they stream
+        response = self.client.get(reverse('blogengine:sitemap'), HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertTrue(b'<sitemapindex' in gzip.decompress(b''.join(response.streaming_content)))
+
+class ConditionalGetTest(BaseAcceptanceTest):
+    def test_index_not_modified(self):
+        # Create the post
+        PostFactory()
+
+        # Fetch the index
+        response = self.client.get(reverse('blogengine:index'))
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        last_modified = response['Last-Modified']
+
+        # Check an unchanged index is not sent again
+        response = self.client.get(reverse('blogengine:index'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(reverse('blogengine:index'), HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+        # Check a new post changes the validators
+        PostFactory(title='My second post', slug='my-second-post')
+        response = self.client.get(reverse('blogengine:index'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_deploy_changes_validators(self):
+        post = PostFactory()
+        response = self.client.get(post.get_absolute_url())
+        etag = response['ETag']
+
+        # Check new critical css, as a deploy brings, changes the ETag
+        critical_root = os.path.join(self.published, 'critical')
+        os.makedirs(critical_root)
+        with open(os.path.join(critical_root, 'post.css'), 'w') as css:
+            css.write('body{margin:0}')
+        with self.settings(CRITICAL_CSS_ROOT=critical_root):
+            conditional.build_stamp.cache_clear()
+            self.addCleanup(conditional.build_stamp.cache_clear)
+            caches['default'].clear()
+            response = self.client.get(post.get_absolute_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_post_page_not_modified(self):
+        # Create the post
+        post = PostFactory()
+        tag = TagFactory()
+
+        # Fetch the post
+        response = self.client.get(post.get_absolute_url())
+        etag = response['ETag']
+        response = self.client.get(post.get_absolute_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # Check tagging the post changes its validators
+        post.tags.add(tag)
+        response = self.client.get(post.get_absolute_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('perl' in response.content.decode('utf-8'))
+
+    def test_feed_not_modified(self):
+        # Create the post
+        post = PostFactory()
+
+        # Fetch the feed
+        response = self.client.get('/feeds/posts/')
+        etag = response['ETag']
+        response = self.client.get('/feeds/posts/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # Check deleting a post changes the validators
+        post.delete()
+        response = self.client.get('/feeds/posts/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+class ArchiveViewTest(BaseAcceptanceTest):
+    def test_empty_archive(self):
+        response = self.client.get(reverse('blogengine:post_archive'))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('No posts found' in response.content.decode('utf-8'))
+
+    @override_settings(ARCHIVE_LISTED_MONTHS=1)
+    def test_archive(self):
+        # Create posts in two months
+        PostFactory(pub_date=datetime(2017, 7, 14, 22, 0, tzinfo=timezone.utc))
+        PostFactory(title='My second post', slug='my-second-post',
+                    pub_date=datetime(2017, 7, 20, 22, 0, tzinfo=timezone.utc))
+        PostFactory(title='My old post', slug='my-old-post',
+                    pub_date=datetime(2016, 5, 1, 12, 0, tzinfo=timezone.utc))
+
+        # Check the months are counted in a fixed number of queries
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('blogengine:post_archive'))
+        content = response.content.decode('utf-8')
+        self.assertTrue('July' in content)
+        self.assertTrue('(2)' in content)
+        self.assertTrue('May' in content)
+        self.assertTrue('(1)' in content)
+
+        # Check only the newest month lists its posts
+        self.assertTrue('My second post' in content)
+        self.assertTrue('My old post' not in content)
+        self.assertTrue(reverse('blogengine:post_archive_month', args=('2016', 5)) in content)
+
+        # Check the month archive lists the older post
+        response = self.client.get(reverse('blogengine:post_archive_month', args=('2016', 5)))
+        self.assertTrue('My old post' in response.content.decode('utf-8'))
+        self.assertTrue('My second post' not in response.content.decode('utf-8'))
+
+        # Check the year archive lists all of the year's posts
+        response = self.client.get(reverse('blogengine:post_archive_year', args=('2017',)))
+        self.assertTrue('My first post' in response.content.decode('utf-8'))
+        self.assertTrue('My second post' in response.content.decode('utf-8'))
+        self.assertTrue('My old post' not in response.content.decode('utf-8'))
+
+    def test_nonexistent_month(self):
+        for url in ('/archive/2017/13/', '/archive/0000/', '/archive/9999/', '/archive/9999/12/', '/archive/0000/1/'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 404)
+
+@override_settings(CATEGORY_OVERVIEW_POSTS=5)
+class CategoryOverviewTest(BaseAcceptanceTest):
+    def test_category_overview(self):
+        # Create posts in two categories
+        perl = CategoryFactory(name='perl', description='The Perl programming language', slug='perl')
+        for number in range(7):
+            PostFactory(title='Post number %d' % number, slug='post-number-%d' % number,
+                        pub_date=datetime(2017, 7, number + 1, tzinfo=timezone.utc))
+        PostFactory(title='My perl post', slug='my-perl-post', category=perl)
+
+        # Check the page takes a fixed number of queries
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('blogengine:post_category'))
+        content = response.content.decode('utf-8')
+
+        # Check only the newest posts of each category are listed
+        self.assertTrue('My perl post' in content)
+        self.assertTrue('Post number 6' in content)
+        self.assertTrue('Post number 2' in content)
+        self.assertTrue('Post number 1' not in content)
+        self.assertTrue('All 7 posts' in content)
+
+    def test_category_overview_invalidation(self):
+        post = PostFactory()
+        self.client.get(reverse('blogengine:post_category'))
+
+        # Check editing the text of a post keeps the cached page
+        post.text = 'This is my edited blog post'
+        post.save()
+        with self.assertNumQueries(0):
+            self.client.get(reverse('blogengine:post_category'))
+
+        # Check renaming a post rebuilds it
+        post.title = 'My renamed post'
+        post.save()
+        response = self.client.get(reverse('blogengine:post_category'))
+        self.assertTrue('My renamed post' in response.content.decode('utf-8'))
+
+class PaginationTest(BaseAcceptanceTest):
+    def create_posts(self, number_of_posts):
+        # Posts two at a time share a publication date
+        for number in range(number_of_posts):
+            PostFactory(title='Post number %d' % number, slug='post-number-%d' % number,
+                        pub_date=datetime(2017, 7, number // 2 + 1, tzinfo=timezone.utc))
+
+    def walk(self, url):
+        titles = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            titles.extend(post.title for post in response.context['object_list'])
+            url = response.context['next_page_url']
+        return titles
+
+    def test_cursor_pages(self):
+        self.create_posts(12)
+        expected = [post.title for post in Post.objects.order_by('-pub_date', '-pk')]
+
+        # Check following the next links lists every post once, in order
+        self.assertEqual(self.walk(reverse('blogengine:index')), expected)
+
+        # Check the previous link of the second page leads back to the first
+        caches['default'].clear()
+        response = self.client.get(reverse('blogengine:index'))
+        second = self.client.get(response.context['next_page_url'])
+        first = self.client.get(second.context['previous_page_url'])
+        self.assertEqual(list(first.context['object_list']), list(response.context['object_list']))
+        self.assertEqual(first.context['previous_page_url'], None)
+
+    def test_numbered_pages(self):
+        self.create_posts(12)
+        expected = [post.title for post in Post.objects.order_by('-pub_date', '-pk')]
+
+        # Check a numbered page lists the same posts and links on by cursor
+        response = self.client.get('/2/')
+        self.assertEqual([post.title for post in response.context['object_list']], expected[5:10])
+        self.assertTrue('after=' in response.context['next_page_url'])
+        self.assertTrue('before=' in response.context['previous_page_url'])
+        self.assertEqual(self.walk(response.context['next_page_url']), expected[10:])
+
+        # Check the total count is cached
+        queryset = Post.objects.all()
+        pagination.numbered_page(queryset, 5, 2, 'test', [caching.POSTS])
+        with self.assertNumQueries(1):
+            pagination.numbered_page(queryset, 5, 2, 'test', [caching.POSTS]).object_list[0]
+
+        # Check pages past the end are not found
+        response = self.client.get('/4/')
+        self.assertEqual(response.status_code, 404)
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('blogengine:index') + '?after=wibble')
+        self.assertEqual(response.status_code, 404)
+
+    def test_search_pages(self):
+        self.create_posts(7)
+        # The posts rank equally, so the newest comes first
+        expected = [post.title for post in Post.objects.order_by('-pk')]
+
+        # Check the search pages keep the query
+        self.assertEqual(self.walk(reverse('blogengine:search') + '?q=number'), expected)
+        response = self.client.get(reverse('blogengine:search') + '?q=number&page=2')
+        self.assertEqual([post.title for post in response.context['object_list']], expected[5:])
+        self.assertTrue('q=number' in response.context['previous_page_url'])
+
+@override_settings(SEARCH_BACKEND='blogengine.search_backends.IndexBackend')
+class SearchIndexTest(TestCase):
+    def setUp(self):
+        caches['default'].clear()
+
+    def test_tokenize(self):
+        # Check words are lower cased and stemmed, and stop words dropped
+        self.assertEqual(search.tokenize('The Posting of my posts'), ['post', 'my', 'post'])
+        self.assertEqual(stemmer.stem('relational'), 'relat')
+        self.assertEqual(stemmer.stem('hopping'), 'hop')
+
+    def test_index_follows_posts(self):
+        post = PostFactory()
+
+        # Check the post is indexed when saved
+        self.assertEqual(search.search('first'), [post.pk])
+        self.assertEqual(search.search('posting'), [post.pk])
+
+        # Check an edit replaces its postings
+        post.text = 'This is my edited blog post'
+        post.save()
+        self.assertEqual(search.search('edit'), [post.pk])
+        self.assertEqual(Posting.objects.filter(term='blog').count(), 1)
+
+        # Check deleting the post removes it from the index
+        post.delete()
+        self.assertEqual(search.search('edit'), [])
+        self.assertEqual(Posting.objects.count(), 0)
+
+    def test_ranking(self):
+        # Create posts mentioning python in the text, the title or not at all
+        in_text = PostFactory(title='My first post', slug='my-first-post',
+                              text='Some notes on python and perl')
+        in_title = PostFactory(title='Python notes', slug='python-notes',
+                               text='Some notes on scripting')
+        PostFactory(title='Perl notes', slug='perl-notes', text='Some notes on perl')
+
+        # Check title matches rank first and posts without the term are left out
+        self.assertEqual(search.search('python'), [in_title.pk, in_text.pk])
+        self.assertEqual(search.search('python perl')[0], in_text.pk)
+        self.assertEqual(search.search(''), [])
+
+    def test_rebuild_index(self):
+        post = PostFactory()
+        Posting.objects.all().delete()
+        SearchDocument.objects.all().delete()
+        self.assertEqual(search.search('first'), [])
+
+        # Check the command indexes every post again
+        output = StringIO()
+        call_command('rebuildsearchindex', stdout=output)
+        self.assertTrue('Indexed 1 posts' in output.getvalue())
+        self.assertEqual(search.search('first'), [post.pk])
+
+class SearchBackendTest(TestCase):
+    def create_posts(self):
+        in_text = PostFactory(title='My first post', slug='my-first-post',
+                              text='Some notes on python and perl')
+        in_title = PostFactory(title='Python notes', slug='python-notes',
+                               text='Some notes on scripting')
+        PostFactory(title='Perl notes', slug='perl-notes', text='Some notes on perl')
+        return in_text, in_title
+
+    def test_native_backend(self):
+        # Check SQLite searches through FTS5
+        backend = search_backends.get_backend()
+        self.assertTrue(isinstance(backend, search_backends.SqliteBackend))
+        in_text, in_title = self.create_posts()
+        self.assertEqual(backend.search('python'), [in_title.pk, in_text.pk])
+        self.assertEqual(backend.search('scripts'), [in_title.pk])
+
+        # Check the inverted index is kept up to date too, for switching to it
+        self.assertEqual(search.search('python'), [in_title.pk, in_text.pk])
+
+        # Check the triggers follow edits and deletes
+        in_title.text = 'Some notes on shells'
+        in_title.save()
+        self.assertEqual(backend.search('scripting'), [])
+        in_text.delete()
+        self.assertEqual(backend.search('python'), [in_title.pk])
+        self.assertEqual(backend.rebuild(), 2)
+        self.assertEqual(backend.search('python'), [in_title.pk])
+
+    def test_triggers_installed_after_migrating(self):
+        # Check the triggers dropped by a rebuilt posts table come back
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TRIGGER blogengine_post_fts_insert')
+        call_command('migrate', verbosity=0)
+        post = PostFactory(text='Some notes on python')
+        self.assertEqual(search_backends.get_backend().search('python'), [post.pk])
+
+    def test_contains_backend(self):
+        in_text, in_title = self.create_posts()
+        backend = search_backends.ContainsBackend()
+        self.assertEqual(backend.search('ytho'), [in_title.pk, in_text.pk])
+        self.assertEqual(backend.search(' '), [])
+
+class SuggestTest(BaseAcceptanceTest):
+    def setUp(self):
+        super(SuggestTest, self).setUp()
+        suggest.suggestions.index = None
+
+    def suggest(self, query):
+        response = self.client.get(reverse('blogengine:search_suggest'), {'q': query})
+        self.assertEqual(response.status_code, 200)
+        return [suggestion['label'] for suggestion in json.loads(response.content.decode('utf-8'))['suggestions']]
+
+    def test_prefix_index(self):
+        index = suggest.PrefixIndex()
+        index.add(('post', 1), 'Caching in Django', 'caching')
+        index.add(('tag', 1), 'Django', 'django')
+
+        # Check a prefix of any word finds the label, once
+        self.assertEqual(index.search('DJ', 10), ['caching', 'django'])
+        self.assertEqual(index.search('cach', 10), ['caching'])
+        self.assertEqual(index.search('in dj', 10), ['caching'])
+        self.assertEqual(index.search('', 10), [])
+
+        # Check removed entries are no longer found
+        index.remove(('post', 1))
+        self.assertEqual(index.search('dj', 10), ['django'])
+
+    def test_suggestions(self):
+        post = PostFactory()
+        TagFactory()
+
+        # Check titles and names are suggested
+        self.assertEqual(self.suggest('fir'), ['My first post'])
+        self.assertEqual(self.suggest('p'), ['perl', 'My first post', 'python'])
+
+        # Check the index answers without querying the database
+        with self.assertNumQueries(0):
+            self.assertEqual(self.suggest('my'), ['My first post'])
+
+        # Check changes made in this worker are applied without a rebuild
+        post.title = 'My renamed post'
+        post.save()
+        index = suggest.suggestions.index
+        self.assertEqual(self.suggest('rena'), ['My renamed post'])
+        self.assertTrue(suggest.suggestions.index is index)
+        post.delete()
+        self.assertEqual(self.suggest('rena'), [])
+
+        # Check changes made elsewhere are caught up with, without a rebuild,
+        # deletions too when another row was added meanwhile
+        Tag.objects.filter(name='perl').update(name='perl6', updated_at=timezone.now())
+        suggest.suggestions.index.add(('tag', 0), 'deleted elsewhere', {'label': 'deleted elsewhere'})
+        suggest.log_deletion(('tag', 0))
+        TagFactory(name='django', slug='django')
+        caching.bump(caching.TAGS)
+        self.assertEqual(self.suggest('perl'), ['perl6'])
+        self.assertEqual(self.suggest('deleted'), [])
+        self.assertTrue(suggest.suggestions.index is index)
+
+        # Check the index is rebuilt when the deletions can't be told
+        caches['default'].delete(caching.version_key(suggest.DELETIONS))
+        suggest.log_deletion(('tag', 0))
+        caching.bump(caching.TAGS)
+        self.assertEqual(self.suggest('perl'), ['perl6'])
+        self.assertFalse(suggest.suggestions.index is index)
+
+    def test_rolled_back_changes(self):
+        self.assertEqual(self.suggest('fir'), [])
+
+        # Check a save that is rolled back leaves the index as it was
+        with self.assertRaises(DatabaseError):
+            with transaction.atomic():
+                PostFactory()
+                raise DatabaseError
+        self.assertEqual(self.suggest('fir'), [])
+
+    def test_prefix_index_extend(self):
+        # Check adding at once indexes like adding one by one
+        entries = [(('post', number), 'Post %d about django' % number, number) for number in range(50)]
+        one_by_one = suggest.PrefixIndex()
+        for entry in entries:
+            one_by_one.add(*entry)
+        at_once = suggest.PrefixIndex()
+        at_once.extend(entries)
+        at_once.extend(entries[:10])
+        self.assertEqual(at_once.keys, one_by_one.keys)
+        at_once.remove_all([('post', number) for number in range(10)])
+        self.assertEqual(at_once.search('post 1', 3), [10, 11, 12])
+
 class FlatPageViewTest(BaseAcceptanceTest):
     def test_create_flat_page(self):
         # Create flat page
@@ -799,6 +1871,12 @@ class FlatPageViewTest(BaseAcceptanceTest):
         self.assertTrue('About me' in response.content.decode('utf-8'))
         self.assertTrue('All about me' in response.content.decode('utf-8'))
 
+def response_content(response):
+    '''the body of a response, published feeds being streamed from their file'''
+    if response.streaming:
+        return b''.join(response.streaming_content)
+    return response.content
+
 class FeedTest(BaseAcceptanceTest):
     def test_all_post_feed(self):
         # Create the category
@@ -831,7 +1909,7 @@ class FeedTest(BaseAcceptanceTest):
         self.assertEqual(response.status_code, 200)
 
         # Parse the feed
-        feed = feedparser.parse(response.content.decode('utf-8'))
+        feed = feedparser.parse(response_content(response).decode('utf-8'))
 
         # Check length
         self.assertEqual(len(feed.entries), 1)
@@ -841,6 +1919,310 @@ class FeedTest(BaseAcceptanceTest):
         self.assertEqual(feed_post.title, post.title)
         self.assertTrue('This is my <em>first</em> blog post' in feed_post.description)
 
+    @override_settings(FEED_ITEMS=3)
+    def test_feed_capped_and_cached(self):
+        for number in range(5):
+            PostFactory(title='Post number %d' % number, slug='post-number-%d' % number,
+                        pub_date=datetime(2017, 7, number + 1, tzinfo=timezone.utc))
+
+        # Check only the newest posts are in the feed
+        response = self.client.get('/feeds/posts/')
+        feed = feedparser.parse(response_content(response).decode('utf-8'))
+        self.assertEqual([entry.title for entry in feed.entries],
+                         ['Post number 4', 'Post number 3', 'Post number 2'])
+
+        # Check the serialized feed is served from the cache
+        request = RequestFactory().get('/feeds/posts/')
+        content = PostsFeed()(request).content
+        with self.assertNumQueries(0):
+            self.assertEqual(PostsFeed()(request).content, content)
+
+        # Check a new post invalidates it
+        PostFactory(title='Post number 5', slug='post-number-5',
+                    pub_date=datetime(2017, 7, 6, tzinfo=timezone.utc))
+        feed = feedparser.parse(PostsFeed()(request).content.decode('utf-8'))
+        self.assertEqual(feed.entries[0].title, 'Post number 5')
+
+    def test_category_and_tag_feeds(self):
+        perl = CategoryFactory(name='perl', description='The Perl programming language', slug='perl')
+        tag = TagFactory(name='django', description='The Django framework', slug='django')
+        post = PostFactory()
+        post.tags.add(tag)
+        PostFactory(title='My perl post', slug='my-perl-post', category=perl)
+
+        # Check each feed only has its own posts
+        response = self.client.get(reverse('blogengine:category_feed', kwargs={'slug': 'perl'}))
+        feed = feedparser.parse(response_content(response).decode('utf-8'))
+        self.assertEqual([entry.title for entry in feed.entries], ['My perl post'])
+        self.assertTrue('perl' in feed.feed.title)
+        response = self.client.get(reverse('blogengine:tag_feed', kwargs={'slug': 'django'}))
+        feed = feedparser.parse(response_content(response).decode('utf-8'))
+        self.assertEqual([entry.title for entry in feed.entries], ['My first post'])
+
+        # Check tagging a post invalidates the tag feed
+        post2 = PostFactory(title='My second post', slug='my-second-post')
+        post2.tags.add(tag)
+        response = self.client.get(reverse('blogengine:tag_feed', kwargs={'slug': 'django'}))
+        feed = feedparser.parse(response_content(response).decode('utf-8'))
+        self.assertEqual(len(feed.entries), 2)
+
+        # Check missing categories have no feed
+        response = self.client.get(reverse('blogengine:category_feed', kwargs={'slug': 'blah'}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_published_feeds(self):
+        post = PostFactory(text='This is my *first* blog post')
+
+        # Check every format was published, compressed too
+        for name in ['posts.rss', 'posts.atom', 'posts.json', 'posts.rss.gz']:
+            self.assertTrue(os.path.exists(os.path.join(self.published, 'feeds', name)))
+
+        # Check the feeds are served without querying the database
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('blogengine:feed_format', kwargs={'format': 'json'}))
+        self.assertEqual(response['Content-Type'], 'application/feed+json; charset=utf-8')
+        feed = json.loads(response_content(response).decode('utf-8'))
+        self.assertEqual(feed['items'][0]['title'], post.title)
+        response = self.client.get(reverse('blogengine:feed_format', kwargs={'format': 'atom'}))
+        feed = feedparser.parse(response_content(response))
+        self.assertEqual(feed.entries[0].title, post.title)
+
+        # Check each feed links to itself, over the scheme of the site
+        domain = Site.objects.get_current().domain
+        self.assertEqual([link.href for link in feed.feed.links if link.rel == 'self'],
+                         ['https://%s/feeds/posts.atom' % domain])
+        self.assertTrue(feed.entries[0].link.startswith('https://'))
+        with open(os.path.join(self.published, 'feeds', 'posts.json'), encoding='utf-8') as published:
+            self.assertEqual(json.load(published)['feed_url'], 'https://%s/feeds/posts.json' % domain)
+
+        # Check the precompressed variant is served to clients accepting it
+        response = self.client.get(reverse('blogengine:feed'), HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        feed = feedparser.parse(gzip.decompress(response_content(response)))
+        self.assertEqual(feed.entries[0].title, post.title)
+        response = self.client.get(reverse('blogengine:feed'), HTTP_ACCEPT_ENCODING='gzip',
+                                   HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        # Check a new post publishes the feeds again
+        PostFactory(title='My second post', slug='my-second-post')
+        response = self.client.get(reverse('blogengine:feed_format', kwargs={'format': 'json'}))
+        feed = json.loads(response_content(response).decode('utf-8'))
+        self.assertEqual(len(feed['items']), 2)
+
+        # Check posts rendered again on deploy are published too
+        Post.objects.filter(pk=post.pk).update(text='This is my *edited* blog post')
+        call_command('migrate', verbosity=0)
+        with open(os.path.join(self.published, 'feeds', 'posts.json'), encoding='utf-8') as published:
+            self.assertTrue('<em>edited</em>' in json.load(published)['items'][1]['content_html'])
+
+    def test_unpublished_feed(self):
+        post = PostFactory()
+
+        # Check the feed is built when it wasn't published
+        with override_settings(PUBLISHED_FEEDS_ROOT=None):
+            response = self.client.get(reverse('blogengine:feed_format', kwargs={'format': 'json'}))
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['items'][0]['title'], post.title)
+
+@override_settings(SITEMAP_URLS_PER_FILE=2)
+class SitemapTest(BaseAcceptanceTest):
+    def locations(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        root = ElementTree.fromstring(response_content(response))
+        namespace = '{http://www.sitemaps.org/schemas/sitemap/0.9}'
+        return [(element.find(namespace + 'loc').text,
+                 element.find(namespace + 'lastmod') is not None) for element in root]
+
+    def test_sitemap(self):
+        for number in range(3):
+            post = PostFactory(title='Post number %d' % number, slug='post-number-%d' % number,
+                               pub_date=datetime(2017, 7, number + 1, tzinfo=timezone.utc))
+        post.tags.add(TagFactory())
+        FlatPageFactory().sites.add(Site.objects.get_current())
+
+        # Check the index links to each shard, with a lastmod where known
+        def shard_url(section, row):
+            return 'http://example.com/sitemap-%s-%d.xml' % (section, (row.pk - 1) // 2)
+
+        posts = list(Post.objects.order_by('pk'))
+        expected = []
+        for post in posts:
+            if (shard_url('posts', post), True) not in expected:
+                expected.append((shard_url('posts', post), True))
+        expected.append((shard_url('categories', Category.objects.get()), True))
+        expected.append((shard_url('tags', Tag.objects.get()), True))
+        expected.append((shard_url('pages', FlatPage.objects.get()), False))
+        self.assertEqual(self.locations(reverse('blogengine:sitemap')), expected)
+
+        # Check the shards list the urls
+        by_shard = {}
+        for post in posts:
+            by_shard.setdefault(shard_url('posts', post), []).append(
+                ('http://example.com' + post.get_absolute_url(), True))
+        for url, locations in by_shard.items():
+            self.assertEqual(self.locations(url.replace('http://example.com', '')), locations)
+        self.assertEqual(self.locations(shard_url('tags', Tag.objects.get()).replace('http://example.com', '')),
+                         [('http://example.com/tag/perl/', True)])
+        self.assertEqual(self.locations(shard_url('pages', FlatPage.objects.get()).replace('http://example.com', '')),
+                         [('http://example.com/about/', False)])
+
+        response = self.client.get('/sitemap-wibble-0.xml')
+        self.assertEqual(response.status_code, 404)
+
+        # Check shards past the last one are not found
+        response = self.client.get(reverse('blogengine:sitemap_section', kwargs={'section': 'posts', 'shard': 9}))
+        self.assertEqual(response.status_code, 404)
+
+class ExportTest(BaseAcceptanceTest):
+    def setUp(self):
+        super(ExportTest, self).setUp()
+        self.directory = os.path.join(self.published, 'site')
+
+    def export(self, **options):
+        call_command('exportsite', self.directory, processes=1, stdout=StringIO(), **options)
+        with open(os.path.join(self.directory, export.MANIFEST)) as manifest:
+            return json.load(manifest)
+
+    def read(self, path):
+        with open(os.path.join(self.directory, path), 'rb') as page:
+            return page.read().decode('utf-8')
+
+    def test_export(self):
+        tag = TagFactory()
+        for number in range(7):
+            post = PostFactory(title='Post number %d' % number, slug='post-number-%d' % number,
+                               pub_date=datetime(2017, 7, number + 1, tzinfo=timezone.utc))
+            post.tags.add(tag)
+        FlatPageFactory().sites.add(Site.objects.get_current())
+
+        manifest = self.export()
+
+        # Check every public page is written, listings numbering their pages
+        # from the oldest post, and the first page taking in the newest page
+        # while it isn't full
+        self.assertTrue('Post number 6' in self.read('index.html'))
+        self.assertTrue('Post number 0' in self.read('index.html'))
+        self.assertFalse('href="/1/"' in self.read('index.html'))
+        self.assertTrue('Post number 0' in self.read('1/index.html'))
+        self.assertFalse('Post number 5' in self.read('1/index.html'))
+        self.assertTrue('href="/2/"' in self.read('1/index.html'))
+        self.assertTrue('Post number 6' in self.read('2/index.html'))
+        self.assertTrue('href="/1/"' in self.read('2/index.html'))
+        self.assertTrue('Post number 3' in self.read('2017/7/post-number-3/index.html'))
+        self.assertTrue('href="/category/python/1/"' in self.read('category/python/2/index.html'))
+        self.assertTrue('Post number 0' in self.read('category/python/1/index.html'))
+        self.assertTrue('Post number 0' in self.read('tag/perl/1/index.html'))
+        self.assertTrue('<rss' in self.read('category/python/feed/index.xml'))
+        self.assertTrue('<rss' in self.read('feeds/posts/index.xml'))
+        self.assertTrue('<feed' in self.read('feeds/posts.atom'))
+        self.assertTrue('Post number 6' in self.read('archive/2017/7/index.html'))
+        self.assertTrue('All about me' in self.read('about/index.html'))
+        self.assertTrue('/2017/7/post-number-3/' in self.read('sitemap-posts-0.xml'))
+        self.assertTrue(os.path.exists(os.path.join(self.directory, 'index.html.gz')))
+        self.assertEqual(manifest['/']['path'], 'index.html')
+
+        # Check nothing is written again while nothing changed
+        mtime = os.stat(os.path.join(self.directory, 'index.html')).st_mtime_ns
+        output = StringIO()
+        call_command('exportsite', self.directory, processes=1, stdout=output)
+        self.assertTrue('Wrote 0 pages' in output.getvalue())
+        self.assertEqual(os.stat(os.path.join(self.directory, 'index.html')).st_mtime_ns, mtime)
+
+        # Check a change outside the database, like new critical css, renders the pages again
+        critical_root = os.path.join(self.published, 'critical')
+        os.makedirs(critical_root)
+        with open(os.path.join(critical_root, 'index.css'), 'w') as css:
+            css.write('body{margin:0}')
+        with self.settings(CRITICAL_CSS_ROOT=critical_root):
+            output = StringIO()
+            call_command('exportsite', self.directory, processes=1, stdout=output)
+        self.assertTrue('<style>body{margin:0}</style>' in self.read('index.html'))
+        self.assertFalse('<style>' in self.read('2017/7/post-number-3/index.html'))
+
+        # Check an edit rewrites its pages, and pages that went away are removed
+        post = Post.objects.get(slug='post-number-3')
+        post.title = 'Edited post'
+        post.save()
+        Post.objects.filter(slug__in=['post-number-0', 'post-number-1']).delete()
+        manifest = self.export()
+        self.assertTrue('Edited post' in self.read('2017/7/post-number-3/index.html'))
+        self.assertFalse(os.path.exists(os.path.join(self.directory, '2017/7/post-number-0/index.html')))
+        self.assertFalse('/2017/7/post-number-0/' in manifest)
+        self.assertFalse('/2/' in manifest)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, '2/index.html')))
+
+    def test_regenerated_pages(self):
+        for number in range(30):
+            PostFactory(title='Post number %d' % number, slug='post-number-%d' % number,
+                        pub_date=datetime(2017, 1, number + 1, tzinfo=timezone.utc))
+        post = PostFactory(title='New post', slug='new-post', pub_date=datetime(2017, 2, 1, tzinfo=timezone.utc))
+
+        def listing_urls(urls):
+            return sorted(url for url in urls if re.match(r'^/((category|tag)/[\w-]+/?)?(\d+/)?$', url))
+
+        # Check publishing a post into listings of six full pages only
+        # changes their first page, the page it starts and the page before
+        urls = regenerate.affected_urls(post.pk, None, regenerate.post_state(post.pk))
+        self.assertEqual(listing_urls(urls), ['/', '/6/', '/7/', '/category/python',
+                                              '/category/python/6/', '/category/python/7/'])
+
+        # Check publishing another only changes the newest page
+        second = PostFactory(title='Second post', slug='second-post',
+                             pub_date=datetime(2017, 2, 2, tzinfo=timezone.utc))
+        urls = regenerate.affected_urls(second.pk, None, regenerate.post_state(second.pk))
+        self.assertEqual(listing_urls(urls), ['/', '/7/', '/category/python', '/category/python/7/'])
+
+    def test_manifest_lock(self):
+        # Check other processes can't take the manifest while it is held
+        with export.locked_manifest(self.directory):
+            with open(os.path.join(self.directory, export.LOCK)) as lock:
+                with self.assertRaises(BlockingIOError):
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        with open(os.path.join(self.directory, export.LOCK)) as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def test_regenerate(self):
+        for number in range(7):
+            PostFactory(title='Post number %d' % number, slug='post-number-%d' % number,
+                        pub_date=datetime(2017, number + 1, 1, tzinfo=timezone.utc))
+        self.export()
+
+        def mtimes():
+            return dict((url, os.stat(os.path.join(self.directory, entry['path'])).st_mtime_ns)
+                        for url, entry in self.export().items())
+
+        with self.settings(EXPORT_ROOT=self.directory):
+            # Check editing a post only rewrites its own pages
+            before = mtimes()
+            post = Post.objects.get(slug='post-number-6')
+            post.title = 'Edited post'
+            post.save()
+            regenerate.regenerator.wait()
+            self.assertTrue('Edited post' in self.read('2017/7/post-number-6/index.html'))
+            self.assertTrue('Edited post' in self.read('index.html'))
+            self.assertTrue('Edited post' in self.read('archive/2017/7/index.html'))
+            self.assertEqual(before['/1/'], mtimes()['/1/'])
+            self.assertEqual(before['/archive/2017/1'], mtimes()['/archive/2017/1'])
+
+            # Check tagging a post adds it to the tag's listing
+            tag = TagFactory()
+            post.tags.add(tag)
+            regenerate.regenerator.wait()
+            self.assertTrue('Edited post' in self.read('tag/perl/index.html'))
+
+            # Check deleting a post removes its page and shifts the listings.
+            # The in-memory test database can't be written while the
+            # regenerating thread reads it, so let it finish each time.
+            Post.objects.get(slug='post-number-0').delete()
+            regenerate.regenerator.wait()
+            Post.objects.get(slug='post-number-1').delete()
+            regenerate.regenerator.wait()
+            self.assertFalse(os.path.exists(os.path.join(self.directory, '2017/1/post-number-0/index.html')))
+            self.assertFalse(os.path.exists(os.path.join(self.directory, '2/index.html')))
+            self.assertTrue('Post number 2' in self.read('index.html'))
+
 class SearchViewTest(BaseAcceptanceTest):
     def test_search(self):
         # Create a post
@@ -871,6 +2253,39 @@ class SearchViewTest(BaseAcceptanceTest):
         # Check the second post is contained in the results
         self.assertTrue('My second post' in response.content.decode('utf-8'))
 
+    def test_search_results_cached(self):
+        post = PostFactory()
+
+        # Check queries differing in case and spacing share their results
+        self.assertEqual(search_backends.search_posts('First'), [post.pk])
+        with self.assertNumQueries(0):
+            self.assertEqual(search_backends.search_posts(' FIRST  '), [post.pk])
+
+        # Check the results are invalidated when a post changes
+        post2 = PostFactory(text='This is my *second* blog post, after the first',
+                            title='My second post',
+                            slug='my-second-post')
+        self.assertEqual(search_backends.search_posts('first'), [post.pk, post2.pk])
+
+    def test_search_snippets(self):
+        PostFactory(text='An introduction. ' + 'Filler words here. ' * 20 +
+                         'Caching a *rendered* page in the [page cache](/cache/). ' +
+                         'More filler words. ' * 20)
+
+        # Check the result shows the best window, without markup, highlighted
+        response = self.client.get(reverse('blogengine:search') + '?q=cached+page')
+        content = response.content.decode('utf-8')
+        self.assertTrue('<mark>Caching</mark> a rendered <mark>page</mark> in the <mark>page</mark> <mark>cache.</mark>' in content)
+        self.assertTrue('An introduction' not in content)
+        self.assertTrue('<em>' not in content)
+
+    def test_snippet(self):
+        # Check the text is escaped and falls back to its start
+        self.assertEqual(snippets.snippet('<b> & more words', 'missing', size=2),
+                         '&lt;b&gt; &amp; &hellip;')
+        self.assertEqual(snippets.snippet('one two three four', 'four', size=2),
+                         '&hellip; three <mark>four</mark>')
+
     def test_failing_search(self):
         # Search for something that is not present
         response = self.client.get(reverse('blogengine:search') + '?q=wibble')
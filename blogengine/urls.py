@@ -1,49 +1,83 @@
 from django.conf.urls import url
-from django.views.generic import ListView, DetailView
 from blogengine.models import Post, Category, Tag
-from blogengine.views import CategoryListView, TagListView, PostsFeed, getSearchResults, posts_archive, posts_category
+from blogengine.conditional import (
+    conditional, index_state, post_state, category_state, tag_state,
+    archive_state, categories_page_state, category_feed_state,
+    tag_feed_state, sitemap_state,
+)
+from blogengine.pagination import PAGE_SIZE
+from blogengine.querybudget import query_budget
+from blogengine.views import PostListView, PostDetailView, CategoryListView, TagListView, CategoryPostsFeed, TagPostsFeed, published_feed, getSearchResults, search_suggestions, sitemap_index, sitemap_section, posts_archive, posts_archive_year, posts_archive_month, posts_category
 
 urlpatterns = [
     # Index
-    url(r'^(?P<page>\d+)?/?$', ListView.as_view(
+    url(r'^(?P<page>\d+)?/?$', query_budget(6)(conditional(index_state)(PostListView.as_view(
         model=Post,
-        paginate_by=5,
-        ),
+        paginate_by=PAGE_SIZE,
+        ))),
         name='index'
         ),
 
     # Individual posts
-    url(r'^(?P<pub_date__year>\d{4})/(?P<pub_date__month>\d{1,2})/(?P<slug>[a-zA-Z0-9-]+)/?$', DetailView.as_view(
+    url(r'^(?P<pub_date__year>\d{4})/(?P<pub_date__month>\d{1,2})/(?P<slug>[a-zA-Z0-9-]+)/?$', query_budget(3)(conditional(post_state)(PostDetailView.as_view(
         model=Post,
-        ),
+        ))),
         name='post'
         ),
 
     # Categories
-    url(r'^category/(?P<slug>[a-zA-Z0-9-]+)/?$', CategoryListView.as_view(
+    url(r'^category/(?P<slug>[a-zA-Z0-9-]+)/?$', query_budget(7)(conditional(category_state)(CategoryListView.as_view(
         model=Category,
-        paginate_by=5,
-        ),
+        paginate_by=PAGE_SIZE,
+        ))),
         name='category'
         ),
 
+    url(r'^category/(?P<slug>[a-zA-Z0-9-]+)/(?P<page>\d+)/$', query_budget(7)(conditional(category_state)(CategoryListView.as_view(
+        model=Category,
+        paginate_by=PAGE_SIZE,
+        ))),
+        name='category_page'
+        ),
+
     # Tags
-    url(r'^tag/(?P<slug>[a-zA-Z0-9-]+)/?$', TagListView.as_view(
+    url(r'^tag/(?P<slug>[a-zA-Z0-9-]+)/?$', query_budget(7)(conditional(tag_state)(TagListView.as_view(
         model=Tag,
-        paginate_by=5,
-        ),
+        paginate_by=PAGE_SIZE,
+        ))),
         name='tag'
         ),
 
-    # Post RSS feed
-    url(r'^feeds/posts/$', PostsFeed()),
+    url(r'^tag/(?P<slug>[a-zA-Z0-9-]+)/(?P<page>\d+)/$', query_budget(7)(conditional(tag_state)(TagListView.as_view(
+        model=Tag,
+        paginate_by=PAGE_SIZE,
+        ))),
+        name='tag_page'
+        ),
+
+    # Post RSS, Atom and JSON feeds, as published when posts change
+    url(r'^feeds/posts/$', query_budget(3)(published_feed), name='feed'),
+    url(r'^feeds/posts\.(?P<format>rss|atom|json)$', query_budget(3)(published_feed), name='feed_format'),
+
+    # Category and tag RSS feeds
+    url(r'^category/(?P<slug>[a-zA-Z0-9-]+)/feed/$', query_budget(4)(conditional(category_feed_state)(CategoryPostsFeed())), name='category_feed'),
+    url(r'^tag/(?P<slug>[a-zA-Z0-9-]+)/feed/$', query_budget(4)(conditional(tag_feed_state)(TagPostsFeed())), name='tag_feed'),
+
+    # Sitemaps, streamed while they are read from the database
+    url(r'^sitemap\.xml$', query_budget(5)(conditional(sitemap_state)(sitemap_index)), name='sitemap'),
+    url(r'^sitemap-(?P<section>posts|categories|tags|pages)-(?P<shard>\d+)\.xml$', query_budget(5)(conditional(sitemap_state)(sitemap_section)), name='sitemap_section'),
+
+    # Search suggestions, only querying the database to build the prefix index
+    url(r'^search/suggest/?$', query_budget(3)(search_suggestions), name='search_suggest'),
 
     # Search posts
-    url(r'^search', getSearchResults, name='search'),
+    url(r'^search', query_budget(7)(conditional(index_state)(getSearchResults)), name='search'),
 
     # Archive post
-     url(r'^archive/?$', posts_archive, name="post_archive"),
+     url(r'^archive/?$', query_budget(3)(conditional(archive_state)(posts_archive)), name="post_archive"),
+     url(r'^archive/(?P<year>\d{4})/?$', query_budget(3)(conditional(archive_state)(posts_archive_year)), name="post_archive_year"),
+     url(r'^archive/(?P<year>\d{4})/(?P<month>\d{1,2})/?$', query_budget(3)(conditional(archive_state)(posts_archive_month)), name="post_archive_month"),
 
     # Category post
-     url(r'^categories/?$', posts_category, name="post_category"),
+     url(r'^categories/?$', query_budget(4)(conditional(categories_page_state)(posts_category)), name="post_category"),
 ]
@@ -1,49 +1,245 @@
 from django.shortcuts import get_object_or_404, render_to_response
-from django.core.paginator import Paginator, EmptyPage
-from django.db.models import Q
-from django.views.generic import ListView
+from django.core.urlresolvers import reverse
+from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.conf import settings
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.db.models.functions import TruncMonth
+from django.core.exceptions import ObjectDoesNotExist
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.encoding import force_bytes
+from django.utils import timezone
+from django.views.generic import ListView, DetailView
 from blogengine.models import Category, Post, Tag
+from blogengine import caching, pagination, publish, search_backends, sitemaps, snippets, suggest
+from blogengine.conditional import conditional, feed_state
 from django.contrib.syndication.views import Feed
-from django.utils.encoding import force_str
-from django.utils.safestring import mark_safe
-import markdown2
+from django.utils.feedgenerator import Atom1Feed
 import datetime
+import hashlib
+import itertools
 
 # Create your views here.
-class CategoryListView(ListView):
+class CacheDependencyMixin(object):
+    '''records what the page depends on, for the page cache middleware'''
+    cache_dependencies = (caching.POSTS, caching.CATEGORIES, caching.TAGS)
+
+    def get_cache_dependencies(self):
+        return self.cache_dependencies
+
+    def get(self, request, *args, **kwargs):
+        caching.add_dependencies(request, *self.get_cache_dependencies())
+        return super(CacheDependencyMixin, self).get(request, *args, **kwargs)
+
+class CursorPaginationMixin(object):
+    '''
+    Paginates a post listing by cursor on (pub_date, id), so that deep pages
+    cost as much as the first one. Numbered pages are still served, with the
+    total count taken from the cache, and are the only kind of page when
+    NUMBERED_PAGE_LINKS is set. The static export numbers its pages from
+    the oldest post instead, see pagination.anchored_page.
+    '''
+    # The listing, 'index', 'category' or 'tag', naming its urls and the
+    # cached count of its posts
+    listing_name = 'index'
+
+    def get_count_key(self):
+        slug = self.kwargs.get('slug')
+        return '%s:%s' % (self.listing_name, slug) if slug else self.listing_name
+
+    def get_page_url(self, number=None):
+        '''url of the listing, or of its numbered page'''
+        slug = self.kwargs.get('slug')
+        return pagination.listing_url(self.listing_name, number, **({'slug': slug} if slug else {}))
+
+    def paginate_queryset(self, queryset, page_size):
+        number = self.kwargs.get(self.page_kwarg) or self.request.GET.get(self.page_kwarg)
+        if getattr(self.request, 'static_export', False):
+            page = pagination.anchored_page(queryset, page_size, number, self.get_count_key(),
+                                            caching.get_dependencies(self.request).keys())
+            return (None, page, page.object_list, page.has_other_pages())
+        if number or pagination.numbered_page_links(self.request):
+            page = pagination.numbered_page(queryset, page_size, number or 1, self.get_count_key(),
+                                            caching.get_dependencies(self.request).keys())
+            return (page.paginator, page, page.object_list, page.has_other_pages())
+        page = pagination.cursor_page(queryset, page_size,
+                                      after=self.request.GET.get('after'),
+                                      before=self.request.GET.get('before'))
+        return (None, page, page.object_list, page.has_other_pages())
+
+    def get_context_data(self, **kwargs):
+        context = super(CursorPaginationMixin, self).get_context_data(**kwargs)
+        page = context.get('page_obj')
+        if page is not None:
+            if isinstance(page, pagination.AnchoredPage):
+                context.update(pagination.anchored_links(page, self.get_page_url))
+            elif pagination.numbered_page_links(self.request):
+                context.update(pagination.path_links(page, self.get_page_url))
+            else:
+                context.update(pagination.page_links(page, self.get_page_url()))
+        return context
+
+class PostListView(CacheDependencyMixin, CursorPaginationMixin, ListView):
+    def get_queryset(self):
+        return Post.objects.for_listing()
+
+class PostDetailView(CacheDependencyMixin, DetailView):
+    def get_queryset(self):
+        return Post.objects.for_listing()
+
+    def get_object(self, queryset=None):
+        post = super(PostDetailView, self).get_object(queryset)
+        dependencies = [caching.post_dependency(post.pk)]
+        if post.category_id is not None:
+            dependencies.append(caching.category_dependency(post.category_id))
+        for tag in post.tags.all():
+            dependencies.append(caching.tag_dependency(tag.pk))
+        caching.add_dependencies(self.request, *dependencies)
+        return post
+
+    def get_cache_dependencies(self):
+        return ()
+
+class CategoryListView(CacheDependencyMixin, CursorPaginationMixin, ListView):
+    listing_name = 'category'
+
     def get_queryset(self):
         slug = self.kwargs['slug']
         try:
             category = Category.objects.get(slug=slug)
-            return Post.objects.filter(category=category)
+            caching.add_dependencies(self.request,
+                                     caching.category_dependency(category.pk),
+                                     caching.TAGS)
+            return Post.objects.for_listing().filter(category=category)
         except Category.DoesNotExist:
             return Post.objects.none()
 
-class TagListView(ListView):
+    def get_cache_dependencies(self):
+        return (caching.CATEGORIES,)
+
+class TagListView(CacheDependencyMixin, CursorPaginationMixin, ListView):
+    listing_name = 'tag'
+
     def get_queryset(self):
         slug = self.kwargs['slug']
         try:
             tag = Tag.objects.get(slug=slug)
-            return tag.post_set.all()
+            caching.add_dependencies(self.request,
+                                     caching.tag_dependency(tag.pk),
+                                     caching.CATEGORIES)
+            return Post.objects.for_listing().filter(tags=tag)
         except Tag.DoesNotExist:
             return Post.objects.none()
 
+    def get_cache_dependencies(self):
+        return (caching.TAGS,)
+
+def feed_items():
+    return getattr(settings, 'FEED_ITEMS', 20)
+
 class PostsFeed(Feed):
+    '''
+    Feed of the newest posts. The serialized feed is cached until one of its
+    dependencies is invalidated, and the items use the html stored on posts.
+    '''
     title = "Jeff Qian's Blog"
     link = '/'
     description = "Jeff Qian's Blog"
 
+    def __call__(self, request, *args, **kwargs):
+        try:
+            obj = self.get_object(request, *args, **kwargs)
+        except ObjectDoesNotExist:
+            raise Http404('Feed object does not exist.')
+        dependencies = self.get_cache_dependencies(obj)
+        caching.add_dependencies(request, *dependencies)
+
+        def build():
+            feedgen = self.get_feed(obj, request)
+            return {'content': feedgen.writeString('utf-8'),
+                    'content_type': feedgen.content_type}
+
+        url = hashlib.md5(force_bytes(request.build_absolute_uri()))
+        feed = caching.cached('blogengine:feed:%s' % url.hexdigest(), dependencies, build)
+        return HttpResponse(feed['content'], content_type=feed['content_type'])
+
+    def get_cache_dependencies(self, obj):
+        return [caching.POSTS]
+
     def items(self):
-        return Post.objects.order_by('-pub_date')
+        return Post.objects.order_by(*pagination.ORDERING)[:feed_items()]
 
     def item_title(self, item):
         return item.title
 
     def item_description(self, item):
-        extras = ["fenced-code-blocks"]
-        content = mark_safe(markdown2.markdown(force_str(item.text),
-                                               extras = extras))
-        return content
+        return item.html
+
+class AtomPostsFeed(PostsFeed):
+    feed_type = Atom1Feed
+    subtitle = PostsFeed.description
+
+def json_feed(request):
+    '''the posts feed as a JSON Feed'''
+    caching.add_dependencies(request, caching.POSTS)
+    return HttpResponse(publish.json_feed(request), content_type=publish.CONTENT_TYPES['json'])
+
+# Views building each format of the posts feed, for when it isn't published
+DYNAMIC_FEEDS = {
+    'rss': conditional(feed_state)(PostsFeed()),
+    'atom': conditional(feed_state)(AtomPostsFeed()),
+    'json': conditional(feed_state)(json_feed),
+}
+
+def published_feed(request, format='rss'):
+    '''
+    The posts feed as written by blogengine.publish when posts change, so
+    serving it runs no queries. Builds the feed when it isn't published.
+    '''
+    path = publish.feed_path(format)
+    response = None
+    if path is not None:
+        response = publish.serve(request, path, publish.CONTENT_TYPES[format])
+    if response is None:
+        response = DYNAMIC_FEEDS[format](request)
+    return response
+
+class CategoryPostsFeed(PostsFeed):
+    def get_object(self, request, slug):
+        return Category.objects.get(slug=slug)
+
+    def get_cache_dependencies(self, category):
+        return [caching.category_dependency(category.pk)]
+
+    def title(self, category):
+        return "Jeff Qian's Blog: %s" % category.name
+
+    def link(self, category):
+        return category.get_absolute_url()
+
+    def description(self, category):
+        return category.description
+
+    def items(self, category):
+        return Post.objects.filter(category=category).order_by(*pagination.ORDERING)[:feed_items()]
+
+class TagPostsFeed(PostsFeed):
+    def get_object(self, request, slug):
+        return Tag.objects.get(slug=slug)
+
+    def get_cache_dependencies(self, tag):
+        return [caching.tag_dependency(tag.pk)]
+
+    def title(self, tag):
+        return "Jeff Qian's Blog: %s" % tag.name
+
+    def link(self, tag):
+        return tag.get_absolute_url()
+
+    def description(self, tag):
+        return tag.description
+
+    def items(self, tag):
+        return Post.objects.filter(tags=tag).order_by(*pagination.ORDERING)[:feed_items()]
 
 def getSearchResults(request):
     """
@@ -53,65 +249,159 @@ def getSearchResults(request):
     #Get the query data
     query = request.GET.get('q', '')
     page = request.GET.get('page', 1)
+    caching.add_dependencies(request, caching.POSTS, caching.CATEGORIES, caching.TAGS)
 
-    #Query the database
-    results = Post.objects.filter(Q(text__icontains=query) | Q(title__icontains=query))
+    #Rank the matching posts with the search backend, or take them from the cache
+    results = search_backends.search_posts(query)
 
     #Add pagination
-    pages = Paginator(results, 5)
+    pages = Paginator(results, pagination.PAGE_SIZE)
 
     # Get specified page
     try:
         returned_page = pages.page(page)
     except EmptyPage:
         returned_page = pages.page(pages.num_pages)
+    except PageNotAnInteger:
+        raise Http404('Invalid page')
+
+    # Fetch the posts of the page, in rank order, with a snippet instead of their body
+    posts = (Post.objects.for_listing().defer('text', 'rendered_text')
+             .in_bulk(returned_page.object_list))
+    returned_page.object_list = [posts[pk] for pk in returned_page.object_list if pk in posts]
+    for post in returned_page.object_list:
+        post.snippet = snippets.snippet(post.plain_text, query)
 
     # Display the search results
-    return render_to_response('blogengine/search_post_list.html',
-                              {'page_obj': returned_page,
-                               'object_list': returned_page.object_list,
-                               'search': query})
+    context = {'page_obj': returned_page,
+               'object_list': returned_page.object_list,
+               'search': query}
+    context.update(pagination.number_links(returned_page, reverse('blogengine:search'), q=query))
+    return render_to_response('blogengine/search_post_list.html', context)
+
+def search_suggestions(request):
+    '''titles of posts and names of categories and tags completing a partial query, as json'''
+    query = request.GET.get('q', '')
+    caching.add_dependencies(request, *suggest.DEPENDENCIES)
+    return JsonResponse({'query': query,
+                         'suggestions': suggest.suggestions.suggest(query)})
+
+def archive_months(queryset):
+    '''(month, number of posts) pairs, newest first, counted by the database'''
+    return (queryset.order_by()
+            .annotate(month=TruncMonth('pub_date', tzinfo=timezone.utc))
+            .values_list('month')
+            .annotate(count=Count('pk'))
+            .order_by('-month'))
+
+def month_range(year, month):
+    '''start and end of a month, as used by post urls, a 404 when there is no such month'''
+    if not datetime.MINYEAR <= year < datetime.MAXYEAR or not 1 <= month <= 12:
+        raise Http404
+    start = datetime.datetime(year, month, 1, tzinfo=timezone.utc)
+    if month == 12:
+        end = start.replace(year=year + 1, month=1)
+    else:
+        end = start.replace(month=month + 1)
+    return start, end
+
+def build_archive(queryset, listed_months):
+    '''
+    Group the posts of queryset by year and month. Only the newest
+    listed_months months list their posts, the others link to their
+    month archive.
+    '''
+    months = list(archive_months(queryset))
+    posts = {}
+    if months and listed_months:
+        since = months[:listed_months][-1][0]
+        for post in queryset.filter(pub_date__gte=since).only('title', 'slug', 'pub_date'):
+            posts.setdefault((post.pub_date.year, post.pub_date.month), []).append(post)
+
+    archive = []
+    for index, (month, count) in enumerate(months):
+        if not archive or archive[-1][0] != month.year:
+            archive.append((month.year, []))
+        archive[-1][1].append({
+            'month': month.month,
+            'count': count,
+            'posts': posts.get((month.year, month.month)) if index < listed_months else None,
+        })
+    return archive
 
 def posts_archive(request):
     '''a archive posts listing view'''
-    posts = Post.objects.filter().order_by('-pub_date')
-    now = datetime.datetime.now()
-
-    #create a dict with the years and months:posts 
-    post_dict = {}
-    for i in range(posts[0].pub_date.year, posts[len(posts)-1].pub_date.year-1, -1):
-        post_dict[i] = {}
-        for month in range(1,13):
-            post_dict[i][month] = []
-    for post in posts:
-        post_dict[post.pub_date.year][post.pub_date.month].append(post)
- 
-    #this is necessary for the years to be sorted
-    post_sorted_keys = list(reversed(sorted(post_dict.keys())))
-    list_posts = []
-    for key in post_sorted_keys:
-        adict = {key:post_dict[key]}
-        list_posts.append(adict)
+    caching.add_dependencies(request, caching.POSTS)
+    archive = build_archive(Post.objects.all(),
+                            getattr(settings, 'ARCHIVE_LISTED_MONTHS', 12))
+
+    return render_to_response('blogengine/post_archive.html',
+                             {'archive': archive})
+
+def posts_archive_year(request, year):
+    '''a archive posts listing view for one year'''
+    caching.add_dependencies(request, caching.POSTS)
+    start = month_range(int(year), 1)[0]
+    end = month_range(int(year), 12)[1]
+    archive = build_archive(Post.objects.filter(pub_date__gte=start, pub_date__lt=end), 12)
+
+    return render_to_response('blogengine/post_archive.html',
+                             {'archive': archive})
+
+def posts_archive_month(request, year, month):
+    '''a archive posts listing view for one month'''
+    caching.add_dependencies(request, caching.POSTS)
+    start, end = month_range(int(year), int(month))
+    archive = build_archive(Post.objects.filter(pub_date__gte=start, pub_date__lt=end), 1)
 
     return render_to_response('blogengine/post_archive.html',
-                             {'now': now, 'list_posts': list_posts})
+                             {'archive': archive})
+
+def category_overview(posts_per_category):
+    '''
+    Categories with posts, most recently posted to first, each with its post
+    count and newest posts. Takes two queries whatever the number of posts.
+    '''
+    categories = list(Category.objects
+                      .annotate(post_count=Count('post'), latest=Max('post__pub_date'))
+                      .filter(post_count__gt=0)
+                      .order_by('-latest'))
+
+    newest = Subquery(Post.objects.filter(category=OuterRef('category'))
+                      .order_by('-pub_date').values('pk')[:posts_per_category])
+    posts = {}
+    for post in (Post.objects.filter(category__isnull=False, pk__in=newest)
+                 .only('title', 'slug', 'pub_date', 'category')
+                 .order_by('-pub_date')):
+        posts.setdefault(post.category_id, []).append(post)
+
+    return [(category, posts.get(category.pk, [])) for category in categories]
 
 def posts_category(request):
     '''a category posts listing view'''
-    posts = Post.objects.filter().order_by('-pub_date')
-    
-    #create a dict with the category and posts
-    post_dict = {}
-    for post in posts:
-        if post.category is None:
-            continue
-
-        if post.category.name not in post_dict:
-            post_dict[post.category.name] = []
-        post_dict[post.category.name].append(post)
+    caching.add_dependencies(request, caching.CATEGORY_OVERVIEW)
+    posts_per_category = getattr(settings, 'CATEGORY_OVERVIEW_POSTS', 5)
+    overview = caching.cached('blogengine:category-overview:%d' % posts_per_category,
+                              [caching.CATEGORY_OVERVIEW],
+                              lambda: category_overview(posts_per_category))
 
     return render_to_response('blogengine/post_category.html',
-                              {'list_posts': post_dict})
-        
+                              {'overview': overview})
 
+def sitemap_index(request):
+    '''the sitemap index, linking to a sitemap per shard of each section'''
+    return StreamingHttpResponse(sitemaps.stream_index(request),
+                                 content_type='application/xml; charset=utf-8')
 
+def sitemap_section(request, section, shard):
+    '''the sitemap of a shard of posts, categories, tags or flatpages, streamed'''
+    if section not in sitemaps.SECTIONS:
+        raise Http404
+    # Reading the first row runs the query within the view, and tells the
+    # shards without rows, past the last one included, from the others
+    rows = sitemaps.shard_rows(section, int(shard)).iterator()
+    first = next(rows, None)
+    if first is None:
+        raise Http404
+    return StreamingHttpResponse(sitemaps.stream_section(request, section, itertools.chain([first], rows)),
+                                 content_type='application/xml; charset=utf-8')
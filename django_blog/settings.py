@@ -47,21 +47,27 @@ INSTALLED_APPS = [
 SITE_ID = 1
 
 MIDDLEWARE = [
+    'blogengine.middleware.CompressionMiddleware',
     'debug_toolbar.middleware.DebugToolbarMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'django.middleware.http.ConditionalGetMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'django.middleware.cache.UpdateCacheMiddleware',
+    'blogengine.middleware.UpdateCacheMiddleware',
     'django.middleware.common.CommonMiddleware',
-    'django.middleware.cache.FetchFromCacheMiddleware',
+    'blogengine.middleware.FetchFromCacheMiddleware',
+    'blogengine.querybudget.QueryBudgetMiddleware',
 ]
 
 INTERNAL_IPS=('127.0.0.1',)
 
+# Fail instead of logging when a view runs more queries than its budget
+QUERY_BUDGET_STRICT = DEBUG
+
 ROOT_URLCONF = 'django_blog.urls'
 
 TEMPLATES = [
@@ -169,6 +175,9 @@ DATABASES['default'] =  dj_database_url.config(default="sqlite:///db.sqlite3")
 # Honor the 'X-Forwarded-Proto' header for request.is_secure()
 SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
 
+# Scheme of the urls built outside of requests, such as in published feeds
+SITE_SCHEME = 'https'
+
 # Allow all host headers
 ALLOWED_HOSTS = ['*']
 
@@ -179,29 +188,128 @@ STATICFILES_DIRS = (
     os.path.join(BASE_DIR, 'static'),
 )
 
+# Fingerprint and precompress the collected files, bundling the stylesheets
+STATICFILES_STORAGE = 'blogengine.assets.CompressedManifestStorage'
+
+STATIC_BUNDLES = {
+    'css/site.css': [
+        'bower_components/bootstrap/dist/css/bootstrap.css',
+        'bower_components/bootstrap/dist/css/bootstrap-theme.css',
+        'bower_components/font-awesome/css/font-awesome.css',
+        'css/code.css',
+        'css/main.css',
+        'css/sidebar.css',
+        'css/archive.css',
+        'css/category.css',
+    ],
+}
+
+# Critical css inlined into pages, written by buildcriticalcss, and the
+# number of elements into a page taken to be above the fold
+CRITICAL_CSS_ROOT = os.path.join(BASE_DIR, 'critical')
+CRITICAL_CSS_FOLD_ELEMENTS = 150
+
+# Cache lifetime of static files without a fingerprint in their name
+STATIC_MAX_AGE = 60 * 60
+
+# Where the resized variants of the images in posts are written and served
+# from, None to leave images as they are, and the widths they are resized
+# to. Sizes is the width images are shown at, beside the 250px sidebar.
+RESPONSIVE_IMAGES_ROOT = os.path.join(BASE_DIR, 'media', 'images')
+RESPONSIVE_IMAGES_URL = '/media/images/'
+RESPONSIVE_IMAGE_WIDTHS = (320, 640, 960, 1280, 1920)
+RESPONSIVE_IMAGE_SIZES = '(min-width: 769px) calc(100vw - 250px), 100vw'
+RESPONSIVE_IMAGE_QUALITY = 80
+
 def get_cache():
   import os
   try:
     os.environ['MEMCACHE_SERVERS'] = os.environ['MEMCACHIER_SERVERS'].replace(',', ';')
     os.environ['MEMCACHE_USERNAME'] = os.environ['MEMCACHIER_USERNAME']
     os.environ['MEMCACHE_PASSWORD'] = os.environ['MEMCACHIER_PASSWORD']
-    return {
-      'default': {
-        'BACKEND': 'django_pylibmc.memcached.PyLibMCCache',
-        'TIMEOUT': 300,
-        'BINARY': True,
-        'OPTIONS': { 'tcp_nodelay': True }
-      }
+    remote = {
+      'BACKEND': 'django_pylibmc.memcached.PyLibMCCache',
+      'TIMEOUT': 300,
+      'BINARY': True,
+      'OPTIONS': { 'tcp_nodelay': True }
     }
   except:
-    return {
-      'default': {
-        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
-        'LOCATION': '127.0.0.1:11211'
-      }
+    remote = {
+      'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+      'TIMEOUT': 300,
+      'LOCATION': 'blogengine'
     }
+  # Per-worker LRU in front of memcached, or of locmem without MemCachier.
+  # Dependency versions and page locks are always read from the shared cache,
+  # so pages cached by a worker are checked against the current versions.
+  return {
+    'default': {
+      'BACKEND': 'blogengine.cache_backends.TieredCache',
+      'LOCATION': 'remote',
+      'TIMEOUT': 300,
+      'OPTIONS': {
+        'MAX_ENTRIES': 1000,
+        'MAX_BYTES': 64 * 1024 * 1024,
+        'LOCAL_TIMEOUT': 5,
+        'REMOTE_ONLY_PREFIXES': ['blogengine:version:', 'blogengine:page-lock:'],
+      }
+    },
+    'remote': remote
+  }
 
 CACHES = get_cache()
 CACHE_MIDDLEWARE_ALIAS = 'default'
 CACHE_MIDDLEWARE_SECONDS = 300
 CACHE_MIDDLEWARE_KEY_PREFIX = ''
+
+# Page cache: keep serving stale pages for a grace period while one worker
+# rebuilds them, and spread expiry times out
+PAGE_CACHE_GRACE_SECONDS = 60
+PAGE_CACHE_JITTER = 0.1
+PAGE_CACHE_LOCK_SECONDS = 10
+PAGE_CACHE_LOCK_WAIT = 0.5
+
+# Responses smaller than this are sent uncompressed
+COMPRESSION_MIN_SIZE = 256
+
+# Number of recent months listing their posts on the archive page
+ARCHIVE_LISTED_MONTHS = 12
+
+# Number of newest posts listed per category on the categories page
+CATEGORY_OVERVIEW_POSTS = 5
+
+# Search backend, by default the full-text search of the database. The inverted
+# index of IndexBackend is kept up to date whichever backend is used.
+SEARCH_BACKEND = None
+
+# Link listing pages by number rather than by cursor, as the static export does
+NUMBERED_PAGE_LINKS = False
+
+# Urls in each sitemap file, at most the 50,000 of the sitemap protocol
+SITEMAP_URLS_PER_FILE = 50000
+
+# Directory of the static export, kept up to date as posts change when set
+EXPORT_ROOT = None
+
+# Number of newest posts in each feed
+FEED_ITEMS = 20
+
+# Where the posts feeds are written when posts change, None to build them
+# on each request instead
+PUBLISHED_FEEDS_ROOT = os.path.join(BASE_DIR, 'published', 'feeds')
+
+# Number of suggestions offered while typing a search
+SEARCH_SUGGESTIONS = 8
+
+# Number of words in the snippet shown for each search result
+SEARCH_SNIPPET_WORDS = 30
+
+# Search ranking: BM25 parameters, and the weight of a term in a post title
+SEARCH_TITLE_BOOST = 3.0
+SEARCH_BM25_K1 = 1.2
+SEARCH_BM25_B = 0.75
+
+# Rendered markdown cache: per-worker LRU in front of the shared cache
+MARKDOWN_CACHE_ENTRIES = 256
+MARKDOWN_CACHE_ALIAS = 'default'
+MARKDOWN_CACHE_TIMEOUT = 24 * 60 * 60
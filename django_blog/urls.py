@@ -32,3 +32,9 @@ if settings.DEBUG:
     urlpatterns = [
         url(r'^__debug__/', include(debug_toolbar.urls)),
     ] + urlpatterns
+
+if settings.DEBUG and settings.RESPONSIVE_IMAGES_ROOT:
+    # Resized images, served by the WSGI application in production
+    from django.conf.urls.static import static
+    urlpatterns = static(settings.RESPONSIVE_IMAGES_URL,
+                         document_root=settings.RESPONSIVE_IMAGES_ROOT) + urlpatterns
@@ -10,11 +10,20 @@ https://docs.djangoproject.com/en/1.11/howto/deployment/wsgi/
 import os
 
 from django.core.wsgi import get_wsgi_application
-from dj_static import Cling
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "django_blog.settings")
 
-application = Cling(get_wsgi_application())
+application = get_wsgi_application()
+
+# Serve the collected static files, precompressed and fingerprinted
+from blogengine.assets import StaticFilesHandler
+application = StaticFilesHandler(application)
+
+# Serve the resized images
+from blogengine.assets import ImagesHandler
+from blogengine.images import images_root
+if images_root() is not None:
+    application = ImagesHandler(application)
 
 # Fix django closing connection to MemCachier after every request (#11331)
 from django.core.cache.backends.memcached import BaseMemcachedCache